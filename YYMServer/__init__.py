@@ -57,6 +57,10 @@ except OSError:
 
 # 准备缓存
 cache = Cache(app, config=app.config)
+from YYMServer.caching import init_cache
+init_cache(app, cache)      # 统计每个请求访问缓存服务的往返次数
+from YYMServer.metrics import init_metrics
+init_metrics(app)           # 统计缓存及接口的性能指标，通过 /rpc/metrics 接口查看
 
 # 准备 api 接口
 api = restful.Api(app, catch_all_404s=True)
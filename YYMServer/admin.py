@@ -497,11 +497,9 @@ class SiteView(MyModelView):
         return super(SiteView, self).update_model(form, model)
 
     def after_model_change(self, form, model, is_created):
-        # 监控 reviews 的修改，更新计数：
+        # 监控 reviews 的修改（星级和评论数由 Review 的 mapper 事件增量维护）：
         after_update_reviews_ids = [review.id for review in model.reviews]
         reviews_ids_diff = util.diff_list(self.before_update_reviews_ids, after_update_reviews_ids)
-        if reviews_ids_diff:
-            util.count_reviews([], [model])
         # 监控 gate_image, top_images, reviews 的修改，更新图片计数：
         after_update_gate_images = model.gate_images
         after_update_top_images = model.top_images
@@ -694,10 +692,8 @@ class ReviewView(MyModelView):
         comments_ids_diff = util.diff_list(self.before_update_comments_ids, after_update_comments_ids)
         if comments_ids_diff:
             util.count_comments([], [], [model])
-        # 监控 reviews 的修改，更新 POI 星级和计数，以及相关用户账号的计数：
-        user = model.user
+        # POI 星级和计数，以及相关用户账号的计数由 Review 的 mapper 事件增量维护，这里只更新图片计数：
         site = model.site
-        util.count_reviews([user] if user else [], [site] if site else [])
         if site:
             util.count_images(site)
         # 监控 like reviews 的修改，更新计数：
@@ -707,12 +703,10 @@ class ReviewView(MyModelView):
         return super(ReviewView, self).after_model_change(form, model, is_created)
 
     def on_model_delete(self, model):
-        '''监控 reviews 的删除，更新 POI 星级和计数，以及相关用户账号的计数。'''
+        '''监控 reviews 的删除，更新 POI 图片计数（星级和计数由 Review 的 mapper 事件增量维护）。'''
         model.valid = False
         db.session.commit()
-        user = model.user
         site = model.site
-        util.count_reviews([user] if user else [], [site] if site else [])
         if site:
             util.count_images(site)
         return super(ReviewView, self).on_model_delete(model)
@@ -857,6 +851,17 @@ class AreaView(TagAlikeView):
         },
     }
 
+    def after_model_change(self, form, model, is_created):
+        # 商区层级关系可能改变，重建闭包表：
+        util.rebuild_closure(Area, AreaClosure)
+        return super(AreaView, self).after_model_change(form, model, is_created)
+
+    def delete_model(self, model):
+        result = super(AreaView, self).delete_model(model)
+        if result:
+            util.rebuild_closure(Area, AreaClosure)
+        return result
+
 
 class CategoryView(TagAlikeView):
     column_searchable_list = ('name',)
@@ -874,6 +879,17 @@ class CategoryView(TagAlikeView):
         ),
     }
 
+    def after_model_change(self, form, model, is_created):
+        # 分类层级关系可能改变，重建闭包表：
+        util.rebuild_closure(Category, CategoryClosure)
+        return super(CategoryView, self).after_model_change(form, model, is_created)
+
+    def delete_model(self, model):
+        result = super(CategoryView, self).delete_model(model)
+        if result:
+            util.rebuild_closure(Category, CategoryClosure)
+        return result
+
 
 class BrandView(MyModelView):
     column_searchable_list = ('name', 'name_zh', 'description', 'note')
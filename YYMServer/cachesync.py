@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+''' 通过 SQLAlchemy 的 session 事件集中维护缓存，后台管理界面和 rpc 接口的写操作都不必再各自清除缓存：
+
+* 每次 flush 之后（after_flush），记录本次被新建、修改、删除的 POI 、用户、晒单评论、首页文章、子评论的 id ，以及需要更新的列表缓存标签；
+* 事务提交之后（after_commit），一次性删除这些数据的详情缓存（util.get_info_ids 使用的 one_xxx_id）及 JSON 片段缓存（fragments 模块），
+  登记数据变更（util.notify_changes ，各服务进程的一级缓存、 POI 数据表、搜索索引据此刷新），并更新标签（caching.bump_tags）；
+  用户的收藏、喜欢、关注关系变化时，同时删除该用户的关系集合缓存（util.get_relation_ids）；
+* 事务回滚之后（after_rollback），丢弃记录。
+
+详情缓存只做删除，下次读取时由 get_info_ids 从数据库重新加载；rpc 接口中写操作之后调用的 util.update_cache 仍然会直接写入新数据。
+标签名称须与 rpc 模块中各个 caching.memoize 函数的标签一致。
+'''
+
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+
+from YYMServer import cache, util, fragments
+from YYMServer.caching import bump_tags
+from YYMServer.models import *
+
+TRACKED_MODELS = (Site, User, Review, Article, Comment)
+INFO_KEY = 'cachesync'
+RELATION_TAGS = {'user_favorites': 'favorites', 'user_likes': 'likes', 'fan': 'follows'}     # 标签名称 -> 用户关系集合的种类
+
+
+def _get_values(obj, name):
+    ''' 给出属性 name 在本次修改前后的全部非空取值，例如晒单评论修改前后所属的两个 POI 的 id 。'''
+    added, unchanged, deleted = attributes.get_history(obj, name)
+    return set(value for value in list(added or ()) + list(unchanged or ()) + list(deleted or ()) if value)
+
+def _get_changed_items(obj, name):
+    ''' 给出集合属性 name （例如 user.likes）本次增加和删除的元素，不加载整个集合。'''
+    added, unchanged, deleted = attributes.get_history(obj, name, passive=attributes.PASSIVE_NO_INITIALIZE)
+    return list(added or ()) + list(deleted or ())
+
+def _review_counted(session, obj):
+    ''' 晒单评论是否新建、删除，或者修改了影响 POI 星级、评论数统计的字段（喜欢数等其他修改不需要更新 POI 和作者的缓存）。'''
+    if obj in session.new or obj in session.deleted:
+        return True
+    return any(attributes.get_history(obj, name, passive=attributes.PASSIVE_NO_INITIALIZE).has_changes() for name in REVIEW_COUNTED_FIELDS)
+
+def _get_area_tags(session, site_ids):
+    ''' 给出 POI 所在城市、国家的晒单评论列表标签。'''
+    if not site_ids:
+        return []
+    query = session.query(Area.city_id, City.country_id).join(City, Area.city_id == City.id).join(Site, Site.area_id == Area.id).filter(Site.id.in_(list(site_ids)))
+    tags = []
+    for city_id, country_id in query:
+        tags.append('city_reviews:%d' % city_id)
+        if country_id:
+            tags.append('country_reviews:%d' % country_id)
+    return tags
+
+def _get_tags(session, obj):
+    ''' 给出数据 obj 被修改时需要更新的列表缓存标签。'''
+    tags = []
+    if isinstance(obj, Review):
+        tags.extend(['reviews', 'review:%d' % obj.id])
+        tags.extend('user_reviews:%d' % id for id in _get_values(obj, 'user_id'))
+        site_ids = _get_values(obj, 'site_id')
+        tags.extend('site_reviews:%d' % id for id in site_ids)
+        tags.extend(_get_area_tags(session, site_ids))
+        tags.extend('user_likes:%d' % user.id for user in _get_changed_items(obj, 'fans'))
+    elif isinstance(obj, Comment):
+        tags.extend(['comments', 'comment:%d' % obj.id])
+        tags.extend('article_comments:%d' % id for id in _get_values(obj, 'article_id'))
+        tags.extend('review_comments:%d' % id for id in _get_values(obj, 'review_id'))
+    elif isinstance(obj, Article):
+        tags.append('articles')
+    elif isinstance(obj, Site):
+        tags.extend('user_favorites:%d' % user.id for user in _get_changed_items(obj, 'fans'))
+    elif isinstance(obj, User):
+        if _get_changed_items(obj, 'likes'):
+            tags.append('user_likes:%d' % obj.id)
+        if _get_changed_items(obj, 'favorites'):
+            tags.append('user_favorites:%d' % obj.id)
+        # UserList 中 follow 参数查询该用户的粉丝， fan 参数查询该用户关注的人：
+        fans = _get_changed_items(obj, 'fans')
+        if fans:
+            tags.append('follow:%d' % obj.id)
+            tags.extend('fan:%d' % user.id for user in fans)
+        follows = _get_changed_items(obj, 'follows')
+        if follows:
+            tags.append('fan:%d' % obj.id)
+            tags.extend('follow:%d' % user.id for user in follows)
+    elif isinstance(obj, ShareRecord):
+        tags.extend('user_shares:%d' % id for id in _get_values(obj, 'user_id'))
+    return tags
+
+def _get_relation_keys(tags):
+    ''' 给出需要删除的用户关系集合（util.get_relation_ids）的缓存 key ：用户的收藏、喜欢、关注列表标签变化，说明对应的关系集合也变化了。'''
+    keys = []
+    for tag in tags:
+        name, sep, id = tag.partition(':')
+        relation = RELATION_TAGS.get(name)
+        if relation and id:
+            keys.append(util.get_relation_key(relation, int(id)))
+    return keys
+
+@event.listens_for(SignallingSession, 'after_flush')
+def collect_changes(session, flush_context):
+    ''' 记录本次 flush 涉及的数据 id 和标签，暂存在 session.info 中，直到事务提交或回滚。'''
+    pending = session.info.setdefault(INFO_KEY, {'ids': {}, 'tags': set()})
+    dirty = [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in list(session.new) + dirty + list(session.deleted):
+        if isinstance(obj, TRACKED_MODELS) and obj.id:
+            pending['ids'].setdefault(obj.__tablename__, set()).add(obj.id)
+        if isinstance(obj, Review) and _review_counted(session, obj):     # POI 星级、评论数及作者评论数由 Review 的 mapper 事件直接在数据库中修改
+            pending['ids'].setdefault('site', set()).update(_get_values(obj, 'site_id'))
+            pending['ids'].setdefault('user', set()).update(_get_values(obj, 'user_id'))
+        pending['tags'].update(_get_tags(session, obj))
+
+def invalidate(ids, tags=()):
+    ''' 批量删除数据的详情缓存及 JSON 片段缓存、登记数据变更并更新标签，ids 是 表名 -> id 集合 的字典。
+
+    不经过 ORM 的批量 SQL 修改（例如 task.score_popularity）不会触发 session 事件，由调用方在提交后直接调用。
+    '''
+    keys = []
+    for tablename, table_ids in ids.items():
+        keys.extend('one_%s_%d' % (tablename, id) for id in table_ids)
+    util.local_cache.delete_many(keys)
+    for tablename, table_ids in ids.items():
+        keys.extend(fragments.get_keys(tablename, table_ids))
+    keys.extend(_get_relation_keys(tags))
+    if keys:
+        cache.delete_many(*keys)
+    for tablename, table_ids in ids.items():
+        util.notify_changes(tablename, sorted(table_ids))
+    bump_tags(tags)
+
+def get_review_tags(session, review_ids):
+    ''' 给出晒单评论被批量 SQL 修改时需要更新的列表缓存标签，与 _get_tags 对晒单评论给出的一致（不涉及喜欢关系）。'''
+    if not review_ids:
+        return []
+    tags = ['reviews']
+    site_ids = set()
+    for id, user_id, site_id in session.query(Review.id, Review.user_id, Review.site_id).filter(Review.id.in_(list(review_ids))):
+        tags.append('review:%d' % id)
+        if user_id:
+            tags.append('user_reviews:%d' % user_id)
+        if site_id:
+            tags.append('site_reviews:%d' % site_id)
+            site_ids.add(site_id)
+    tags.extend(_get_area_tags(session, site_ids))
+    return tags
+
+@event.listens_for(SignallingSession, 'after_commit')
+def apply_changes(session):
+    ''' 事务提交后，批量删除详情缓存、登记数据变更并更新标签。'''
+    pending = session.info.pop(INFO_KEY, None)
+    if not pending:
+        return
+    invalidate(pending['ids'], pending['tags'])
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def discard_changes(session):
+    session.info.pop(INFO_KEY, None)
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+''' 缓存服务的辅助封装。
+
+CountingCache 包装 Flask-Cache 实际使用的缓存后端（例如 RedisCache），对每次访问缓存服务的调用计数：
+一次 get_many / set_many 只算一次往返，从而可以验证批量读写的效果。
+每个请求的往返次数通过 X-Cache-Round-Trips 响应头输出，累计次数计入 stats 的 cache_round_trips ；按 key 类别的命中率、字节数及耗时记入 metrics 模块。
+
+LocalCache 是服务进程内的一级缓存（L1），放在共享缓存服务之前，供 util.get_info_ids 读取热点数据时不必访问缓存服务。
+
+memoize 是按标签失效的函数缓存：写操作调用 bump_tags 使依赖相应标签的全部缓存数据失效，无需枚举参数组合逐个删除；
+同时防止缓存过期时大量请求同时重新计算（single-flight），并可在过期后的一段时间内继续使用旧数据。
+'''
+
+import collections
+import cPickle as pickle
+import functools
+import hashlib
+import inspect
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context
+from werkzeug.contrib.cache import BaseCache
+
+from YYMServer import app, cache, metrics, stats
+
+# 会访问缓存服务的后端方法：
+ROUND_TRIP_METHODS = ('get', 'get_many', 'get_dict', 'set', 'set_many', 'add', 'delete', 'delete_many', 'inc', 'dec', 'has', 'clear')
+
+
+def count_round_trip():
+    ''' 记录一次缓存服务往返。'''
+    stats.incr('cache_round_trips')
+    if has_request_context():
+        g.cache_round_trips = getattr(g, 'cache_round_trips', 0) + 1
+
+
+class CountingCache(object):
+    ''' 缓存后端的代理，转发全部调用，并对 ROUND_TRIP_METHODS 中的方法计数，同时向 metrics 模块记录各类 key 的命中情况、数据字节数及耗时。
+
+    后端自行序列化数据时（提供 dump_object 和 load_object 方法，例如 RedisCache），借用这两个方法记录每个 key 的数据字节数。
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.local = threading.local()
+        if getattr(type(backend).delete_many, 'im_func', None) is BaseCache.delete_many.im_func:
+            # BaseCache.delete_many 遇到第一个不存在的 key 就停止删除（all 的短路求值），SimpleCache 等后端因而会漏删其余的 key ：
+            backend.delete_many = lambda *keys: all([backend.delete(key) for key in keys])
+        if hasattr(backend, 'dump_object') and hasattr(backend, 'load_object'):
+            backend.dump_object = self._measured(backend.dump_object, False)
+            backend.load_object = self._measured(backend.load_object, True)
+
+    def _measured(self, func, loading):
+        def measured(value):
+            result = func(value)
+            sizes = getattr(self.local, 'sizes', None)
+            if sizes is not None:
+                data = value if loading else result
+                sizes.append(len(data) if isinstance(data, basestring) else 0)
+            return result
+        return measured
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name not in ROUND_TRIP_METHODS:
+            return attr
+        def counted(*args, **kwargs):
+            count_round_trip()
+            if not metrics.enabled:
+                return attr(*args, **kwargs)
+            self.local.sizes = []
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                sizes, self.local.sizes = self.local.sizes, None
+            if name in ('set_many', 'get_dict'):
+                keys = list(args[0] if name == 'set_many' else args)
+            elif name in ('get_many', 'delete_many'):
+                keys = list(args)
+            else:
+                keys = list(args[:1])
+            hits = None
+            if name in ('get', 'get_many'):
+                hits = [value is not None for value in (result if name == 'get_many' else [result])]
+            elif name == 'get_dict':
+                hits = [result.get(key) is not None for key in keys]
+            metrics.record_cache(name, keys, seconds, hits, sizes if len(sizes) == len(keys) else None)
+            return result
+        return counted
+
+
+def init_cache(app, cache):
+    ''' 用 CountingCache 包装 cache 的后端，并注册输出请求往返次数的响应处理。'''
+    app.extensions['cache'][cache] = CountingCache(app.extensions['cache'][cache])
+
+    @app.after_request
+    def add_round_trips_header(response):
+        response.headers['X-Cache-Round-Trips'] = str(getattr(g, 'cache_round_trips', 0))
+        return response
+
+
+class LocalCache(object):
+    ''' 进程内的一级缓存：容量有限（超出时淘汰最久未使用的条目），每个条目在 timeout 秒后过期。
+
+    条目以 pickle 后的字符串保存，每次读取都得到新的对象副本，避免不同请求（线程）修改同一个对象。
+    其他进程对数据的修改，通过 sync 函数读取 util.notify_changes 登记的变更来使对应条目失效。
+    clock 和 get_changes 可以替换为本地的模拟实现，以便脱离缓存服务单独测试。
+    '''
+
+    def __init__(self, max_size=1000, timeout=5, check_interval=1, clock=time.time, get_changes=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.clock = clock
+        self.get_changes = get_changes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # key -> (过期时间, pickle 后的数据)
+        self.versions = {}      # channel -> (已同步的变更版本号, 最后检查时间)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, keys):
+        ''' 按 keys 的顺序给出缓存内容，不存在或已过期的给出 None 。'''
+        now = self.clock()
+        result = []
+        hit = 0
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None or entry[0] < now:
+                    if entry is not None:
+                        del self.entries[key]
+                    result.append(None)
+                    continue
+                # 最近使用过的条目移到末尾：
+                del self.entries[key]
+                self.entries[key] = entry
+                result.append(entry[1])
+                hit += 1
+        if keys:
+            stats.incr('local_cache_hit', hit)
+            stats.incr('local_cache_miss', len(keys) - hit)
+        return [None if data is None else pickle.loads(data) for data in result]
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set_many(self, mapping):
+        if not self.max_size:
+            return
+        expire_time = self.clock() + self.timeout
+        items = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in mapping.items()]
+        with self.lock:
+            for key, data in items:
+                self.entries.pop(key, None)
+                self.entries[key] = (expire_time, data)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        ''' 删除全部以 prefix 开头的条目。'''
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def sync(self, channel, key_template):
+        ''' 读取 channel 的数据变更，删除被修改数据对应的条目（key_template 如 'one_site_%d'）；两次检查之间至少间隔 check_interval 秒。
+
+        变更记录不完整时，删除该 channel 的全部条目。
+        '''
+        if not self.max_size or self.get_changes is None:
+            return
+        now = self.clock()
+        version, check_time = self.versions.get(channel, (None, 0))
+        if version is not None and now - check_time < self.check_interval:
+            return
+        new_version, ids = self.get_changes(channel, version)
+        if ids is None:     # 首次使用该 channel 时也是如此，但此时还没有需要删除的条目
+            self.delete_prefix(key_template.split('%')[0])
+        elif ids:
+            self.delete_many([key_template % id for id in ids])
+        self.versions[channel] = (new_version, now)
+
+
+TAG_TIMEOUT = 86400 * 7     # 标签 generation 的保存时间，应长于被缓存数据的缓存时间
+
+def _tag_keys(tags):
+    return ['tag_' + tag for tag in tags]
+
+def _new_generation():
+    ''' 标签不存在（从未使用或已被缓存服务清除）时的初始 generation ：当前的毫秒时间，确保不会与清除之前的取值重复。'''
+    return int(time.time() * 1000)
+
+def _init_tags(keys, generations):
+    ''' 对 generation 为 None （不存在）的标签做初始化，给出全部标签初始化之后的 generation 。'''
+    missing = [key for key, generation in zip(keys, generations) if generation is None]
+    if not missing:
+        return tuple(generations)
+    for key in missing:
+        cache.cache.add(key, _new_generation(), timeout=TAG_TIMEOUT)
+    return tuple(cache.get_many(*keys))     # 其他进程可能同时做了初始化，以缓存服务中的取值为准
+
+def bump_tags(tags):
+    ''' 增加各个标签的 generation ，使依赖这些标签的 memoize 缓存数据全部失效。'''
+    for key in _tag_keys(set(tags)):
+        if cache.cache.inc(key) == 1:   # 标签原本不存在
+            cache.cache.set(key, _new_generation(), timeout=TAG_TIMEOUT)
+
+LOCK_TIMEOUT = 30      # 重新计算缓存数据时所持锁的最长保持时间（秒），避免持锁进程异常退出后一直无法重新计算
+LOCK_WAIT = 3           # 没有可用的缓存数据、又有其他请求正在计算时，等待其结果的最长时间（秒），超时后自行计算
+WAIT_INTERVALS = (0.05, 0.1, 0.2, 0.4, 0.5)    # 等待期间检查计算结果的间隔（秒），逐渐加长，之后一直使用最后一个值
+
+# 只有锁的取值仍是自己的令牌时才删除（Redis 的 Lua 脚本是原子执行的）：
+RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+def _acquire(key):
+    ''' 抢锁，成功时给出本次持锁的令牌（释放时用于核对），失败时给出 None 。'''
+    token = uuid.uuid4().hex
+    return token if cache.cache.add('lock_' + key, token, timeout=LOCK_TIMEOUT) else None
+
+def _release(key, token):
+    ''' 释放锁：只有锁仍属于自己（取值是自己的令牌）时才删除，以免计算超过 LOCK_TIMEOUT 、锁已被其他请求重新抢到时误删他人的锁。
+
+    RedisCache 用 Lua 脚本原子地核对并删除；其他后端先读取再删除，两步之间仍有极短的竞争窗口。
+    '''
+    lock_key = 'lock_' + key
+    backend = cache.cache.backend
+    client = getattr(backend, '_client', None)
+    if client is not None and hasattr(client, 'eval'):
+        count_round_trip()
+        client.eval(RELEASE_SCRIPT, 1, (backend.key_prefix or '') + lock_key, backend.dump_object(token))
+    elif cache.cache.get(lock_key) == token:
+        cache.cache.delete(lock_key)
+
+def memoize(tags=None, timeout=None, stale_window=None, refresh_ahead=0):
+    ''' 与 cache.memoize 类似的函数缓存装饰器，增加了按标签失效、防止缓存击穿（stampede）和过期后继续使用旧数据的功能。
+
+    tags 是与被缓存函数参数相同的函数，给出这组参数的缓存结果所依赖的标签列表，例如：
+
+        @caching.memoize(tags=lambda site=0l, user=0l: ['site_reviews:%d' % site, 'user_reviews:%d' % user])
+
+    缓存数据与各个标签当时的 generation 一起保存；读取时通过一次 get_many 同时取回缓存数据和标签当前的 generation ，不一致即视为未命中。
+
+    缓存数据在 timeout 秒（默认为 CACHE_DEFAULT_TIMEOUT）后过期，但在之后的 stale_window 秒（默认为 CACHE_STALE_WINDOW）内仍然保留：
+    过期后只有抢到锁的一个请求重新计算，其他请求继续使用旧数据；完全没有缓存数据时，其他请求等待该请求的计算结果。
+    refresh_ahead 大于 0 时，在过期前 refresh_ahead 秒内即开始重新计算，适用于访问量最大的数据，使其几乎不会出现过期。
+    标签变化（数据确实已被修改）时不会继续使用旧数据。
+    '''
+    def decorator(f):
+        prefix = 'memoize_%s.%s_' % (f.__module__, f.__name__)
+        # 被缓存的是 Resource 类的方法时，key 中加上类名，以便 metrics 按类别区分各个接口的 _get 函数：
+        is_method = inspect.getargspec(f).args[:1] == ['self']
+        method_prefix = 'memoize_%s.%%s.%s_' % (f.__module__, f.__name__)
+
+        def compute(key, generations, args, kwargs):
+            result = f(*args, **kwargs)
+            expire = timeout or app.config['CACHE_DEFAULT_TIMEOUT']
+            window = app.config['CACHE_STALE_WINDOW'] if stale_window is None else stale_window
+            cache.set(key, (generations, time.time() + expire, result), timeout=expire + window)
+            return result
+
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            key = (method_prefix % args[0].__class__.__name__ if is_method and args else prefix) + hashlib.md5(repr((args, sorted(kwargs.items())))).hexdigest()
+            tag_keys = [] if tags is None else _tag_keys(tags(*args, **kwargs))
+            values = cache.get_many(key, *tag_keys)
+            entry, generations = values[0], tuple(values[1:])
+            now = time.time()
+            if entry is not None and None not in generations and entry[0] == generations:
+                fresh_until, result = entry[1], entry[2]
+                token = None if now < fresh_until - refresh_ahead else _acquire(key)
+                if token is None:
+                    stats.incr('memoize_hit' if now < fresh_until else 'memoize_stale')
+                    return result
+                stats.incr('memoize_refresh')
+                try:
+                    return compute(key, generations, args, kwargs)
+                finally:
+                    _release(key, token)
+            stats.incr('memoize_miss')
+            generations = _init_tags(tag_keys, generations)
+            token = _acquire(key)
+            if token is not None:
+                try:
+                    return compute(key, generations, args, kwargs)
+                finally:
+                    _release(key, token)
+            # 其他请求正在计算同一数据（没有可用的旧数据），逐渐拉长检查间隔，减少对缓存服务的访问：
+            deadline = now + LOCK_WAIT
+            attempt = 0
+            while time.time() < deadline:
+                time.sleep(WAIT_INTERVALS[min(attempt, len(WAIT_INTERVALS) - 1)])
+                attempt += 1
+                entry = cache.get(key)
+                if entry is not None and entry[0] == generations:
+                    return entry[2]
+            return compute(key, generations, args, kwargs)
+        return decorated
+    return decorator
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+''' 计数增量缓冲：活动期间热门晒单评论、用户的喜欢数等计数每分钟被修改成百上千次，逐次 UPDATE 会在同一行上争用行锁。
+开启 COUNTER_BUFFER 配置后，喜欢、收藏、关注、分享接口不再直接修改数据库中的计数字段，而是把增量累加到共享缓存中：
+
+* 每个计数字段的待写入增量保存在 'counter_<表名>_<字段名>_<id>' 中，用缓存服务的原子加法（inc）累加；
+* 同时像 util.notify_changes 一样，把本次涉及的计数登记在一个按版本号递增的日志中，供写入任务找到有增量的计数；
+* task.flush_counters 定期读取日志，把同一计数的多次增量合并后批量写入数据库（每种增量值一条 UPDATE），提交后再从缓存中减去已写入的增量；
+* util.get_info_ids 读取用户、晒单评论数据时叠加尚未写入的增量（overlay），因而接口输出的计数仍然是实时的。
+
+缓冲需要多进程共享的缓存服务（例如 Redis），增量记录在缓存中，缓存服务重启会丢失尚未写入的增量，由 task.reconcile_counters 修正。
+'''
+
+from YYMServer import app, cache
+
+# 允许缓冲的计数字段：表名 -> 字段名列表
+BUFFERED = {'user': ('like_num', 'favorite_num', 'fans_num', 'follow_num', 'share_num'),
+            'review': ('like_num', ),
+           }
+
+KEY_TEMPLATE = 'counter_%s_%s_%d'
+LOG_VERSION_KEY = 'counter_log_version'
+LOG_FLUSHED_KEY = 'counter_log_flushed'
+LOG_TEMPLATE = 'counter_log_%d'
+MAX_LOG_RANGE = 100000      # 一次最多读取的日志条数
+
+
+def enabled():
+    return app.config['COUNTER_BUFFER']
+
+def add(tablename, name, ids, delta):
+    ''' 把 tablename 表中 ids 对应数据的计数字段 name 增加 delta ，只记入缓冲，不修改数据库。'''
+    ids = [id for id in ids if id]
+    if not ids or not delta:
+        return
+    for id in ids:
+        cache.cache.inc(KEY_TEMPLATE % (tablename, name, id), delta)
+    version = cache.cache.inc(LOG_VERSION_KEY)
+    if version:
+        cache.set(LOG_TEMPLATE % version, [(tablename, name, id) for id in ids], timeout = app.config['COUNTER_BUFFER_LOG_TIMEOUT'])
+
+def overlay(tablename, objs):
+    ''' 在 tablename 表的数据对象 objs （各不相同）的计数字段上叠加尚未写入数据库的增量。'''
+    names = BUFFERED.get(tablename)
+    objs = list(objs)
+    if not names or not objs:
+        return
+    keys = [KEY_TEMPLATE % (tablename, name, obj.id) for obj in objs for name in names]
+    deltas = iter(cache.get_many(*keys))
+    for obj in objs:
+        for name in names:
+            delta = next(deltas)
+            if delta:
+                setattr(obj, name, (getattr(obj, name, 0) or 0) + int(delta))
+
+def snapshot(tablename, name, ids):
+    ''' 给出这些数据的计数字段 name 当前待写入的增量 {id: 增量} ，为 0 的不输出。在按关系数据重新计算计数之前调用，结果交给 discard 。'''
+    if name not in BUFFERED.get(tablename, ()):
+        return {}
+    ids = list(set(id for id in ids if id))
+    if not ids:
+        return {}
+    values = cache.get_many(*[KEY_TEMPLATE % (tablename, name, id) for id in ids])
+    return dict((id, int(value)) for id, value in zip(ids, values) if value and int(value))
+
+def discard(tablename, name, deltas):
+    ''' 计数字段按关系数据重新计算（写入了实际计数）之后，从缓冲中减去重新计算之前读到的增量 deltas （见 snapshot），以免之后写入时重复计入。
+
+    重新计算开始之后新增的增量没有包含在实际计数中，予以保留。
+    '''
+    for id, delta in deltas.items():
+        cache.cache.dec(KEY_TEMPLATE % (tablename, name, id), delta)
+
+def read_log():
+    ''' 读取上次写入之后登记的日志，给出 (起始版本号, 最新版本号, 有增量的计数集合) ，计数表示为 (表名, 字段名, id) 。
+
+    过期或丢失的日志条目被忽略，其中的增量要等同一计数再次被修改时才会写入（或由 task.reconcile_counters 修正）。
+    '''
+    version = cache.get(LOG_VERSION_KEY) or 0
+    flushed = cache.get(LOG_FLUSHED_KEY) or 0
+    if flushed > version:   # 缓存服务被重置
+        flushed = 0
+    start = max(flushed, version - MAX_LOG_RANGE)
+    entries = set()
+    for i in xrange(start + 1, version + 1, 1000):
+        for items in cache.get_many(*[LOG_TEMPLATE % j for j in xrange(i, min(i + 1000, version + 1))]):
+            entries.update(items or ())
+    return start, version, entries
+
+def get_pending(entries):
+    ''' 给出各计数（见 read_log）当前待写入的增量，为 0 的不输出。'''
+    entries = list(entries)
+    if not entries:
+        return {}
+    values = cache.get_many(*[KEY_TEMPLATE % entry for entry in entries])
+    return dict((entry, int(value)) for entry, value in zip(entries, values) if value and int(value))
+
+def mark_flushed(start, version, pending):
+    ''' 增量写入数据库之后，从缓冲中减去已写入的部分（期间新增的增量保留），记录已处理的日志版本号，并删除已处理的日志。'''
+    for entry, delta in pending.items():
+        cache.cache.dec(KEY_TEMPLATE % entry, delta)
+    flushed = cache.get(LOG_FLUSHED_KEY) or 0
+    if version != flushed:
+        cache.cache.inc(LOG_FLUSHED_KEY, version - flushed)
+    for i in xrange(start + 1, version + 1, 1000):
+        cache.delete_many(*[LOG_TEMPLATE % j for j in xrange(i, min(i + 1000, version + 1))])
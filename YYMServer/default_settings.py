@@ -34,5 +34,38 @@ CACHE_DEFAULT_TIMEOUT = 15 * 60
 #CACHE_REDIS_HOST = '127.0.0.1'
 #CACHE_REDIS_PORT = 6379
 #CACHE_REDIS_PASSWORD = ''
+# caching.memoize 函数缓存过期后继续使用旧数据的秒数（期间由一个请求重新计算），以及访问量最大的数据提前重新计算的秒数
+CACHE_STALE_WINDOW = 5 * 60
+CACHE_REFRESH_AHEAD = 60
+# util.get_info_ids 缓存“数据库中不存在”这一结果的秒数：
+NEGATIVE_CACHE_TIMEOUT = 60
+# 同一用户在同一设备上被新登陆取代的旧 token ，超过此天数后由 task.prune_tokens 删除：
+TOKEN_RETENTION_DAYS = 30
+# 服务进程内的一级缓存（YYMServer.caching.LocalCache）：最多缓存的条目数（为 0 表示不使用），条目过期秒数，检查其他进程数据变更的最小间隔秒数
+LOCAL_CACHE_SIZE = 2000
+LOCAL_CACHE_TIMEOUT = 5
+LOCAL_CACHE_CHECK_INTERVAL = 1
+# 列表接口（/rpc/sites 、 /rpc/reviews 、 /rpc/articles）是否使用缓存的 JSON 片段（YYMServer.fragments）拼接响应：
+JSON_FRAGMENTS = True
+# 是否把喜欢、收藏、关注、分享接口的计数修改先记入共享缓存中的增量缓冲（YYMServer.counters），由 cron/flush_counters.py 每隔几秒批量写入数据库。
+# 需要 Redis 等多进程共享的缓存服务；缓冲登记日志的过期秒数应远大于写入间隔：
+COUNTER_BUFFER = False
+COUNTER_BUFFER_LOG_TIMEOUT = 24 * 3600
+# 人气指数（YYMServer.popularity ，由 cron/score_popularity.py 每天计算）：各种行为的分值，分值随时间减半的天数，只统计最近多少天的行为：
+POPULARITY_SITE_WEIGHTS = {'favorite': 30, 'share': 20, 'review': 50, 'like': 5, 'comment': 5}
+POPULARITY_REVIEW_WEIGHTS = {'like': 10, 'comment': 20, 'share': 20}
+POPULARITY_HALF_LIFE = 30
+POPULARITY_WINDOW = 365
+# 人气指数达到此值的已发布晒单评论被自动设为精选（selected）：
+REVIEW_SELECTED_SCORE = 100
+# 是否统计缓存及接口的性能指标（YYMServer.metrics），通过 /rpc/metrics 接口查看：
+METRICS = True
+# “附近”搜索是否使用进程内存中的 POI 数据表（YYMServer.sitetable）做距离计算和排序：
+SITE_TABLE = True
+SITE_TABLE_REFRESH_INTERVAL = 10   # POI 数据表检查数据变更的最小间隔秒数
+# POI 关键词搜索是否使用倒排索引（YYMServer.search），以及索引文件的存储路径：
+SEARCH_INDEX = True
+SEARCH_INDEX_PATH = '/tmp/yym_search_index.pickle'
+SEARCH_INDEX_REFRESH_INTERVAL = 10     # 倒排索引检查数据变更的最小间隔秒数
 
 
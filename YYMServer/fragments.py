@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+''' 列表接口使用的 JSON 片段缓存：对 POI 、用户、晒单评论、首页文章等数据，按不同的输出格式（例如 brief 和 full）缓存 marshal 并序列化之后的 JSON 文本。
+
+缓存命中时，接口只需把各条数据的 JSON 片段拼接成完整的响应，不再对每条数据重复执行 marshal 及 json.dumps 。
+与当前用户相关的少数字段（例如 favorited 、 liked 、 followed）不放入片段，由接口在拼接时补充（overlay）。
+
+片段以 'json_<表名>_<格式名>_<id>' 为 key 保存在共享缓存中，缓存内容是 (JSON 文本, 关联数据) ，关联数据由注册时提供的 refs 函数给出，
+例如晒单评论的用户 id 、 POI id ，供接口继续读取内嵌数据的片段。
+数据被修改时，由 cachesync 模块（以及 util.update_cache）删除该数据全部格式的片段，下次读取时重新生成。
+'''
+
+import json
+
+from flask.ext.restful import marshal
+
+from YYMServer import cache, stats
+
+JSON_SETTINGS = {'ensure_ascii': False, 'encoding': 'utf8'}     # 与 rpc 模块中 output_json 的设置一致
+KEY_TEMPLATE = 'json_%s_%s_%d'
+
+formats = {}    # 表名 -> {格式名: (fields, refs 函数)}
+
+
+def register(tablename, name, fields, refs=None):
+    ''' 登记一种片段格式：fields 是 marshal 使用的字段定义，refs 是从数据对象提取关联数据的函数。'''
+    formats.setdefault(tablename, {})[name] = (fields, refs)
+
+def get_keys(tablename, ids):
+    ''' 给出数据 ids 的全部格式的片段 key ，用于删除片段缓存。'''
+    return [KEY_TEMPLATE % (tablename, name, id) for name in formats.get(tablename, ()) for id in ids]
+
+def dumps(data):
+    result = json.dumps(data, **JSON_SETTINGS)
+    return result.decode('utf8') if isinstance(result, str) else result     # 统一为 unicode ，以便拼接
+
+def render(obj, fields):
+    ''' 把数据对象 obj （可以是 None）按 fields 转为 JSON 文本。'''
+    return dumps(marshal(obj, fields))
+
+def extend(fragment, items):
+    ''' 在 JSON 对象片段 fragment 末尾补充字段，items 是 (字段名, 已经序列化的 JSON 文本) 的列表。'''
+    if not items:
+        return fragment
+    extra = ', '.join('%s: %s' % (dumps(name), value) for name, value in items)
+    return fragment[:-1] + (', ' if fragment != '{}' else '') + extra + '}'
+
+def get_fragments(tablename, name, ids, load_func):
+    ''' 按 ids 的顺序给出各数据 name 格式的 (JSON 文本, 关联数据) ，数据不存在或无效时给出 None 。
+
+    缓存中没有的数据，通过 load_func(缺少的 id 列表) 读取数据对象（通常是 util.get_info_ids 的包装），生成片段并批量写入缓存。
+    '''
+    if not ids:
+        return []
+    fields, refs = formats[tablename][name]
+    keys = [KEY_TEMPLATE % (tablename, name, id) for id in ids]
+    cached_dic = dict(zip(keys, cache.get_many(*keys)))
+    missing_ids = list(set(id for id, key in zip(ids, keys) if cached_dic[key] is None))
+    stats.incr('fragment_hit', len(ids) - len(missing_ids))
+    stats.incr('fragment_miss', len(missing_ids))
+    if missing_ids:
+        mapping = {}
+        for obj in load_func(missing_ids):
+            mapping[KEY_TEMPLATE % (tablename, name, obj.id)] = (render(obj, fields), None if refs is None else refs(obj))
+        if mapping:
+            cache.set_many(mapping)
+            cached_dic.update(mapping)
+    return [cached_dic.get(key) for key in keys]
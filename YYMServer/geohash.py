@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+''' Geohash 编码及邻接方格计算，用于 POI “附近”搜索时按方格做距离的初步筛选。
+
+编码方式与 http://en.wikipedia.org/wiki/Geohash 一致，同一前缀的 geohash 落在同一个方格内。
+'''
+
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+BASE32_INDEX = dict((char, i) for i, char in enumerate(BASE32))
+
+MAX_PRECISION = 12      # 与 Site.geohash 字段长度一致
+KM_PER_DEGREE = 111.2   # 经线方向上，每一度对应的公里数（近似值）
+
+
+def encode(latitude, longitude, precision=MAX_PRECISION):
+    ''' 将经纬度编码为指定长度的 geohash 字符串。'''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True     # geohash 的偶数位表示经度，奇数位表示纬度
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits = bits << 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits = bits << 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+def decode_bounds(geohash):
+    ''' 给出 geohash 方格的边界：(最小纬度, 最大纬度, 最小经度, 最大经度)。'''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = BASE32_INDEX[char]
+        for shift in (4, 3, 2, 1, 0):
+            bit = (value >> shift) & 1
+            target = lon_range if even else lat_range
+            mid = (target[0] + target[1]) / 2
+            if bit:
+                target[0] = mid
+            else:
+                target[1] = mid
+            even = not even
+    return (lat_range[0], lat_range[1], lon_range[0], lon_range[1])
+
+def cell_size(precision):
+    ''' 给出指定长度 geohash 方格的 (纬度跨度, 经度跨度)，单位是度。'''
+    lon_bits = (precision * 5 + 1) // 2
+    lat_bits = precision * 5 // 2
+    return (180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits))
+
+def precision_for_range(range, latitude):
+    ''' 选出方格边长不小于 range 公里的最长 geohash 长度，从而保证中心方格及其 8 个邻接方格能够覆盖 range 范围内的全部 POI 。'''
+    # 经度方向的方格宽度随纬度增加而变窄，因此按照搜索范围内离赤道最远的纬度计算：
+    farthest_latitude = min(abs(latitude) + range / KM_PER_DEGREE, 89.9)
+    lon_factor = math.cos(math.radians(farthest_latitude))
+    for precision in xrange(MAX_PRECISION, 0, -1):
+        lat_span, lon_span = cell_size(precision)
+        if lat_span * KM_PER_DEGREE >= range and lon_span * KM_PER_DEGREE * lon_factor >= range:
+            return precision
+    return 0
+
+def neighbors(geohash):
+    ''' 给出指定 geohash 方格周围的 8 个邻接方格（跨越 180 度经线时自动回绕，到达极点时不再向外扩展）。'''
+    precision = len(geohash)
+    min_lat, max_lat, min_lon, max_lon = decode_bounds(geohash)
+    lat_span = max_lat - min_lat
+    lon_span = max_lon - min_lon
+    center_lat = (min_lat + max_lat) / 2
+    center_lon = (min_lon + max_lon) / 2
+    result = []
+    for d_lat in (-1, 0, 1):
+        lat = center_lat + d_lat * lat_span
+        if lat <= -90.0 or lat >= 90.0:
+            continue
+        for d_lon in (-1, 0, 1):
+            if d_lat == 0 and d_lon == 0:
+                continue
+            lon = center_lon + d_lon * lon_span
+            if lon >= 180.0:
+                lon -= 360.0
+            elif lon < -180.0:
+                lon += 360.0
+            cell = encode(lat, lon, precision)
+            if cell not in result and cell != geohash:
+                result.append(cell)
+    return result
+
+def covering_cells(longitude, latitude, range):
+    ''' 给出覆盖以指定经纬度为中心、range 公里为半径范围的 geohash 方格列表（中心方格及其邻接方格）。
+
+    返回的列表已排序，可直接作为缓存 key 的一部分；返回空列表表示无法用方格做初步筛选。
+    '''
+    if longitude is None or latitude is None or not range or range < 0:
+        return []
+    precision = precision_for_range(range, latitude)
+    if precision == 0:
+        return []
+    center = encode(latitude, longitude, precision)
+    return sorted([center] + neighbors(center))
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+''' 服务进程内的缓存及接口性能指标，通过 /rpc/metrics 接口以 Prometheus 文本格式输出。
+
+* 缓存：按 key 的类别（例如 one_site 、 memoize_YYMServer.rpc.CityList._get 、 site_items）统计命中、未命中次数，
+  读写的数据字节数，以及各种操作的耗时分布（直方图）。数据由 caching.CountingCache 在访问缓存服务时记录；
+  字节数只在缓存后端自行序列化数据时（例如 RedisCache 的 dump_object / load_object）记录，不会为了统计而额外序列化。
+* 接口：按 endpoint 、请求方法统计耗时分布，以及按响应状态码统计请求次数。
+
+每次记录只是在进程内的字典中做几次加法（持有一次锁），开销很小，可以在生产环境中常开；也可以通过 METRICS 配置关闭。
+与 stats 模块一样，数据只在当前进程内累计，多进程部署时每个进程分别统计。
+'''
+
+import bisect
+import re
+import threading
+import time
+
+from flask import g, request
+
+from YYMServer import stats
+
+# 耗时直方图的分桶上限（秒）：
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+lock = threading.Lock()
+counters = {}       # (指标名称, 标签元组) -> 计数
+histograms = {}     # (指标名称, 标签元组) -> [各分桶计数列表, 总和, 总次数]
+enabled = True
+
+FAMILY_PATTERN = re.compile(r'^([a-z]+(?:_[a-z]+)*)_')
+
+
+def key_family(key):
+    ''' 给出缓存 key 的类别：去掉 key 末尾的 id 、 md5 等参数部分，例如 one_site_12 -> one_site ，tag_review:12 -> tag 。
+
+    caching.memoize 的 key 保留被缓存函数的名称，标签和锁的 key 分别归入 tag 和 lock ；
+    无法识别的 key （例如 Flask-Cache memoize 生成的 key）归入 other ，以免类别数量无限增长。
+    '''
+    if key.startswith('memoize_'):
+        return key.rsplit('_', 1)[0]
+    if key.startswith('tag_') or key.startswith('lock_'):
+        return key.split('_', 1)[0]
+    match = FAMILY_PATTERN.match(key)
+    return match.group(1) if match else 'other'
+
+def _observe(name, labels, value):
+    histogram = histograms.get((name, labels))
+    if histogram is None:
+        histogram = histograms[(name, labels)] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+    histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+    histogram[1] += value
+    histogram[2] += 1
+
+def _incr(name, labels, delta=1):
+    counters[(name, labels)] = counters.get((name, labels), 0) + delta
+
+def record_cache(operation, keys, seconds, hits=None, sizes=None):
+    ''' 记录一次缓存操作：keys 是本次操作涉及的 key 列表，hits 是读取操作对应各 key 的命中标记，sizes 是各 key 的数据字节数（未知时为 None）。
+
+    批量操作的耗时计入第一个 key 的类别（get_info_ids 等批量读取的 key 都属于同一类别， memoize 的 key 排在各标签之前）。
+    '''
+    if not enabled or not keys:
+        return
+    families = [key_family(key) for key in keys]
+    with lock:
+        _observe('yym_cache_operation_seconds', (('family', families[0]), ('operation', operation)), seconds)
+        if hits is not None:
+            for family, hit in zip(families, hits):
+                _incr('yym_cache_requests_total', (('family', family), ('result', 'hit' if hit else 'miss')))
+        if sizes is not None:
+            direction = 'read' if hits is not None else 'write'
+            for family, size in zip(families, sizes):
+                if size:
+                    _incr('yym_cache_bytes_total', (('direction', direction), ('family', family)), size)
+
+def record_request(endpoint, method, status, seconds):
+    ''' 记录一次接口请求的耗时及响应状态码。'''
+    if not enabled:
+        return
+    endpoint = endpoint or 'unknown'
+    with lock:
+        _observe('yym_http_request_seconds', (('endpoint', endpoint), ('method', method)), seconds)
+        _incr('yym_http_requests_total', (('endpoint', endpoint), ('method', method), ('status', str(status))))
+
+
+def init_metrics(app):
+    ''' 根据 METRICS 配置决定是否记录指标，并注册统计接口耗时的请求处理。'''
+    global enabled
+    enabled = app.config.get('METRICS', True)
+    if not enabled:
+        return
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start_time = time.time()
+
+    @app.after_request
+    def note_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    # 在 teardown_request 中记录：未被 Flask-RESTful 的 handle_error 转换为响应的异常会跳过 after_request ，此时按 500 计数。
+    @app.teardown_request
+    def record_timer(exc):
+        start_time = getattr(g, 'metrics_start_time', None)
+        if start_time is not None:
+            record_request(request.endpoint, request.method, getattr(g, 'metrics_status', 500), time.time() - start_time)
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels) + '}'
+
+def _format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+def render():
+    ''' 给出 Prometheus 文本格式（text/plain; version=0.0.4）的全部指标。'''
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, (list(buckets), total, count)) for key, (buckets, total, count) in histograms.items())
+    lines = []
+    described = set()
+    def describe(name, type, help):
+        if name not in described:
+            described.add(name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+    helps = {'yym_cache_requests_total': 'Cache lookups by key family and result.',
+             'yym_cache_bytes_total': 'Serialized bytes read from or written to the cache by key family.',
+             'yym_http_requests_total': 'Requests by endpoint, method and status code.',
+             'yym_cache_operation_seconds': 'Latency of cache operations by key family.',
+             'yym_http_request_seconds': 'Latency of requests by endpoint and method.',
+            }
+    for (name, labels), value in counter_items:
+        describe(name, 'counter', helps.get(name, name))
+        lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+    for (name, labels), (buckets, total, count) in histogram_items:
+        describe(name, 'histogram', helps.get(name, name))
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + ('+Inf', ), buckets):
+            cumulative += bucket
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', bound)]), cumulative))
+        lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(total)))
+        lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+    # stats 模块中的运行统计计数也一并输出：
+    describe('yym_events_total', 'counter', 'Process-local event counters from YYMServer.stats.')
+    for name, value in sorted(stats.get_counters().items()):
+        lines.append('yym_events_total%s %s' % (_format_labels([('name', name)]), _format_value(value)))
+    describe('yym_uptime_seconds', 'gauge', 'Seconds since this process started.')
+    lines.append('yym_uptime_seconds %s' % repr(time.time() - stats.start_time))
+    return '\n'.join(lines) + '\n'
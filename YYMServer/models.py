@@ -5,9 +5,11 @@ import shortuuid
 
 from sqlalchemy import event
 from sqlalchemy import DDL
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import attributes
 from werkzeug.security import generate_password_hash
 
-from YYMServer import db
+from YYMServer import db, geohash
 
 random.seed()
 
@@ -176,6 +178,16 @@ class Area(db.Model):   # 商区
         return u'<Area [%d] %s>' % (self.id, self.name)
 
 
+class AreaClosure(db.Model):    # 商区层级关系的闭包表，记录每个商区与其自身及所有层级子商区的对应关系，是一个缓存，由 util.rebuild_closure 维护
+    # 因为是可以随时重建的缓存，所以不设置外键，以免删除商区时受到约束
+    ancestor_id = db.Column(db.Integer, primary_key=True, autoincrement=False)      # 上级商区 id（包括自身）
+    descendant_id = db.Column(db.Integer, primary_key=True, autoincrement=False, index=True)    # 下级商区 id（包括自身）
+    depth = db.Column(db.SmallInteger, default=0)      # 两者相隔的层级数，自身为 0
+
+    def __unicode__(self):
+        return u'<AreaClosure %d -> %d>' % (self.ancestor_id, self.descendant_id)
+
+
 class Forecast(db.Model):   # 天气预报
     id = db.Column(db.Integer, primary_key=True)
     city_id = db.Column(db.Integer, db.ForeignKey('city.id'))
@@ -236,6 +248,7 @@ class Site(db.Model):   # 店铺或景点等 POI
     stars = db.Column(db.Float, default=0.0)         # POI 的评论星级，由于是统计结果，因而存在半颗星等小数。
     popular = db.Column(db.Integer, default=0)    # 统计店铺人气指数，用于搜索排序，每天更新！
     review_num = db.Column(db.SmallInteger, default=0)    # 该店铺拥有的晒单评论数量，是一个缓存值
+    stars_total = db.Column(db.Float, default=0.0)    # 该店铺全部有效且已发布的晒单评论的星级之和，是一个缓存值，与 review_num 一起在晒单评论修改时增量维护，stars 即两者之比
     categories = db.relationship('Category', lazy='dynamic', secondary=categories,
                                  backref=db.backref('sites', lazy='dynamic'))
     environment = db.Column(db.Unicode(50), default=u'')      # 环境特点的文字描述
@@ -251,7 +264,7 @@ class Site(db.Model):   # 店铺或景点等 POI
     description = db.Column(db.UnicodeText)     # POI 的简介描述
     longitude = db.Column(Real, default=0.0)     # 经度
     latitude = db.Column(Real, default=0.0)      # 纬度
-    # ToDo: 缺经纬度对应的方格坐标的缓存字段！
+    geohash = db.Column(db.String(12), default='', index=True)     # 经纬度对应的 geohash 方格编码，是一个缓存值，在保存 POI 时自动计算
     area_id = db.Column(db.Integer, db.ForeignKey('area.id'))   # 所属商区
     area = db.relationship('Area', backref=db.backref('sites', lazy='dynamic'))
     mark = db.Column(db.UnicodeText)        # 周围地标，支持换行
@@ -273,6 +286,15 @@ event.listen(
     DDL("ALTER TABLE %(table)s AUTO_INCREMENT = 3421;").execute_if(dialect=('postgresql', 'mysql'))
 )
 
+@event.listens_for(Site, 'before_insert')
+@event.listens_for(Site, 'before_update')
+def update_geohash(mapper, connection, target):
+    ''' 根据经纬度重新计算 POI 的 geohash 方格编码。经纬度未填写时保留为空字符串，不参与“附近”搜索的方格筛选。'''
+    if target.longitude and target.latitude:
+        target.geohash = geohash.encode(target.latitude, target.longitude)
+    else:
+        target.geohash = ''
+
 
 class Category(db.Model):       # POI 分类
     id = db.Column(db.Integer, primary_key=True)
@@ -286,6 +308,16 @@ class Category(db.Model):       # POI 分类
         return u'<Category [%d] %s>' % (self.id, self.name)
 
 
+class CategoryClosure(db.Model):    # POI 分类层级关系的闭包表，记录每个分类与其自身及所有层级子分类的对应关系，是一个缓存，由 util.rebuild_closure 维护
+    # 因为是可以随时重建的缓存，所以不设置外键，以免删除分类时受到约束
+    ancestor_id = db.Column(db.Integer, primary_key=True, autoincrement=False)      # 上级分类 id（包括自身）
+    descendant_id = db.Column(db.Integer, primary_key=True, autoincrement=False, index=True)    # 下级分类 id（包括自身）
+    depth = db.Column(db.SmallInteger, default=0)      # 两者相隔的层级数，自身为 0
+
+    def __unicode__(self):
+        return u'<CategoryClosure %d -> %d>' % (self.ancestor_id, self.descendant_id)
+
+
 fans = db.Table('fans',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
     db.Column('fan_id', db.Integer, db.ForeignKey('user.id')),
@@ -351,7 +383,7 @@ class Token(db.Model):
     create_time = db.Column(db.DateTime, default=datetime.datetime.now)       # 首次创建时间，以服务器时间为准
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))     # 用户 id
     user = db.relationship('User', backref=db.backref('tokens', lazy='dynamic'), foreign_keys=[user_id])
-    token = db.Column(db.String(50), default=shortuuid.uuid)         # 用户登陆后的临时唯一标识
+    token = db.Column(db.String(50), default=shortuuid.uuid, index=True)         # 用户登陆后的临时唯一标识
     device = db.Column(db.String(50))    # 设备 id
 
 
@@ -507,6 +539,69 @@ event.listen(
     DDL("ALTER TABLE %(table)s AUTO_INCREMENT = 2991;").execute_if(dialect=('postgresql', 'mysql'))
 )
 
+# 晒单评论对 POI 星级、评论数及作者评论数的贡献，只有有效且已发布的晒单评论才计入：
+REVIEW_COUNTED_FIELDS = ('valid', 'published', 'stars', 'site_id', 'user_id')
+
+def _review_contribution(valid, published, stars, site_id, user_id):
+    return None if not (valid and published) else (site_id, user_id, stars or 0.0)
+
+def _get_old_review_contribution(connection, target):
+    ''' 给出晒单评论本次修改之前的贡献。修改前的取值没有加载到 session 中时（例如对象已过期），从数据库读取。'''
+    values = []
+    for name in REVIEW_COUNTED_FIELDS:
+        added, unchanged, deleted = attributes.get_history(target, name)
+        if not (deleted or unchanged):
+            break
+        values.append((deleted or unchanged)[0])
+    else:
+        return _review_contribution(*values)
+    table = Review.__table__
+    row = connection.execute(select([table.c[name] for name in REVIEW_COUNTED_FIELDS]).where(table.c.id == target.id)).first()
+    return None if row is None else _review_contribution(*row)
+
+def _update_review_counts(connection, old, new):
+    ''' 按晒单评论修改前后的贡献，增量修改 POI 的 review_num 、 stars_total 、 stars 及作者的 review_num ，不需要读取该 POI 的其他晒单评论。'''
+    if old == new:
+        return
+    site_deltas = {}
+    user_deltas = {}
+    for contribution, sign in ((old, -1), (new, 1)):
+        if contribution is None:
+            continue
+        site_id, user_id, stars = contribution
+        if site_id:
+            num, total = site_deltas.get(site_id, (0, 0.0))
+            site_deltas[site_id] = (num + sign, total + sign * stars)
+        if user_id:
+            user_deltas[user_id] = user_deltas.get(user_id, 0) + sign
+    site = Site.__table__
+    for site_id, (num, total) in site_deltas.items():
+        if num or total:
+            connection.execute(site.update().where(site.c.id == site_id).values(review_num = func.coalesce(site.c.review_num, 0) + num,
+                                                                                 stars_total = func.coalesce(site.c.stars_total, 0.0) + total))
+            # 没有评论时保留原有星级（可能是运营人员设置的初始值）：
+            connection.execute(site.update().where(site.c.id == site_id).values(stars = case([(site.c.review_num > 0, site.c.stars_total / site.c.review_num)], else_ = site.c.stars)))
+    user = User.__table__
+    for user_id, num in user_deltas.items():
+        if num:
+            connection.execute(user.update().where(user.c.id == user_id).values(review_num = func.coalesce(user.c.review_num, 0) + num))
+
+@event.listens_for(Review, 'after_insert')
+def count_inserted_review(mapper, connection, target):
+    _update_review_counts(connection, None, _review_contribution(*[getattr(target, name) for name in REVIEW_COUNTED_FIELDS]))
+
+@event.listens_for(Review, 'before_update')
+def count_updated_review(mapper, connection, target):
+    ''' 发布、取消发布、修改星级、修改所属 POI 或作者、删除（valid 改为 False）等修改，都只增量修改相关计数。'''
+    if not any(attributes.get_history(target, name).has_changes() for name in REVIEW_COUNTED_FIELDS):
+        return
+    new = _review_contribution(*[getattr(target, name) for name in REVIEW_COUNTED_FIELDS])
+    _update_review_counts(connection, _get_old_review_contribution(connection, target), new)
+
+@event.listens_for(Review, 'before_delete')
+def count_deleted_review(mapper, connection, target):
+    _update_review_counts(connection, _get_old_review_contribution(connection, target), None)
+
 
 class Comment(db.Model):        # 用户子评论
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+''' 人气指数计算：根据收藏、喜欢、分享、子评论、晒单评论等行为，计算 POI 和晒单评论按时间衰减的人气指数，由 task.score_popularity 每天执行。
+
+每次行为按其种类计分（见 POPULARITY_SITE_WEIGHTS 、 POPULARITY_REVIEW_WEIGHTS 配置），分值按发生时间衰减，每经过 POPULARITY_HALF_LIFE 天减半，
+超过 POPULARITY_WINDOW 天的行为不再计入。
+
+行为表的数据量可能达到千万行，因此不逐行读取：每种行为先在数据库中按 (目标 id, 发生日期) 分组计数，
+同一天的行为衰减系数相同，再用 NumPy 对分组结果做向量化的衰减加权和按目标 id 的汇总。
+'''
+
+import datetime
+
+import numpy
+from sqlalchemy import func
+
+from YYMServer import app, db, cache
+from YYMServer.models import *
+
+VERSION_KEY = 'site_popular_version'    # POI 人气指数的版本号，每次批量修改 Site.popular 后加一
+
+
+def _daily_counts(cutoff, target, time, *criteria):
+    ''' 给出 cutoff 之后的行为按 (目标 id, 发生日期) 分组计数的查询，target 、 time 分别是目标 id 和发生时间的字段。'''
+    day = func.date(time)
+    query = db.session.query(target, day, func.count('*')).filter(target != None).filter(time >= cutoff)
+    for criterion in criteria:
+        query = query.filter(criterion)
+    return query.group_by(target, day)
+
+def _site_sources(cutoff):
+    ''' 计入 POI 人气的行为：收藏、分享、晒单评论，以及该 POI 的晒单评论收到的喜欢和子评论。'''
+    published = (Review.valid == True, Review.published == True)
+    return [('favorite', _daily_counts(cutoff, favorites.c.site_id, favorites.c.action_time)),
+            ('share', _daily_counts(cutoff, ShareRecord.site_id, ShareRecord.action_time)),
+            ('review', _daily_counts(cutoff, Review.site_id, Review.publish_time, *published)),
+            ('like', _daily_counts(cutoff, Review.site_id, likes.c.action_time, likes.c.review_id == Review.id, *published)),
+            ('comment', _daily_counts(cutoff, Review.site_id, Comment.publish_time, Comment.review_id == Review.id, Comment.valid == True, *published)),
+           ]
+
+def _review_sources(cutoff):
+    ''' 计入晒单评论人气的行为：喜欢、子评论、分享。'''
+    return [('like', _daily_counts(cutoff, likes.c.review_id, likes.c.action_time)),
+            ('comment', _daily_counts(cutoff, Comment.review_id, Comment.publish_time, Comment.valid == True)),
+            ('share', _daily_counts(cutoff, ShareRecord.review_id, ShareRecord.action_time)),
+           ]
+
+def _to_date(value):
+    ''' func.date 的结果在 MySQL 中是 date 对象，在 SQLite 中是 'YYYY-MM-DD' 格式的字符串。'''
+    if isinstance(value, basestring):
+        return datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+def _score(get_sources, weights, now=None):
+    ''' 汇总 get_sources(起始时间) 给出的各种行为的衰减分值，给出 (目标 id 数组, 人气指数数组) ，id 升序排列，没有行为的目标不出现。'''
+    today = (now or datetime.datetime.now()).date()
+    window = app.config['POPULARITY_WINDOW']
+    half_life = float(app.config['POPULARITY_HALF_LIFE'])
+    cutoff = datetime.datetime.combine(today - datetime.timedelta(days = window), datetime.time())
+    decay = 0.5 ** (numpy.arange(window + 1) / half_life)    # 按行为发生距今的天数查表
+    id_parts = []
+    score_parts = []
+    for name, query in get_sources(cutoff):
+        weight = weights.get(name, 0)
+        if not weight:
+            continue
+        rows = query.all()
+        if not rows:
+            continue
+        ids, days, nums = zip(*rows)
+        ages = {}       # 不同的日期最多只有 window 个，逐个换算
+        for value in set(days):
+            ages[value] = min(max((today - _to_date(value)).days, 0), window)
+        age_array = numpy.fromiter((ages[value] for value in days), dtype=numpy.int64, count=len(days))
+        id_parts.append(numpy.array(ids, dtype=numpy.int64))
+        score_parts.append(weight * numpy.array(nums, dtype=numpy.float64) * decay[age_array])
+    if not id_parts:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.float64)
+    unique_ids, inverse = numpy.unique(numpy.concatenate(id_parts), return_inverse=True)
+    return unique_ids, numpy.bincount(inverse, weights=numpy.concatenate(score_parts))
+
+def score_sites(now=None):
+    ''' 计算 POI 的人气指数（取整后即 Site.popular），给出 (POI id 数组, 人气指数数组) 。'''
+    return _score(_site_sources, app.config['POPULARITY_SITE_WEIGHTS'], now)
+
+def score_reviews(now=None):
+    ''' 计算晒单评论的人气指数，给出 (晒单评论 id 数组, 人气指数数组) ，用于自动设置精选。'''
+    return _score(_review_sources, app.config['POPULARITY_REVIEW_WEIGHTS'], now)
+
+def lookup(ids, scored_ids, scores):
+    ''' 从 _score 的结果中查出 ids 数组中各个 id 的人气指数，没有行为的为 0 。'''
+    if not len(scored_ids):
+        return numpy.zeros(len(ids), dtype=numpy.float64)
+    positions = numpy.minimum(numpy.searchsorted(scored_ids, ids), len(scored_ids) - 1)
+    return numpy.where(scored_ids[positions] == ids, scores[positions], 0.0)
+
+def get_version():
+    ''' 给出 POI 人气指数的版本号，供按人气排序的缓存（例如 rpc 模块中 SiteList._get_site_items 的候选集合）放入 key 中。'''
+    return cache.get(VERSION_KEY) or 0
+
+def bump_version():
+    ''' 批量修改 Site.popular 之后调用，使按人气排序的缓存全部失效。'''
+    cache.cache.inc(VERSION_KEY)
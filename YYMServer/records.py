@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+''' 缓存中使用的紧凑数据格式：对经过 util.format_xxx 处理的 model 实例，只保留接口输出（marshal）、分享页模板及后续处理需要的属性。
+
+编码结果是 (SCHEMA_TAG, 表名, 格式版本, 属性值元组) 格式的元组，只包含 int 、unicode 、datetime 等基本类型，
+比 pickle 整个 SQLAlchemy 实例（连同 _sa_instance_state 及关联的 Image 等实例）小得多，序列化也快得多。
+解码得到 Record 对象，属性名与 format_xxx 处理后的 model 实例一致，因而对 marshal 及模板是透明的。
+
+增删 schema 中的属性时，需要同时增加该 schema 的 version ，旧格式的缓存数据会被当作未命中而重新查库。
+没有定义 schema 的 model （例如 Announce 、ShareRecord）仍然直接缓存 model 实例。
+'''
+
+import operator
+
+SCHEMA_TAG = 'yym-record'
+TOMBSTONE = ('yym-tombstone', )     # 数据库中不存在的数据，由 util.get_info_ids 短时间缓存，避免反复查库
+
+
+class Record(object):
+    ''' 从缓存数据解码得到的对象。与 model 实例一样，可以继续补充属性（例如 review.valid_user）。'''
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return '<Record %r>' % self.__dict__
+
+
+def encode_image(image):
+    ''' 图片只保留 image_fields_mini 需要的 id 和 path 。'''
+    return None if image is None else (image.id, image.path)
+
+def decode_image(data):
+    return None if data is None else Record(id=data[0], path=data[1])
+
+def encode_images(images):
+    return tuple(encode_image(image) for image in images or ())
+
+def decode_images(data):
+    return [decode_image(image) for image in data]
+
+def encode_content(content):
+    ''' 富媒体正文（util.parse_textstyle 的输出）中的图片、 POI 也转为紧凑格式。'''
+    result = []
+    for entry in content or ():
+        entry = dict(entry)
+        if entry['class'] == 'image':
+            entry['content'] = encode_image(entry['content'])
+        elif entry['class'] == 'site':
+            entry['content'] = None if entry['content'] is None else SCHEMAS['site'].encode(entry['content'])
+        result.append(entry)
+    return tuple(result)
+
+def decode_content(data):
+    result = []
+    for entry in data:
+        entry = dict(entry)
+        if entry['class'] == 'image':
+            entry['content'] = decode_image(entry['content'])
+        elif entry['class'] == 'site':
+            entry['content'] = None if entry['content'] is None else SCHEMAS['site'].decode(entry['content'])
+        result.append(entry)
+    return result
+
+
+class Schema(object):
+    ''' 一种 model 的缓存格式：attributes 是原样保存的属性，converters 是需要转换的属性（属性名 -> (编码函数, 解码函数)），
+    aliases 是解码后补充的属性别名（别名 -> 属性名，例如模板中使用的 site.logo）。
+    '''
+
+    def __init__(self, tablename, version, attributes, converters={}, aliases={}):
+        self.tablename = tablename
+        self.version = version
+        self.attributes = tuple(attributes)
+        self.converters = tuple(converters.items())
+        self.aliases = aliases
+        self.names = self.attributes + tuple(name for name, functions in self.converters)
+        self.getter = operator.attrgetter(*self.attributes)
+
+    def encode(self, model):
+        values = self.getter(model)
+        if len(self.attributes) == 1:
+            values = (values, )
+        values += tuple(encode(getattr(model, name, None)) for name, (encode, decode) in self.converters)
+        return (SCHEMA_TAG, self.tablename, self.version, values)
+
+    def decode(self, data):
+        ''' 数据格式不符（例如旧版本的缓存数据）时返回 None 。'''
+        if not isinstance(data, tuple) or len(data) != 4 or data[0] != SCHEMA_TAG or data[1] != self.tablename or data[2] != self.version:
+            return None
+        values = data[3]
+        count = len(self.attributes)
+        attributes = dict(zip(self.attributes, values[:count]))
+        for (name, (encode, decode)), value in zip(self.converters, values[count:]):
+            attributes[name] = decode(value)
+        for alias, name in self.aliases.items():
+            attributes[alias] = attributes[name]
+        return Record(**attributes)
+
+
+SCHEMAS = dict((schema.tablename, schema) for schema in (
+    Schema('site', 1,
+           ('id', 'valid', 'area_id', 'name', 'name_orig', 'city_name', 'level', 'stars', 'popular', 'review_num', 'images_num',
+            'longitude', 'latitude', 'address', 'address_orig', 'formated_keywords', 'environment', 'formated_payment_types', 'menu',
+            'formated_ticket', 'tour', 'booking', 'formated_business_hours', 'phone', 'transport', 'description', 'valid_categories'),
+           {'logo_image': (encode_image, decode_image),
+            'valid_top_images': (encode_images, decode_images),
+            'valid_gate_images': (encode_images, decode_images),
+           },
+           {'logo': 'logo_image'}),
+    Schema('user', 1,
+           ('id', 'valid', 'anonymous', 'create_time', 'update_time', 'name', 'username', 'mobile', 'em_username', 'em_password',
+            'icon_id', 'gender', 'level', 'exp', 'follow_num', 'fans_num', 'like_num', 'share_num', 'review_num', 'favorite_num',
+            'formated_badges'),
+           {'icon_image': (encode_image, decode_image)}),
+    Schema('review', 1,
+           ('id', 'valid', 'selected', 'published', 'publish_time', 'update_time', 'user_id', 'site_id', 'at_list', 'stars', 'content',
+            'formated_keywords', 'total', 'currency', 'like_num', 'comment_num', 'images_num'),
+           {'valid_images': (encode_images, decode_images)}),
+    Schema('article', 1,
+           ('id', 'valid', 'order', 'create_time', 'update_time', 'user_id', 'title', 'formated_keywords', 'comment_num'),
+           {'caption_image': (encode_image, decode_image),
+            'formated_content': (encode_content, decode_content),
+           },
+           {'caption': 'caption_image'}),
+    Schema('comment', 1,
+           ('id', 'valid', 'publish_time', 'update_time', 'review_id', 'article_id', 'user_id', 'at_list', 'content'), ),
+    ))
+
+
+def encode(tablename, model):
+    ''' 把（经过格式化的）model 实例转为缓存格式；没有定义 schema 的直接返回 model 实例本身。'''
+    schema = SCHEMAS.get(tablename)
+    return model if schema is None else schema.encode(model)
+
+def decode(tablename, data):
+    ''' 把缓存数据转为用于输出的对象；数据格式不符时返回 None 。'''
+    if data is None:
+        return None
+    schema = SCHEMAS.get(tablename)
+    if schema is None:
+        return None if isinstance(data, tuple) else data
+    return schema.decode(data)
+
@@ -1,23 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import json
 import time, datetime
 
+import numpy
 import pytz
 from sqlalchemy import func, desc, or_, and_
 from sqlalchemy.orm import aliased
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from flask import jsonify, request, url_for
+from flask import jsonify, request, url_for, g, Response
 from flask.ext.restful import reqparse, Resource, fields, marshal_with, marshal, abort
 from flask.ext.restful import output_json as restful_output_json
 from flask.ext.hmacauth import hmac_auth
 
 from qiniu.auth import digest
 
-from YYMServer import app, db, cache, api, util, message, baseurl_share, tz_server
+from YYMServer import app, db, cache, api, util, message, stats, metrics, caching, fragments, popularity, baseurl_share, tz_server
 from YYMServer.models import *
 from YYMServer.keywords import KEYWORDS_TRANS
+from YYMServer.geohash import covering_cells
+from YYMServer.sitetable import get_site_table
+from YYMServer.search import get_search_index
 
 from flask.ext.restful.representations.json import output_json
 output_json.func_globals['settings'] = {'ensure_ascii': False, 'encoding': 'utf8'}
@@ -33,8 +38,20 @@ def output_json(data, code, headers=None):
         if data.has_key('status'):
             code = data.pop('status')
     data = {'status': code, 'message': message, 'data':data}
+    cursor = getattr(g, 'cursor', None)
+    if cursor:      # 支持 cursor 翻页的接口，输出读取下一页用的 cursor
+        data['cursor'] = cursor
     return restful_output_json(data, code, headers)
 
+def output_fragments(items, code=200):
+    ''' 用已经序列化的 JSON 片段（fragments 模块）拼接出与 output_json 格式相同的响应，items 是 data 数组中各个元素的 JSON 文本。'''
+    data = {'status': code, 'message': 'OK'}
+    cursor = getattr(g, 'cursor', None)
+    if cursor:
+        data['cursor'] = cursor
+    body = fragments.extend(fragments.dumps(data), [('data', '[' + ', '.join(items) + ']')])
+    return Response(body, status=code, mimetype='application/json')
+
 
 # 基础接口：
 class Version(Resource):
@@ -61,6 +78,24 @@ class CacheTime(Resource):
 api.add_resource(CacheTime, '/rpc/cache_time')
 
 
+class Stats(Resource):
+    '''当前服务进程的运行统计（缓存命中率等）查询。'''
+    @hmac_auth('api')
+    def get(self):
+        return stats.get_report()
+
+api.add_resource(Stats, '/rpc/stats')
+
+
+class Metrics(Resource):
+    '''当前服务进程的缓存及接口性能指标，以 Prometheus 文本格式输出。'''
+    @hmac_auth('api')
+    def get(self):
+        return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+api.add_resource(Metrics, '/rpc/metrics')
+
+
 # 常用公共辅助：
 id_parser = reqparse.RequestParser()
 id_parser.add_argument('id', type=long, default=0l)
@@ -303,6 +338,8 @@ user_fields = {
     'em_password': fields.String,   # 用户对应的环信账号密码
 }
 user_fields.update(user_fields_brief)
+# JSON 片段缓存（fragments 模块）中的用户格式，与当前用户相关的 followed 字段在拼接时补充：
+fragments.register('user', 'mini', dict((name, field) for name, field in user_fields_mini.items() if name != 'followed'))
 
 def _prepare_msg_account(user):
     ''' 辅助函数：检查 user 拥有的环信账号，如果没有则创建一个。'''
@@ -324,21 +361,12 @@ class UserList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    def _delete_follow_cache(self, follow, fan):
-        ''' 辅助函数：清除指定 follow 和 fan 的缓存数据。'''
-        follow_id = 0l if not follow else follow.id
-        fan_id = 0l if not fan else fan.id
-        if follow_id:
-            cache.delete_memoized(self._get, self, 0l, follow_id, 0l)
-        if fan_id:
-            cache.delete_memoized(self._get, self, 0l, 0l, fan_id)
-
     def _check_password(self, password):
         ''' 辅助函数：用于检查用户提交的新密码的合规性。'''
         if len(password) < 6:
             abort(409, message='The password length should be at least 6 characters!')
     
-    @cache.memoize()
+    @caching.memoize(tags=lambda self, id=0l, em='', follow=0l, fan=0l: (['follow:%d' % follow] if follow else []) + (['fan:%d' % fan] if fan else []))
     def _get(self, id=0l, em='', follow=0l, fan=0l):
         # 当指定用户 id 进行查询时，即使该用户 valid 为 False，也仍然给出详细信息。
         result = []
@@ -488,7 +516,8 @@ def _generate_token(new_user, device, old_token=None):
     '''辅助函数：根据新登陆的 user 实例创建对应 token。如果提供了旧 token ，相应做旧 token 的历史行为记录迁移。'''
     old_user = None
     if old_token:
-        old_user = db.session.query(User).join(User.tokens).filter(Token.token == old_token).first()
+        old_user_id = util.get_token_user_id(old_token)
+        old_user = None if not old_user_id else db.session.query(User).filter(User.id == old_user_id).first()
         if old_user:
             # 建立后台任务，合并旧 token 的行为数据到当前登陆的新账号：
             if new_user.anonymous == False and old_user.anonymous == True and new_user.id != old_user.id:
@@ -500,7 +529,7 @@ def _generate_token(new_user, device, old_token=None):
                            )
                 db.session.add(task)
                 db.session.commit()
-    # 永远生成新 token，而不复用之前产生的 token。
+    # 永远生成新 token，而不复用之前产生的 token。同一设备上被新 token 取代的旧 token 由 task.prune_tokens 定期清理。
     token = Token(user_id = new_user.id,
                   device = device,
                   )
@@ -564,7 +593,7 @@ class CategoryList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    @cache.memoize()
+    @caching.memoize()
     def _get(self, id=0l):
         query = db.session.query(Category).filter(Category.valid == True).filter(Category.parent_id == None).order_by(Category.order.desc())
         if id:
@@ -639,7 +668,7 @@ class CityList(Resource):
             self._get_children_areas(child)
         parent.valid_areas = children
 
-    @cache.memoize()
+    @caching.memoize(refresh_ahead=app.config['CACHE_REFRESH_AHEAD'])
     def _get(self, id=0l):
         query = db.session.query(City).filter(City.valid == True).order_by(City.order.desc())
         if id:
@@ -712,7 +741,7 @@ class CountryList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    @cache.memoize()
+    @caching.memoize(refresh_ahead=app.config['CACHE_REFRESH_AHEAD'])
     def _get(self, id=0l):
         query = db.session.query(Country).filter(Country.valid == True).order_by(Country.order.desc())
         if id:
@@ -783,6 +812,8 @@ site_parser.add_argument('order', type=int, default=0)     # 0 表示默认的
 site_parser.add_argument('longitude', type=float)       # 用户当前位置的经度
 site_parser.add_argument('latitude', type=float)        # 用户当前位置的维度
 site_parser.add_argument('token', type=str)     # 用户 token，用于获取是否收藏的关系
+site_parser.add_argument('cursor', type=str)    # 上一页返回的翻页 cursor ，提供时从上一页的最后一个 POI 之后继续读取，并忽略 offset 。
+site_parser.add_argument('facets', type=int, default=0)     # 大于 0 表示不输出 POI 列表，而是输出当前搜索条件下各子分类、各商区的 POI 数量。
 
 site_fields_mini = {
     'id': fields.Integer,
@@ -821,16 +852,41 @@ site_fields = {
     'favorited': fields.Boolean,         # 当前 token 参数表示的用户是否收藏了此 POI
 }
 site_fields.update(site_fields_brief)
+# JSON 片段缓存（fragments 模块）中的 POI 格式，与当前用户相关的 favorited 字段在拼接时补充：
+fragments.register('site', 'mini', site_fields_mini)
+fragments.register('site', 'brief', site_fields_brief)
+fragments.register('site', 'full', dict((name, field) for name, field in site_fields.items() if name != 'favorited'))
+
+facet_fields = {
+    'id': fields.Integer,
+    'name': fields.String,
+    'count': fields.Integer,    # 当前搜索条件下，属于该分类（或商区，均包括其所有层级的子节点）的 POI 数量
+}
+
+site_facets_fields = {
+    'total': fields.Integer,    # 当前搜索条件下的 POI 总数
+    'categories': fields.List(fields.Nested(facet_fields)),    # 当前分类的各个子分类（未指定分类时为各个顶级分类）
+    'areas': fields.List(fields.Nested(facet_fields)),         # 当前商区的各个子商区（未指定商区时为城市的各个顶级商区；城市也未指定时只列出有 POI 的顶级商区）
+}
 
-@cache.memoize()
 def _get_category_subtree_ids(category_id):
     ''' 辅助函数：对指定 category_id ，获取其自身及其所有层级子节点的 id。'''
-    return util.get_self_and_children(Category, category_id)
+    return util.get_subtree_ids(CategoryClosure, category_id)
 
-@cache.memoize()
 def _get_area_subtree_ids(area_id):
     ''' 辅助函数：对指定 area_id ，获取其自身及其所有层级子节点的 id。'''
-    return util.get_self_and_children(Area, area_id)
+    return util.get_subtree_ids(AreaClosure, area_id)
+
+
+def _get_keyword_list(keywords):
+    ''' 辅助函数：把搜索关键词字符串拆分为关键词列表，并补充 KEYWORDS_TRANS 中定义的替换目标词。'''
+    keywords = keywords.translate({ord('+'):' '})
+    keyword_list = keywords.split()
+    for i in xrange(len(keyword_list)):
+        target = KEYWORDS_TRANS.get(keyword_list[i], None)
+        if target != None:
+            keyword_list.append(target)
+    return keyword_list
 
 
 # ToDo: 欠一个搜索关键字推荐接口！
@@ -842,11 +898,15 @@ class SiteList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    @cache.memoize()
     def _get(self, brief=0, id=0l, keywords=u'', area=0l, city=0l, range=0, category=0l, order=0, geohash=None):
-        ''' 本函数实际上只是根据搜索条件，给出搜索结果对应的 POI id 序列。详细属性需要通过 util.get_info_sites 函数读取，以减小缓存提及。'''
-        # ToDo: 需要利用 geohash，实现高效率的距离初步筛选！
+        ''' 本函数实际上只是根据搜索条件，给出搜索结果对应的 POI id 序列。详细属性需要通过 util.get_info_sites 函数读取，以减小缓存提及。
+
+        geohash 参数是 geohash 方格编码的列表（通常由 _get_range 函数根据搜索范围计算得出），提供时只返回落在这些方格内的 POI 。
+        本函数不再直接缓存，由 _get_site_items 按照与用户具体位置无关的搜索条件缓存查询结果。
+        '''
         query = db.session.query(Site.id, Site.longitude, Site.latitude).filter(Site.valid == True)
+        if geohash:
+            query = query.filter(or_(*[Site.geohash.like(cell + '%') for cell in geohash]))
         if order is not None:
             if order == 1:      # 距离最近：
                 pass    # 在 _get_sorted 函数中实现。
@@ -859,23 +919,25 @@ class SiteList(Resource):
         if id:
             query = query.filter(Site.id == id)
         if area:
-            area_ids = _get_area_subtree_ids(area)
-            query = query.filter(Site.area_id.in_(area_ids))
+            # 通过商区闭包表，一次 join 即可筛选出属于该商区及其所有子商区的 POI ：
+            query = query.join(AreaClosure, AreaClosure.descendant_id == Site.area_id).filter(AreaClosure.ancestor_id == area)
         if city:
             query = query.join(Site.area).filter(Area.city_id == city)
             # ToDo: 除了直接使用 city id 判断外，还应该把城市中心点距离一定范围内（即使是属于其他城市的）的 POI 纳入搜索结果！
         if category:
-            category_ids = _get_category_subtree_ids(category)
-            query = query.join(Site.categories).filter(Category.id.in_(category_ids))
+            # 通过分类闭包表筛选属于该分类及其所有子分类的 POI ，使用子查询以免一个 POI 属于多个子分类时重复出现：
+            category_site_ids = db.session.query(categories.c.site_id).join(CategoryClosure, CategoryClosure.descendant_id == categories.c.category_id).filter(CategoryClosure.ancestor_id == category)
+            query = query.filter(Site.id.in_(category_site_ids))
         if keywords:
-            # 搜索关键词目前支持在 POI 名称、地址的中文、原文中进行模糊搜索。
-            # ToDo: 搜索关键词还应考虑支持 description 和 keywords 两项！
-            keywords = keywords.translate({ord('+'):' '})
-            keyword_list = keywords.split()
-            for i in xrange(len(keyword_list)):
-                target = KEYWORDS_TRANS.get(keyword_list[i], None)
-                if target != None:
-                    keyword_list.append(target)
+            keyword_list = _get_keyword_list(keywords)
+            if app.config['SEARCH_INDEX']:
+                # 使用倒排索引，在 POI 名称、地址的中文、原文，以及简介、关键词中搜索：
+                site_ids = get_search_index().search(keyword_list)
+                if not site_ids:
+                    return []
+                query = query.filter(Site.id.in_(list(site_ids)))
+                keyword_list = []
+            # 未启用倒排索引时，搜索关键词只支持在 POI 名称、地址的中文、原文中进行模糊搜索：
             for keyword in keyword_list:
                 query = query.filter(Site.name.ilike(u'%{}%'.format(keyword)) | 
                                      Site.name_orig.ilike(u'%{}%'.format(keyword)) |
@@ -885,15 +947,52 @@ class SiteList(Resource):
         result = query.all()
         return result
 
-    @cache.memoize()
-    def _get_sorted(self, brief=0, id=0l, keywords=u'', area=0l, city=0l, range=0, category=0l, order=0, longitude = None, latitude = None):
-        ''' 本函数基于 _get 函数封装数据库查询给出的基础结果，进一步用 Python 处理复杂的排序条件等，并利用缓存支撑用户端分批读取。'''
+    def _get_range(self, area=0l, range=0, longitude=None, latitude=None):
+        ''' 私有辅助函数，给出实际使用的搜索范围，以及用于距离初步筛选的 geohash 方格列表。'''
         if not area and (range == None or range == 0):
             range = 5   # ToDo: 如果商圈和 range 都没有设置，表示智能范围（注意：range 为 -1 时表示全城搜索）。这里暂时只是把搜索范围置成5公里了。
-        # ToDo: 应当利用 geohash，实现高效率的距离初步筛选！
+        # 利用 geohash 方格做距离的初步筛选，只对落在覆盖方格内的 POI 计算精确距离：
         geohash = None
+        if range and range > 0 and longitude and latitude:
+            geohash = covering_cells(longitude, latitude, range) or None
+        return (range, geohash)
+
+    def _get_cache_params(self, id=0l, keywords=u'', area=0l, city=0l, category=0l, geohash=None):
+        ''' 私有辅助函数，给出搜索结果缓存（候选集合、筛选项统计）的 key 所使用的参数：筛选条件、 geohash 方格，以及相关数据的版本号。'''
+        keyword_list = [] if not keywords else sorted(set(keyword.lower() for keyword in _get_keyword_list(keywords)))
+        params = (id, keyword_list, area, city, category, tuple(geohash or ()), util.get_changes('site', None)[0])
+        if keyword_list and app.config['SEARCH_INDEX']:
+            params += (get_search_index().get_version(), )
+        return params
+
+    def _get_site_items(self, id=0l, keywords=u'', area=0l, city=0l, category=0l, order=None, geohash=None):
+        ''' 给出 _get 函数的查询结果（候选 POI 集合），并缓存。
+
+        缓存 key 只包含筛选条件和 geohash 方格（按搜索范围确定的粗粒度位置），不包含用户的具体经纬度，
+        因此附近的用户可以共用同一份候选集合，再各自计算距离、排序。
+        key 中还包含 'site' 变更的版本号：POI 被新建、修改、移动位置或删除时（由 cachesync 模块登记变更），全部候选集合随之失效；
+        使用倒排索引搜索关键词时，还包含索引的版本（索引文件重建或增量更新之后，搜索结果随之失效）。
+        '''
+        if order == 1:
+            order = None    # _get 函数在数据库查询中不处理距离排序
+        params = self._get_cache_params(id, keywords, area, city, category, geohash) + (order, )
+        if order == 2:      # 人气排序的结果在 task.score_popularity 批量修改人气指数后失效
+            params += (popularity.get_version(), )
+        key = 'site_items_' + hashlib.md5(repr(params)).hexdigest()
+        site_items = cache.get(key)
+        if site_items is None:
+            stats.incr('site_candidates_miss')
+            site_items = [tuple(site_item) for site_item in self._get(0, id, keywords, area, city, 0, category, order, geohash)]
+            cache.set(key, site_items)
+        else:
+            stats.incr('site_candidates_hit')
+        return site_items
+
+    def _get_sorted(self, brief=0, id=0l, keywords=u'', area=0l, city=0l, range=0, category=0l, order=0, longitude = None, latitude = None):
+        ''' 本函数基于 _get 函数封装数据库查询给出的基础结果，进一步用 Python 处理复杂的排序条件等。'''
+        range, geohash = self._get_range(area, range, longitude, latitude)
         result = []
-        site_items = self._get(brief, id, keywords, area, city, range, category, order, geohash)
+        site_items = self._get_site_items(id, keywords, area, city, category, order, geohash)
         for site_item in site_items:
             id, lon, lat = site_item
             distance = 0.0 if not longitude or not latitude else util.get_distance(longitude, latitude, lon, lat)
@@ -907,6 +1006,114 @@ class SiteList(Resource):
         result = map(lambda x: x['id'], result)
         return result
 
+    def _get_candidates(self, brief=0, id=0l, keywords=u'', area=0l, city=0l, range=0, category=0l, longitude = None, latitude = None):
+        ''' 私有辅助函数，给出符合搜索条件（距离范围除外）的 POI id 序列，以及实际使用的搜索范围，供 sitetable.SiteTable 计算距离和排序。'''
+        range, geohash = self._get_range(area, range, longitude, latitude)
+        if not id and not city and not geohash and (not keywords or app.config['SEARCH_INDEX']):
+            # 只按商圈、分类、关键词筛选时，直接在数据表和倒排索引中完成，不必查询数据库：
+            area_ids = None if not area else _get_area_subtree_ids(area)
+            category_ids = None if not category else _get_category_subtree_ids(category)
+            site_ids = get_site_table().select(area_ids, category_ids)
+            if keywords:
+                matched_ids = get_search_index().search(_get_keyword_list(keywords))
+                site_ids = numpy.intersect1d(site_ids, numpy.fromiter(matched_ids, dtype=numpy.int64, count=len(matched_ids)))
+        else:
+            # 候选集合与排序方式无关，不同 order 的请求可以共用同一份缓存：
+            site_ids = [site_item[0] for site_item in self._get_site_items(id, keywords, area, city, category, None, geohash)]
+        return (site_ids, range)
+
+    def _get_ranked(self, brief=0, id=0l, keywords=u'', area=0l, city=0l, range=0, category=0l, order=0, longitude = None, latitude = None):
+        ''' 与 _get_sorted 函数功能相同，但距离计算、范围过滤和排序都由进程内存中的 sitetable.SiteTable 用 NumPy 批量完成，因而无需再缓存排序结果。'''
+        site_ids, range = self._get_candidates(brief, id, keywords, area, city, range, category, longitude, latitude)
+        return get_site_table().rank(site_ids, order, longitude, latitude, range)
+
+    def _get_page(self, brief=0, id=0l, keywords=u'', area=0l, city=0l, range=0, category=0l, order=0, longitude = None, latitude = None, offset=0, limit=10, cursor=None):
+        ''' 给出一页搜索结果的 POI id 列表，以及读取下一页用的 cursor（没有下一页时为 None）。
+
+        使用 sitetable.SiteTable 时只选取本页需要的前 offset + limit 个 POI ，不对全部结果排序；
+        提供 cursor 时从上一页最后一个 POI 之后继续选取，offset 参数不再起作用。
+        '''
+        if cursor and cursor.get('o') != order:
+            cursor = None       # 排序方式改变后，旧 cursor 不再有意义，从第一页开始
+        if cursor:
+            offset = 0
+            # 距离排序的 cursor 需要沿用第一页时的用户位置，否则排序值无法衔接：
+            longitude = cursor.get('x', longitude)
+            latitude = cursor.get('y', latitude)
+        if not app.config['SITE_TABLE']:
+            result = self._get_sorted(brief, id, keywords, area, city, range, category, order, longitude, latitude)
+            if cursor:
+                try:
+                    result = result[result.index(cursor.get('i')) + 1:]
+                except ValueError, e:
+                    result = []
+            result = result[offset:]
+            if limit:
+                result = result[:limit]
+            next_cursor = None
+            if limit and len(result) == limit:
+                next_cursor = {'o': order, 'i': result[-1], 'x': longitude, 'y': latitude}
+            return (result, next_cursor)
+        site_ids, range = self._get_candidates(brief, id, keywords, area, city, range, category, longitude, latitude)
+        after = None if not cursor else (cursor.get('k'), cursor.get('i'))
+        result, keys = get_site_table().top(site_ids, order, longitude, latitude, range, 0 if not limit else offset + limit, after)
+        result = result[offset:]
+        keys = keys[offset:]
+        next_cursor = None
+        if limit and len(result) == limit:
+            next_cursor = {'o': order, 'k': keys[-1], 'i': result[-1], 'x': longitude, 'y': latitude}
+        return (result, next_cursor)
+
+    def _count_facets(self, site_ids, closure_class, query_func, facet_ids):
+        ''' 私有辅助函数，通过闭包表做 group by 查询，统计 site_ids 中属于 facet_ids 各节点（及其所有层级子节点）的 POI 数量。
+
+        query_func(closure_class, chunk) 需返回 (节点 id, POI 数量) 格式的 group by 查询。site_ids 分批查询，避免 in 查询的参数过多。
+        '''
+        counts = dict((facet_id, 0) for facet_id in facet_ids)
+        if not facet_ids:
+            return counts
+        site_ids = list(site_ids)
+        for i in xrange(0, len(site_ids), 1000):
+            chunk = site_ids[i:i + 1000]
+            query = query_func(closure_class, chunk).filter(closure_class.ancestor_id.in_(facet_ids)).group_by(closure_class.ancestor_id)
+            for facet_id, count in query:
+                counts[facet_id] += count
+        return counts
+
+    def _get_facets(self, brief=0, id=0l, keywords=u'', area=0l, city=0l, range=0, category=0l, longitude = None, latitude = None):
+        ''' 给出当前搜索条件下，各子分类、各商区的 POI 数量，供客户端一次性显示全部筛选项。
+
+        结果按筛选条件、搜索范围及 geohash 方格缓存（与 _get_site_items 的候选集合一样），缓存命中时不必计算搜索结果；
+        同一组方格内的用户共用同一份统计，统计按首个请求的用户位置计算，范围边缘的 POI 数量可能略有出入。
+        '''
+        search_range, geohash = self._get_range(area, range, longitude, latitude)
+        key = 'site_facets_' + hashlib.md5(repr(self._get_cache_params(id, keywords, area, city, category, geohash) + (search_range, ))).hexdigest()
+        result = cache.get(key)
+        if result is not None:
+            return result
+        get_func = self._get_ranked if app.config['SITE_TABLE'] else self._get_sorted
+        site_ids = sorted(get_func(brief, id, keywords, area, city, range, category, 0, longitude, latitude))
+        # 筛选项：当前分类的子分类，以及当前商区的子商区（或城市的顶级商区）：
+        category_query = db.session.query(Category).filter(Category.valid == True).filter(Category.parent_id == (category or None))
+        area_query = db.session.query(Area).filter(Area.valid == True).filter(Area.parent_id == (area or None))
+        if city and not area:
+            area_query = area_query.filter(Area.city_id == city)
+        sub_categories = category_query.order_by(Category.order.desc()).all()
+        sub_areas = area_query.order_by(Area.order.desc()).all()
+        category_counts = self._count_facets(site_ids, CategoryClosure,
+            lambda closure_class, chunk: db.session.query(closure_class.ancestor_id, func.count(func.distinct(categories.c.site_id))).join(categories, categories.c.category_id == closure_class.descendant_id).filter(categories.c.site_id.in_(chunk)),
+            [sub_category.id for sub_category in sub_categories])
+        area_counts = self._count_facets(site_ids, AreaClosure,
+            lambda closure_class, chunk: db.session.query(closure_class.ancestor_id, func.count(Site.id)).join(Site, Site.area_id == closure_class.descendant_id).filter(Site.id.in_(chunk)),
+            [sub_area.id for sub_area in sub_areas])
+        result = {'total': len(site_ids),
+                  'categories': [{'id': sub_category.id, 'name': sub_category.name, 'count': category_counts[sub_category.id]} for sub_category in sub_categories],
+                  'areas': [{'id': sub_area.id, 'name': sub_area.name, 'count': area_counts[sub_area.id]} for sub_area in sub_areas if area or city or area_counts[sub_area.id]],
+                 }
+        result = marshal(result, site_facets_fields)
+        cache.set(key, result)
+        return result
+
     @hmac_auth('api')
     def get(self):
         args = site_parser.parse_args()
@@ -916,25 +1123,30 @@ class SiteList(Resource):
         latitude = None if not latitude else round(latitude, 4)
         # 基本搜索条件处理：
         brief = args['brief']
-        result = self._get_sorted(brief, args['id'], args['keywords'], args['area'], args['city'], args['range'], args['category'], args['order'], longitude, latitude)
-        offset = args['offset']
-        if offset:
-            result = result[offset:]
-        limit = args['limit']
-        if limit:
-            result = result[:limit]
+        if args['facets']:
+            return self._get_facets(brief, args['id'], args['keywords'], args['area'], args['city'], args['range'], args['category'], longitude, latitude)
+        cursor = None
+        if args['cursor']:
+            cursor = util.decode_cursor(args['cursor'])
+            if cursor is None:
+                abort(400, message='The cursor is not valid!')
+        result, next_cursor = self._get_page(brief, args['id'], args['keywords'], args['area'], args['city'], args['range'], args['category'], args['order'], longitude, latitude, args['offset'], args['limit'], cursor)
+        g.cursor = None if not next_cursor else util.encode_cursor(next_cursor)
+        token = args['token']
+        if app.config['JSON_FRAGMENTS']:
+            # 拼接各 POI 的 JSON 片段，完整格式补充 favorite 关系（没有 token 时为 null）：
+            items = [(site_id, item[0]) for site_id, item in zip(result, fragments.get_fragments('site', 'brief' if brief else 'full', result, util.get_info_sites)) if item]
+            if brief:
+                return output_fragments([item for site_id, item in items])
+            viewer = util.get_viewer(token).add('favorites', [site_id for site_id, item in items])
+            return output_fragments([fragments.extend(item, [('favorited', fragments.dumps(viewer.favorited(site_id)))]) for site_id, item in items])
         # 读取具体的 site 信息详情：
         result = util.get_info_sites(result)
         # 提取 favorite 关系：
-        if not brief:
-            token = args['token']
-            if token:        # ToDo: 这里查询收藏关系使用的是数据库查询，存在性能风险！
-                query = db.session.query(Site.id).filter(Site.valid == True).join(Site.fans).join(Token, User.id == Token.user_id).filter(Token.token == token).filter(Site.id.in_([site.id for site in result]))
-                favorite_dic = {}
-                for site_id in query:
-                    favorite_dic[site_id[0]] = True
-                for site in result:
-                    site.favorited = favorite_dic.get(site.id, False)
+        if not brief and token:
+            viewer = util.get_viewer(token).add('favorites', [site.id for site in result])
+            for site in result:
+                site.favorited = viewer.favorited(site.id)
         # 输出数据：
         if brief:
             return marshal(result, site_fields_brief)
@@ -997,6 +1209,8 @@ article_fields = {
     'comment_num': fields.Integer,
 }
 article_fields.update(article_fields_brief)
+fragments.register('article', 'brief', article_fields_brief)
+fragments.register('article', 'full', article_fields)
 
 def get_info_articles(article_ids, valid_only = True):
     ''' 辅助函数：提取指定 id 的首页文章内容详情，并使用缓存。'''
@@ -1016,7 +1230,7 @@ class ArticleList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    @cache.memoize()
+    @caching.memoize(tags=lambda self, id=0l, city=0l: ['articles'])
     def _get(self, id=0l, city=0l):
         query = db.session.query(Article).filter(Article.valid == True)
         if id:
@@ -1042,8 +1256,10 @@ class ArticleList(Resource):
         limit = args['limit']
         if limit:
             result = result[:limit]
-        result = get_info_articles(result)
         brief = args['brief']
+        if app.config['JSON_FRAGMENTS']:
+            return output_fragments([item[0] for item in fragments.get_fragments('article', 'brief' if brief else 'full', result, get_info_articles) if item])
+        result = get_info_articles(result)
         if brief:
             return marshal(result, article_fields_brief)
         else:
@@ -1156,39 +1372,100 @@ review_fields = {
 }
 review_fields.update(review_fields_brief)
 review_fields['content'] = fields.String        # 非 brief 模式下，提供完整的文字内容
+# JSON 片段缓存（fragments 模块）中的晒单评论格式只包含晒单评论自身的字段，内嵌的用户、 POI 及 liked 字段在拼接时补充：
+fragments.register('review', 'brief', dict((name, field) for name, field in review_fields_brief.items() if name not in ('user', 'site', 'liked')),
+                   refs = lambda review: (review.user_id, review.site_id, ()))
+fragments.register('review', 'full', dict((name, field) for name, field in review_fields.items() if name not in ('user', 'site', 'liked', 'at_list')),
+                   refs = lambda review: (review.user_id, review.site_id, tuple(util.get_ids_from_str(review.at_list or ''))))
+
+def _load_reviews(review_ids, valid_only = True, brief = False):
+    ''' 辅助函数：提取指定 id 的晒单评论自身的内容详情（不含内嵌的用户、 POI 等），并使用缓存。'''
+    result = util.get_info_ids(Review, review_ids, format_func = util.format_review, valid_only = valid_only)
+    if brief:
+        for review in result:
+            review.brief_content = review.content[:80]
+            review.valid_images = review.valid_images[:1]
+    return result
 
 def get_info_reviews(review_ids, valid_only = True, brief = False, token = None):
     ''' 辅助函数：提取指定 id 的晒单评论内容详情，并使用缓存。'''
-    result = util.get_info_ids(Review, review_ids, format_func = util.format_review, valid_only = valid_only)
+    result = _load_reviews(review_ids, valid_only, brief)
+    # 内嵌的作者及 POI 批量读取，作者的关注关系通过 ViewerContext 一次解析：
+    users = dict((user.id, user) for user in util.get_info_users(list(set(review.user_id for review in result if review.user_id)), token = token))
+    sites = dict((site.id, site) for site in util.get_info_sites(list(set(review.site_id for review in result if review.site_id))))
     for review in result:
-        review.valid_user = util.get_info_user(review.user_id, token = token)
-        review.valid_site = util.get_info_site(review.site_id)
+        review.valid_user = users.get(review.user_id)
+        review.valid_site = sites.get(review.site_id)
         review.valid_at_users = []
         if review.at_list:
             review.valid_at_users = util.get_users(review.at_list)
-        if brief:
-            review.brief_content = review.content[:80]
-            review.valid_images = review.valid_images[:1]
     # 提取 like 关系：
     _format_review_like(result, token)
     return result
 
+def get_review_fragments(review_ids, brief = False, token = None):
+    ''' 辅助函数：给出与 get_info_reviews 的结果经 marshal 输出相同的各条晒单评论的 JSON 文本，使用 fragments 模块的片段缓存。
+
+    晒单评论、内嵌的用户及 POI 各自批量读取片段，再按 token 补充 liked 字段及作者的 followed 字段（@ 的用户的 followed 字段总是 null）。
+    '''
+    name = 'brief' if brief else 'full'
+    items = [(review_id, item) for review_id, item in zip(review_ids, fragments.get_fragments('review', name, review_ids, lambda ids: _load_reviews(ids, brief = brief))) if item]
+    user_ids = set()
+    site_ids = set()
+    viewer = util.get_viewer(token)
+    for review_id, (text, (user_id, site_id, at_ids)) in items:
+        user_ids.add(user_id)
+        user_ids.update(at_ids)
+        site_ids.add(site_id)
+        viewer.add('follows', [user_id]).add('likes', [review_id])
+    user_ids = [id for id in user_ids if id]
+    site_ids = [id for id in site_ids if id]
+    users = dict(zip(user_ids, fragments.get_fragments('user', 'mini', user_ids, util.get_info_users)))
+    sites = dict(zip(site_ids, fragments.get_fragments('site', 'mini', site_ids, util.get_info_sites)))
+    def user_json(user_id, followed):
+        user = users.get(user_id)
+        if not user:
+            return fragments.render(None, user_fields_mini)
+        return fragments.extend(user[0], [('followed', fragments.dumps(followed))])
+    result = []
+    for review_id, (text, (user_id, site_id, at_ids)) in items:
+        site = sites.get(site_id)
+        extra = [('user', user_json(user_id, viewer.followed(user_id))),
+                 ('site', site[0] if site else fragments.render(None, site_fields_mini)),
+                 ('liked', fragments.dumps(viewer.liked(review_id))),
+                ]
+        if not brief:
+            extra.append(('at_list', '[' + ', '.join(user_json(at_id, None) for at_id in at_ids if users.get(at_id)) + ']'))
+        result.append(fragments.extend(text, extra))
+    return result
+
 def get_info_review(review_id, valid_only = True, brief = False, token = None):
     result = get_info_reviews([review_id], valid_only = valid_only, brief = brief, token = token)
     return None if not result else result[0]
 
 def _format_review_like(reviews, token):
     ''' 辅助函数：用于在 Review 实例中，插入当前 token 对应用户是否喜欢它的信息。'''
-    like_dic = {}
-    if token:        # ToDo: 这里查询喜欢关系使用的是数据库查询，存在性能风险！
-        query = db.session.query(Review.id).filter(Review.valid == True).join(Review.fans).join(Token, User.id == Token.user_id).filter(Token.token == token).filter(Review.id.in_([review.id for review in reviews]))
-        for review_id in query:
-            like_dic[review_id[0]] = True
+    viewer = util.get_viewer(token).add('likes', [review.id for review in reviews])
     for review in reviews:
-        review.liked = like_dic.get(review.id, False)
+        review.liked = viewer.liked(review.id)
     return reviews
 
-@cache.memoize()
+def _get_reviews_tags(selected = None, published = False, id=0l, site=0l, city=0l, country=0l, user=0l):
+    ''' 辅助函数：给出 get_reviews_id 的缓存结果所依赖的标签。每个查询条件对应一个标签，没有查询条件时依赖全部晒单评论。晒单评论被修改时，由 cachesync 模块更新相应标签。'''
+    tags = []
+    if id:
+        tags.append('review:%d' % id)
+    if site:
+        tags.append('site_reviews:%d' % site)
+    if city:
+        tags.append('city_reviews:%d' % city)
+    if country:
+        tags.append('country_reviews:%d' % country)
+    if user:
+        tags.append('user_reviews:%d' % user)
+    return tags or ['reviews']
+
+@caching.memoize(tags=_get_reviews_tags)
 def get_reviews_id(selected = None, published = False, id=0l, site=0l, city=0l, country=0l, user=0l):
     query = db.session.query(Review.id).filter(Review.valid == True)
     query = query.order_by(Review.publish_time.desc())
@@ -1208,7 +1485,7 @@ def get_reviews_id(selected = None, published = False, id=0l, site=0l, city=0l,
         # 在“动态”栏目显示晒单评论的时候，不显示无图片评论：
         query = query.filter(Review.images != '')
     if selected is None:
-        # ToDo: 后台需要有个定时任务，将被关注多的 Review 设置成 selected 。
+        # 人气高的 Review 由定时任务 task.score_popularity 设置成 selected 。
         pass
     else:   # 要求只返回 selected 或者只返回一定没被 selected 的内容时：
         query = query.filter(Review.selected == selected)   # selected 取值为合法 boolean 这一点，由 ReviewList.get 函数调用 get_reviews_id 前负责保证！
@@ -1226,37 +1503,16 @@ class ReviewList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    def _delete_cache(self, model, site, user):
-        ''' 辅助函数：尝试覆盖组合参数的主要可能性，清空对应缓存。'''
-        # ToDo: 我有点儿怀疑这个搞法的效率，太多次 cache 访问了。感觉至少应该用 delete_many 处理。
-        params = [(selected, published) for selected in (None, False, True) for published in (False, True)]
-        id = 0l if not model else model.id
-        site_id = 0l if not site else site.id
-        city_id = 0l if not site else model.site.area.city.id
-        country_id = 0l if not site else model.site.area.city.country.id
-        user_id = 0l if not user else user.id
-        for selected, published in params:
-            if id:
-                cache.delete_memoized(get_reviews_id, selected, published, id, 0l, 0l, 0l, 0l)
-            if site_id:
-                cache.delete_memoized(get_reviews_id, selected, published, 0l, site_id, 0l, 0l, 0l)
-            if city_id:
-                cache.delete_memoized(get_reviews_id, selected, published, 0l, 0l, city_id, 0l, 0l)
-            if country_id:
-                cache.delete_memoized(get_reviews_id, selected, published, 0l, 0l, 0l, country_id, 0l)
-            if user_id:
-                cache.delete_memoized(get_reviews_id, selected, published, 0l, 0l, 0l, 0l, user_id)
-
     def _count_reviews(self, model):
-        ''' 辅助函数，对晒单评论涉及的用户账号和 POI ，重新计算其星级和评论数。并更新各个缓存。'''
+        ''' 辅助函数，提交晒单评论的修改，并更新各个缓存。
+
+        涉及的用户账号和 POI 的星级、评论数由 models 模块中 Review 的 mapper 事件在同一事务中增量修改，其缓存由 cachesync 模块删除。
+        '''
+        db.session.commit()
         util.update_cache(model, format_func = util.format_review)
-        user = model.user
         site = model.site
-        util.count_reviews([user] if user else [], [site] if site else [])
         if site:
             util.count_images(site)
-        # 清除 Review 详情缓存：
-        self._delete_cache(model, site, user)
 
     @hmac_auth('api')
     def get(self):
@@ -1277,6 +1533,8 @@ class ReviewList(Resource):
             result = result[offset:]
         if limit:
             result = result[:limit]
+        if app.config['JSON_FRAGMENTS']:
+            return output_fragments(get_review_fragments(result, brief = brief, token = args['token']))
         result = get_info_reviews(result, valid_only = True, brief = brief, token = args['token'])
         # 输出结果：
         if brief:
@@ -1292,7 +1550,6 @@ class ReviewList(Resource):
         review = db.session.query(Review).filter(Review.id == id).filter(Review.valid == True).first()
         if review:
             review.valid = False
-            db.session.commit()
             self._count_reviews(review)
             return '', 200
         abort(404, message='Target Review do not exists!')
@@ -1324,7 +1581,6 @@ class ReviewList(Resource):
         if args['published']:
             review.publish_time = datetime.datetime.now()
         db.session.add(review)
-        db.session.commit()
         self._count_reviews(review)
         # 通过用户消息通知被 @ 的用户：
         for at_id in util.get_ids_from_str(at_list):
@@ -1361,7 +1617,6 @@ class ReviewList(Resource):
             review.site_id = args['site']
             if args['published'] and not review.publish_time:   # 只有首次发布才记录 publish_time 
                 review.publish_time = datetime.datetime.now()
-            db.session.commit()
             self._count_reviews(review)
             review = get_info_review(review.id)
             return marshal(review, review_fields), 200
@@ -1415,7 +1670,18 @@ def get_info_comment(comment_id, valid_only = True):
     result = get_info_comments([comment_id], valid_only)
     return None if not result else result[0]
 
-@cache.memoize()
+def _get_comments_tags(id=0l, article=0l, review=0l):
+    ''' 辅助函数：给出 get_comments_id 的缓存结果所依赖的标签。子评论被修改时，由 cachesync 模块更新相应标签。'''
+    tags = []
+    if id:
+        tags.append('comment:%d' % id)
+    if article:
+        tags.append('article_comments:%d' % article)
+    if review:
+        tags.append('review_comments:%d' % review)
+    return tags or ['comments']
+
+@caching.memoize(tags=_get_comments_tags)
 def get_comments_id(id=0l, article=0l, review=0l):
     query = db.session.query(Comment.id).filter(Comment.valid == True)
     query = query.order_by(Comment.publish_time.desc())
@@ -1437,27 +1703,10 @@ class CommentList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    def _delete_cache(self, model, article, review):
-        ''' 辅助函数：尝试覆盖组合参数的主要可能性，清空对应缓存。'''
-        id = 0l if not model else model.id
-        article_id = 0l if not article else article.id
-        review_id = 0l if not review else review.id
-        if id:
-            cache.delete_memoized(get_comments_id, id, 0l, 0l)
-        if article_id:
-            cache.delete_memoized(get_comments_id, 0l, article_id, 0l)
-        if review_id:
-            cache.delete_memoized(get_comments_id, 0l, 0l, review_id)
-    
-    def _count_comments(self, model):
-        ''' 辅助函数，对子评论涉及的首页文章和晒单评论，重新计算其子评论计数。'''
+    def _count_comments(self, model, delta):
+        ''' 辅助函数，提交子评论的修改，并在同一事务中增减其涉及的首页文章和晒单评论的子评论计数。'''
+        util.incr_comments(model, delta)
         util.update_cache(model, format_func = format_comment)
-        user = model.user
-        article = model.article
-        review = model.review
-        util.count_comments([user] if user else [], [article] if article else [], [review] if review else [])
-        # 清除相关数据缓存：
-        self._delete_cache(model, article, review)
 
     @hmac_auth('api')
     @marshal_with(comment_fields)
@@ -1481,8 +1730,7 @@ class CommentList(Resource):
         comment = db.session.query(Comment).filter(Comment.id == id).filter(Comment.valid == True).first()
         if comment:
             comment.valid = False
-            db.session.commit()
-            self._count_comments(comment)
+            self._count_comments(comment, -1)
             return '', 200
         abort(404, message='Target Comment do not exists!')
 
@@ -1502,8 +1750,7 @@ class CommentList(Resource):
                           content = args['content'],
                          )
         db.session.add(comment)
-        db.session.commit()
-        self._count_comments(comment)
+        self._count_comments(comment, 1)
         # 通过用户消息通知被 @ 的用户：
         for at_id in util.get_ids_from_str(at_list):
             util.send_message(user_id, 
@@ -1551,11 +1798,9 @@ class FollowList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    def _count_follow_fans(self, follow, fan):
-        ''' 辅助函数，对交互行为涉及的用户账号，重新计算其 follow_num 和 fans_num 。'''
-        util.count_follow_fans([follow] if follow else [], [fan] if fan else [])
-        # 顺便清除相关缓存：
-        UserList()._delete_follow_cache(follow, fan)
+    def _count_follow_fans(self, follow, fan, delta):
+        ''' 辅助函数，提交关注关系的修改，并在同一事务中增减交互行为涉及的用户账号的 follow_num 和 fans_num 。'''
+        util.incr_follow_fans(follow, fan, delta)
 
     @hmac_auth('api')
     def delete(self):
@@ -1567,8 +1812,7 @@ class FollowList(Resource):
         fan = follow.fans.filter(User.id == args['fan']).first()
         if fan != None:
             follow.fans.remove(fan)
-            db.session.commit()
-            self._count_follow_fans(follow, fan)
+            self._count_follow_fans(follow, fan, -1)
         return '', 200
 
     @hmac_auth('api')
@@ -1583,8 +1827,7 @@ class FollowList(Resource):
             abort(404, message='The user fan do not exists!')
         if follow.fans.filter(User.id == args['fan']).first() == None:  # 避免多次 follow 同一用户。
             follow.fans.append(fan)
-            db.session.commit()
-            self._count_follow_fans(follow, fan)
+            self._count_follow_fans(follow, fan, 1)
         # 通过用户消息通知关注的用户：
         util.send_message(fan.id, 
                           follow.id, 
@@ -1617,16 +1860,11 @@ class LikeList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    def _delete_cache(self, user):
-        if user:
-            cache.delete_memoized(self._get, self, user.id)
-
-    def _count_likes(self, user, review):
-        ''' 辅助函数，对交互行为涉及的用户账号和晒单评论，重新计算其 like_num 。'''
-        util.count_likes([user] if user else [], [review] if review else [])
-        self._delete_cache(user)
+    def _count_likes(self, user, review, delta):
+        ''' 辅助函数，提交喜欢关系的修改，并在同一事务中增减交互行为涉及的用户账号和晒单评论的 like_num 。'''
+        util.incr_likes(user, review, delta)
 
-    @cache.memoize()
+    @caching.memoize(tags=lambda self, user=0l: ['user_likes:%d' % user])
     def _get(self, user=0l):
         query = db.session.query(Review.id).filter(Review.valid == True)
         query = query.join(likes, Review.id == likes.columns.review_id)
@@ -1661,8 +1899,7 @@ class LikeList(Resource):
         review = user.likes.filter(Review.id == args['review']).first()
         if review != None:
             user.likes.remove(review)
-            db.session.commit()
-            self._count_likes(user, review)
+            self._count_likes(user, review, -1)
         return '', 200
 
     @hmac_auth('api')
@@ -1677,8 +1914,7 @@ class LikeList(Resource):
             abort(404, message='The review do not exists!')
         if user.likes.filter(Review.id == args['review']).first() == None:  # 避免多次 like 同一 Review 。
             user.likes.append(review)
-            db.session.commit()
-            self._count_likes(user, review)
+            self._count_likes(user, review, 1)
         # 通过用户消息通知被喜欢的用户：
         util.send_message(user.id, 
                           review.user_id, 
@@ -1710,16 +1946,11 @@ class FavoriteList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    def _delete_cache(self, user):
-        if user:
-            cache.delete_memoized(self._get, self, user.id)
-
-    def _count_favorites(self, user, site):
-        ''' 辅助函数，对交互行为涉及的用户账号和 POI ，重新计算其 favorite_num 。'''
-        util.count_favorites([user] if user else [], [site] if site else [])
-        self._delete_cache(user)
+    def _count_favorites(self, user, site, delta):
+        ''' 辅助函数，提交收藏关系的修改，并在同一事务中增减交互行为涉及的用户账号的 favorite_num 。'''
+        util.incr_favorites(user, site, delta)
 
-    @cache.memoize()
+    @caching.memoize(tags=lambda self, user=0l: ['user_favorites:%d' % user])
     def _get(self, user=0l):
         brief = 1
         query = db.session.query(Site.id).filter(Site.valid == True)
@@ -1753,8 +1984,7 @@ class FavoriteList(Resource):
         site = user.favorites.filter(Site.id == args['site']).first()
         if site != None:
             user.favorites.remove(site)
-            db.session.commit()
-            self._count_favorites(user, site)
+            self._count_favorites(user, site, -1)
         return '', 200
 
     @hmac_auth('api')
@@ -1769,8 +1999,7 @@ class FavoriteList(Resource):
             abort(404, message='The site do not exists!')
         if user.favorites.filter(Site.id == args['site']).first() == None:  # 避免多次 favorite 同一 Site 。
             user.favorites.append(site)
-            db.session.commit()
-            self._count_favorites(user, site)
+            self._count_favorites(user, site, 1)
         return '', 201
 
 api.add_resource(FavoriteList, '/rpc/favorites')
@@ -1842,18 +2071,21 @@ class ShareList(Resource):
         '''
         return '%s' % self.__class__.__name__
 
-    def _delete_cache(self, user):
-        if user:
-            cache.delete_memoized(self._get, self, user.id)
-
-    def _count_shares(self, user, site, review, article):
-        ''' 辅助函数，对交互行为涉及的用户账号、 POI 、晒单评论、首页文章，重新计算其 share_num 。'''
-        util.count_shares([user] if user else [], [site] if site else [], [review] if review else [], [article] if article else [])
-        self._delete_cache(user)
+    def _count_shares(self, user, share_record):
+        ''' 辅助函数，保存新的共享记录，并与之一起增加用户的 share_num （同一 POI 、晒单评论、首页文章的重复共享不重复计数）。'''
+        delta = 0
+        for column, value in ((ShareRecord.site_id, share_record.site_id), (ShareRecord.review_id, share_record.review_id), (ShareRecord.article_id, share_record.article_id)):
+            if value and db.session.query(ShareRecord.id).filter(ShareRecord.user_id == user.id).filter(column == value).first() == None:
+                delta += 1
+        db.session.add(share_record)
+        util.incr_shares(user, delta)
 
     def _get_info_shares(self, share_ids, token = None):
         ''' 辅助函数：用于格式化 ShareRecord 实例，用于接口输出并缓存。'''
         result = util.get_info_ids(ShareRecord, share_ids)
+        # 被分享的晒单评论批量读取，当前用户的 like 及关注关系由 ViewerContext 一次解析：
+        review_ids = list(set(share.review_id for share in result if share.review_id and not share.article_id and not share.site_id))
+        reviews = dict((review.id, review) for review in get_info_reviews(review_ids, brief = True, token = token))
         for share in result:
             share.url = ''
             share.image = None
@@ -1878,7 +2110,7 @@ class ShareList(Resource):
                     share.title = valid_site.name
                     share.description = valid_site.description
             elif share.review_id:
-                valid_review = get_info_review(share.review_id, brief = True, token = token)
+                valid_review = reviews.get(share.review_id)
                 share.valid_review = valid_review
                 share.url = baseurl_share + '/reviews/' + share.token
                 if valid_review != None:
@@ -1892,7 +2124,7 @@ class ShareList(Resource):
         result = self._get_info_shares([share_id], token = token)
         return None if not result else result[0]
 
-    @cache.memoize()
+    @caching.memoize(tags=lambda self, user=0l: ['user_shares:%d' % user])
     def _get(self, user=0l):
         query = db.session.query(ShareRecord).filter(ShareRecord.user_id == user)
         query = query.order_by(ShareRecord.action_time.desc())  # 对同一个 Article，Site，Review，显示其最新的一次共享
@@ -1942,13 +2174,7 @@ class ShareList(Resource):
                                    review_id = review_id or None,
                                    target = args['target'],
                                    )
-        db.session.add(share_record)
-        db.session.commit()
-        self._count_shares(user, 
-                           share_record.site,
-                           share_record.review,
-                           share_record.article,
-                           )
+        self._count_shares(user, share_record)
         share_record = self._get_info_share(share_record.id)
         return marshal(share_record, share_fields), 201
 
@@ -2026,7 +2252,7 @@ class ForecastList(Resource):
         result['is_night'] = None if not datapoint.has_key('temp') else hour < 7 or hour >= 19
         return result
 
-    @cache.memoize()
+    @caching.memoize()
     def _get(self, city_id=0l):
         now = tz_server.localize(datetime.datetime.now())
         city = db.session.query(City).filter(City.valid == True).filter(City.id == city_id).first()
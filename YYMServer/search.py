@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+''' POI 关键词搜索使用的倒排索引，代替对 name、name_orig、address、address_orig 等字段逐个做 ilike 模糊匹配。
+
+分词规则：中日韩文字取单字及相邻两字（bigram），其他文字按单词切分并转为小写。
+搜索时中日韩文字按 bigram 匹配（单字关键词按单字匹配），其他单词按前缀匹配；多个词之间是“且”的关系。
+
+索引保存在 SEARCH_INDEX_PATH 指定的本地文件中（由 cron/build_search_index.py 定期重建），
+服务进程载入后通过 util.notify_changes 登记的 'site' 变更做增量更新。
+'''
+
+import bisect
+import cPickle as pickle
+import datetime
+import os
+import os.path
+import re
+import threading
+import time
+
+import flock
+
+from YYMServer import app, db, cache, util
+from YYMServer.models import Site
+
+CHANGES_CHANNEL = 'site'
+INDEX_FORMAT = 2        # 索引文件的格式版本，格式修改后应加一，以免载入旧格式的文件
+BUILD_VERSION_KEY = 'search_index_build'     # 索引文件的生成序号，每次由 build_index_file 重建后加一
+
+CJK_CHARS = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'     # 日文假名、中日韩汉字、韩文
+TOKEN_RE = re.compile(u'([%s]+)|([^\\W_%s]+)' % (CJK_CHARS, CJK_CHARS), re.UNICODE)
+
+
+def tokenize(text):
+    ''' 对一段文本分词，给出建索引用的 token 集合。'''
+    tokens = set()
+    if not text:
+        return tokens
+    for cjk, word in TOKEN_RE.findall(text):
+        if cjk:
+            tokens.update(cjk)
+            tokens.update(cjk[i:i + 2] for i in xrange(len(cjk) - 1))
+        else:
+            tokens.add(word.lower())
+    return tokens
+
+def tokenize_query(keyword):
+    ''' 对一个搜索关键词分词，给出 (需精确匹配的 token 列表, 需前缀匹配的 token 列表) 。'''
+    exact = []
+    prefix = []
+    for cjk, word in TOKEN_RE.findall(keyword):
+        if cjk:
+            if len(cjk) == 1:
+                exact.append(cjk)
+            else:
+                exact.extend(cjk[i:i + 2] for i in xrange(len(cjk) - 1))
+        else:
+            prefix.append(word.lower())
+    return (exact, prefix)
+
+def get_site_text(site):
+    ''' 给出 POI 参与搜索的全部文本。site 可以是 Site 实例，也可以是同名字段的查询结果。'''
+    return u' '.join([site.name or u'', site.name_orig or u'', site.address or u'', site.address_orig or u'',
+                      site.description or u'', site.keywords or u''])
+
+
+class SearchIndex(object):
+    ''' POI 关键词倒排索引。postings 记录每个 token 对应的 POI id 集合，site_tokens 记录每个 POI 的 token ，用于增量更新时删除旧数据。'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.version = 0            # 已经应用到的 'site' 变更版本号
+        self.refresh_time = 0.0     # 最后一次检查变更的时间
+        self.build_time = None      # 索引数据对应的数据库时间点，用于从索引文件载入后补充更新
+        self.build_version = 0      # 索引数据对应的索引文件生成序号
+        self.postings = {}
+        self.site_tokens = {}
+        self.vocabulary = []        # 排序后的 token 列表，用于前缀匹配
+        self.vocabulary_dirty = False
+
+    def __len__(self):
+        return len(self.site_tokens)
+
+    def _add(self, site_id, tokens):
+        self.site_tokens[site_id] = tuple(tokens)
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = set()
+                self.vocabulary_dirty = True
+            posting.add(site_id)
+
+    def _remove(self, site_id):
+        for token in self.site_tokens.pop(site_id, ()):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.discard(site_id)
+            if not posting:
+                del self.postings[token]
+                self.vocabulary_dirty = True
+
+    def _query(self, site_ids=None, since=None):
+        query = db.session.query(Site.id, Site.valid, Site.name, Site.name_orig, Site.address, Site.address_orig, Site.description, Site.keywords)
+        if site_ids is not None:
+            query = query.filter(Site.id.in_(site_ids))
+        if since is not None:
+            query = query.filter(Site.update_time >= since)
+        return query
+
+    def _apply(self, rows, site_ids=()):
+        ''' 用查询结果更新索引；site_ids 中查不到（已被删除）的 POI 从索引中去掉。'''
+        found = set()
+        for row in rows:
+            found.add(row.id)
+            self._remove(row.id)
+            if row.valid:
+                self._add(row.id, tokenize(get_site_text(row)))
+        for site_id in site_ids:
+            if site_id not in found:
+                self._remove(site_id)
+
+    def rebuild(self):
+        ''' 从数据库完整重建索引。'''
+        with self.lock:
+            self.version, ids = util.get_changes(CHANGES_CHANNEL, None)
+            self.build_time = datetime.datetime.now()
+            self.build_version = cache.get(BUILD_VERSION_KEY) or 0
+            self.postings = {}
+            self.site_tokens = {}
+            self.vocabulary_dirty = True
+            self._apply(self._query().filter(Site.valid == True).yield_per(1000))
+            self.refresh_time = time.time()
+            self.loaded = True
+
+    def update(self, site_ids):
+        ''' 从数据库重新读取指定 POI 的文本，更新索引。'''
+        site_ids = list(site_ids)
+        with self.lock:
+            for i in xrange(0, len(site_ids), 500):     # 避免 in 查询的参数过多
+                chunk = site_ids[i:i + 500]
+                self._apply(self._query(chunk).all(), chunk)
+
+    def save(self, path):
+        ''' 把索引保存到文件。先写临时文件再改名，避免服务进程读到写了一半的文件。'''
+        with self.lock:
+            data = (INDEX_FORMAT, self.build_time, self.build_version, self.site_tokens)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def load(self, path):
+        ''' 从文件载入索引，并补充更新文件生成之后修改过的 POI 。文件不存在或格式不符时返回 False 。'''
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            format, build_time, build_version, site_tokens = data
+        except Exception, e:
+            return False
+        if format != INDEX_FORMAT:
+            return False
+        with self.lock:
+            self.build_version = build_version
+            self.version, ids = util.get_changes(CHANGES_CHANNEL, None)
+            self.postings = {}
+            self.site_tokens = {}
+            for site_id, tokens in site_tokens.iteritems():
+                self._add(site_id, tokens)
+            self.vocabulary_dirty = True
+            self.build_time = datetime.datetime.now()
+            # 文件生成后修改过的 POI ，重新建索引：
+            self._apply(self._query(since=build_time).all(), [])
+            self.refresh_time = time.time()
+            self.loaded = True
+        return True
+
+    def refresh(self, force=False):
+        ''' 检查 'site' 变更并增量更新索引；两次检查之间至少间隔 SEARCH_INDEX_REFRESH_INTERVAL 秒。'''
+        if not self.loaded:
+            if not self.load(app.config['SEARCH_INDEX_PATH']):
+                self.rebuild()
+            return
+        now = time.time()
+        if not force and now - self.refresh_time < app.config['SEARCH_INDEX_REFRESH_INTERVAL']:
+            return
+        self.refresh_time = now
+        version, ids = util.get_changes(CHANGES_CHANNEL, self.version)
+        if ids is None:
+            # 变更记录不完整时，按修改时间补充更新（删除的 POI 留待索引文件重建时清理，搜索结果仍会经过数据库的 valid 过滤）：
+            since = self.build_time
+            with self.lock:
+                self.build_time = datetime.datetime.now()
+                self._apply(self._query(since=since).all(), [])
+        elif ids:
+            self.update(ids)
+        self.version = version
+
+    def get_version(self):
+        ''' 给出索引数据的版本：(索引文件生成序号, 已经应用到的 'site' 变更版本号) ，供搜索结果的缓存放入 key 中。'''
+        return (self.build_version, self.version)
+
+    def _prefix_match(self, prefix):
+        ''' 给出所有以 prefix 开头的 token 对应的 POI id 集合。'''
+        if self.vocabulary_dirty:
+            self.vocabulary = sorted(self.postings)
+            self.vocabulary_dirty = False
+        vocabulary = self.vocabulary
+        result = set()
+        i = bisect.bisect_left(vocabulary, prefix)
+        while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+            result.update(self.postings.get(vocabulary[i], ()))
+            i += 1
+        return result
+
+    def search(self, keyword_list):
+        ''' 给出同时匹配 keyword_list 中全部关键词的 POI id 集合。'''
+        with self.lock:
+            exact = []
+            prefix = []
+            for keyword in keyword_list:
+                keyword_exact, keyword_prefix = tokenize_query(keyword)
+                exact.extend(keyword_exact)
+                prefix.extend(keyword_prefix)
+            if not exact and not prefix:
+                return set()
+            postings = []
+            for token in set(exact):
+                posting = self.postings.get(token)
+                if not posting:
+                    return set()
+                postings.append(posting)
+            postings.sort(key=len)      # 从最短的倒排表开始求交集
+            result = None
+            for posting in postings:
+                result = set(posting) if result is None else result & posting
+                if not result:
+                    return set()
+            for token in set(prefix):
+                matched = self._prefix_match(token)
+                result = matched if result is None else result & matched
+                if not result:
+                    return set()
+            return result
+
+
+search_index = SearchIndex()
+
+def get_search_index():
+    ''' 获取当前进程的关键词索引，并在需要时做增量更新。'''
+    search_index.refresh()
+    return search_index
+
+def build_index_file():
+    ''' 完整重建关键词索引并保存到 SEARCH_INDEX_PATH ，同时只允许一个实例运行。通常由 cron 任务定期调用，服务进程重启时即可直接载入。'''
+    with open('/tmp/yym_task_build_search_index.lock', 'w') as f:
+        blocking_lock = flock.Flock(f, flock.LOCK_EX|flock.LOCK_NB)
+
+        try:
+            with blocking_lock:
+                print 'Got lock and building search index:'
+                index = SearchIndex()
+                start = time.time()
+                index.rebuild()
+                index.build_version = cache.cache.inc(BUILD_VERSION_KEY) or 0
+                index.save(app.config['SEARCH_INDEX_PATH'])
+                print '* %d sites, %d tokens, %.1f seconds.' % (len(index), len(index.postings), time.time() - start)
+        except IOError, e:
+            print 'Search index is being built by another process!'
+
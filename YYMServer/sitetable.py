@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+''' 常驻服务进程内存的 POI 坐标及排序数据表，用 NumPy 数组按列存储，供“附近”搜索批量计算距离、范围过滤和排序。
+
+数据表通过 util.notify_changes 登记的 'site' 变更做增量刷新（任何提交到数据库的 POI 修改都会由 cachesync 模块登记，接口更新 POI 缓存时也会登记）。
+'''
+
+import threading
+import time
+
+import numpy
+
+from YYMServer import app, db, util
+from YYMServer.models import Site, categories
+
+EARTH_RADIUS = 6378.1   # 地球半径（单位是公里），与 util.get_distance 一致
+CHANGES_CHANNEL = 'site'
+
+
+class SiteTable(object):
+    ''' POI 数据表。各列数组均按 POI id 升序排列，每次刷新都生成新的数组后整体替换，因而读取时无需加锁。'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.version = 0            # 已经应用到的 'site' 变更版本号
+        self.refresh_time = 0.0     # 最后一次检查变更的时间
+        self.columns = self._empty_columns()
+        self.category_pairs = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def _empty_columns(self):
+        return {'id': numpy.zeros(0, dtype=numpy.int64),
+                'valid': numpy.zeros(0, dtype=numpy.bool_),
+                'longitude': numpy.zeros(0, dtype=numpy.float64),
+                'latitude': numpy.zeros(0, dtype=numpy.float64),
+                'cos_latitude': numpy.zeros(0, dtype=numpy.float64),
+                'order': numpy.zeros(0, dtype=numpy.int64),
+                'popular': numpy.zeros(0, dtype=numpy.int64),
+                'stars': numpy.zeros(0, dtype=numpy.float64),
+                'area': numpy.zeros(0, dtype=numpy.int64),
+               }
+
+    def _build_columns(self, rows):
+        ''' 把 (id, valid, longitude, latitude, order, popular, stars, area_id) 格式的查询结果转为按列存储的数组。'''
+        if not rows:
+            return self._empty_columns()
+        id, valid, longitude, latitude, order, popular, stars, area = zip(*rows)
+        # 坐标缺失的 POI 用 NaN 表示，计算距离时自然落在任何范围之外：
+        longitude = numpy.array([numpy.nan if value is None else value for value in longitude], dtype=numpy.float64)
+        latitude = numpy.array([numpy.nan if value is None else value for value in latitude], dtype=numpy.float64)
+        columns = {'id': numpy.array(id, dtype=numpy.int64),
+                   'valid': numpy.array([bool(value) for value in valid], dtype=numpy.bool_),
+                   'longitude': numpy.radians(longitude),
+                   'latitude': numpy.radians(latitude),
+                   'order': numpy.array([value or 0 for value in order], dtype=numpy.int64),
+                   'popular': numpy.array([value or 0 for value in popular], dtype=numpy.int64),
+                   'stars': numpy.array([value or 0.0 for value in stars], dtype=numpy.float64),
+                   'area': numpy.array([value or 0 for value in area], dtype=numpy.int64),
+                  }
+        columns['cos_latitude'] = numpy.cos(columns['latitude'])
+        return columns
+
+    def _build_category_pairs(self, rows):
+        ''' 把 (site_id, category_id) 格式的查询结果转为按 site_id 排序的两个数组。'''
+        rows = [row for row in rows if row[0] and row[1]]
+        if not rows:
+            return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+        site_ids, category_ids = zip(*rows)
+        site_ids = numpy.array(site_ids, dtype=numpy.int64)
+        category_ids = numpy.array(category_ids, dtype=numpy.int64)
+        index = numpy.argsort(site_ids, kind='mergesort')
+        return (site_ids[index], category_ids[index])
+
+    def _query(self, site_ids=None):
+        ''' 从数据库读取 POI 数据，site_ids 为 None 时读取全部。'''
+        query = db.session.query(Site.id, Site.valid, Site.longitude, Site.latitude, Site.order, Site.popular, Site.stars, Site.area_id)
+        category_query = db.session.query(categories.c.site_id, categories.c.category_id)
+        if site_ids is not None:
+            query = query.filter(Site.id.in_(site_ids))
+            category_query = category_query.filter(categories.c.site_id.in_(site_ids))
+        return (query.order_by(Site.id).all(), category_query.all())
+
+    def load(self, rows, category_rows):
+        ''' 用完整的数据替换数据表内容。'''
+        columns = self._build_columns(rows)
+        index = numpy.argsort(columns['id'], kind='mergesort')
+        self.columns = dict((name, column[index]) for name, column in columns.items())
+        self.category_pairs = self._build_category_pairs(category_rows)
+        self.loaded = True
+
+    def upsert(self, site_ids, rows, category_rows):
+        ''' 用 rows 中的数据替换数据表中 site_ids 对应的记录（数据库中已不存在的 POI 会被删除）。'''
+        site_ids = numpy.array(sorted(set(site_ids)), dtype=numpy.int64)
+        new_columns = self._build_columns(rows)
+        old_columns = self.columns
+        keep = ~numpy.in1d(old_columns['id'], site_ids)
+        columns = dict((name, numpy.concatenate((old_columns[name][keep], new_columns[name]))) for name in old_columns)
+        index = numpy.argsort(columns['id'], kind='mergesort')
+        columns = dict((name, column[index]) for name, column in columns.items())
+        old_site_ids, old_category_ids = self.category_pairs
+        new_site_ids, new_category_ids = self._build_category_pairs(category_rows)
+        keep = ~numpy.in1d(old_site_ids, site_ids)
+        category_site_ids = numpy.concatenate((old_site_ids[keep], new_site_ids))
+        category_ids = numpy.concatenate((old_category_ids[keep], new_category_ids))
+        index = numpy.argsort(category_site_ids, kind='mergesort')
+        self.columns = columns
+        self.category_pairs = (category_site_ids[index], category_ids[index])
+
+    def reload(self):
+        ''' 从数据库完整加载数据表。'''
+        with self.lock:
+            version, ids = util.get_changes(CHANGES_CHANNEL, None)
+            rows, category_rows = self._query()
+            self.load(rows, category_rows)
+            self.version = version
+            self.refresh_time = time.time()
+
+    def update(self, site_ids):
+        ''' 从数据库重新读取指定 POI 的数据。'''
+        site_ids = list(site_ids)
+        if not site_ids:
+            return
+        with self.lock:
+            for i in xrange(0, len(site_ids), 500):     # 避免 in 查询的参数过多
+                chunk = site_ids[i:i + 500]
+                rows, category_rows = self._query(chunk)
+                self.upsert(chunk, rows, category_rows)
+
+    def refresh(self, force=False):
+        ''' 检查 'site' 变更并增量刷新数据表；两次检查之间至少间隔 SITE_TABLE_REFRESH_INTERVAL 秒。'''
+        if not self.loaded:
+            self.reload()
+            return
+        now = time.time()
+        if not force and now - self.refresh_time < app.config['SITE_TABLE_REFRESH_INTERVAL']:
+            return
+        self.refresh_time = now
+        version, ids = util.get_changes(CHANGES_CHANNEL, self.version)
+        if ids is None:
+            self.reload()
+            return
+        self.update(ids)
+        self.version = version
+
+    def _locate(self, site_ids):
+        ''' 给出 site_ids 在数据表中的行号；数据表中还没有的 POI 先从数据库补充读取。'''
+        site_ids = numpy.unique(numpy.asarray(site_ids, dtype=numpy.int64))
+        rows, found = self._search(site_ids)
+        if not found.all():
+            self.update(site_ids[~found].tolist())
+            rows, found = self._search(site_ids)
+        return rows[found]
+
+    def _search(self, site_ids):
+        ''' 二分查找 site_ids 在数据表中的行号，同时给出是否找到的标记。'''
+        ids = self.columns['id']
+        if not len(ids):
+            return (numpy.zeros(len(site_ids), dtype=numpy.int64), numpy.zeros(len(site_ids), dtype=numpy.bool_))
+        rows = numpy.minimum(numpy.searchsorted(ids, site_ids), len(ids) - 1)
+        return (rows, ids[rows] == site_ids)
+
+    def select(self, area_ids=None, category_ids=None):
+        ''' 在数据表中筛选属于指定商圈（列表中任一）和指定分类（列表中任一）的有效 POI ，返回 POI id 数组。'''
+        columns = self.columns
+        mask = columns['valid'].copy()
+        if area_ids is not None:
+            mask &= numpy.in1d(columns['area'], numpy.asarray(area_ids, dtype=numpy.int64))
+        if category_ids is not None:
+            category_site_ids, site_category_ids = self.category_pairs
+            matched = numpy.unique(category_site_ids[numpy.in1d(site_category_ids, numpy.asarray(category_ids, dtype=numpy.int64))])
+            mask &= numpy.in1d(columns['id'], matched)
+        return columns['id'][mask]
+
+    def _sort_keys(self, site_ids, order=0, longitude=None, latitude=None, range=0):
+        ''' 对给定的 POI id 批量计算到指定经纬度的距离，按 range 公里范围过滤，给出 (POI id 数组, 排序值数组) ，排序值越小越靠前。
+
+        order 的取值与 /rpc/sites 接口一致：1 表示距离最近，2 表示人气最高，3 表示评价最好，其他表示默认的“智能排序”。
+        '''
+        rows = self._locate(site_ids)
+        columns = self.columns      # 在 _locate 之后读取，因为它可能补充读取了数据
+        rows = rows[columns['valid'][rows]]
+        ids = columns['id'][rows]
+        if longitude and latitude:
+            # haversine 公式：
+            lon = numpy.radians(longitude)
+            lat = numpy.radians(latitude)
+            sin_d_lat = numpy.sin((columns['latitude'][rows] - lat) / 2)
+            sin_d_lon = numpy.sin((columns['longitude'][rows] - lon) / 2)
+            a = sin_d_lat * sin_d_lat + numpy.cos(lat) * columns['cos_latitude'][rows] * sin_d_lon * sin_d_lon
+            distance = 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+            distance[numpy.isnan(distance)] = numpy.inf
+        else:
+            distance = numpy.zeros(len(rows), dtype=numpy.float64)
+        if range and range > 0:
+            in_range = distance <= range
+            rows = rows[in_range]
+            ids = ids[in_range]
+            distance = distance[in_range]
+        if order == 1:
+            key = distance
+        elif order == 2:
+            key = -columns['popular'][rows].astype(numpy.float64)
+        elif order == 3:
+            key = -columns['stars'][rows]
+        else:
+            key = -columns['order'][rows].astype(numpy.float64)
+        return (ids, key)
+
+    def rank(self, site_ids, order=0, longitude=None, latitude=None, range=0):
+        ''' 对给定的 POI id 批量计算距离、按 range 公里范围过滤，再按 order 排序，返回完整的 POI id 列表。排序值相同的 POI 按 id 升序排列。'''
+        ids, key = self._sort_keys(site_ids, order, longitude, latitude, range)
+        index = numpy.lexsort((ids, key))
+        return ids[index].tolist()
+
+    def top(self, site_ids, order=0, longitude=None, latitude=None, range=0, limit=10, after=None):
+        ''' 与 rank 函数的排序规则相同，但只给出排在最前面的 limit 个 POI ，返回 (POI id 列表, 排序值列表) 。
+
+        after 是上一页最后一个 POI 的 (排序值, id) ，提供时只在排在它之后的 POI 中选取，用于连续翻页。
+        选取时先用 argpartition 找出前 limit 个（O(n)），只对这一小部分做完整排序。
+        '''
+        ids, key = self._sort_keys(site_ids, order, longitude, latitude, range)
+        if after is not None:
+            after_key, after_id = after
+            mask = (key > after_key) | ((key == after_key) & (ids > after_id))
+            ids = ids[mask]
+            key = key[mask]
+        if limit and len(ids) > limit:
+            kth = key[numpy.argpartition(key, limit - 1)[limit - 1]]
+            mask = key <= kth      # 包含与第 limit 个排序值相同的全部 POI ，再按 id 决定取舍
+            ids = ids[mask]
+            key = key[mask]
+        index = numpy.lexsort((ids, key))
+        if limit:
+            index = index[:limit]
+        return (ids[index].tolist(), key[index].tolist())
+
+site_table = SiteTable()
+
+def get_site_table():
+    ''' 获取当前进程的 POI 数据表，并在需要时做增量刷新。'''
+    site_table.refresh()
+    return site_table
+
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+''' 服务进程内的简单运行统计计数（例如缓存命中、未命中次数），通过 /rpc/stats 接口查看。
+
+计数只在当前进程内累计，进程重启后清零；多进程部署时每个进程分别统计。
+'''
+
+import os
+import threading
+import time
+
+lock = threading.Lock()
+counters = {}
+start_time = time.time()
+
+
+def incr(name, delta=1):
+    ''' 将名为 name 的计数增加 delta 。'''
+    with lock:
+        counters[name] = counters.get(name, 0) + delta
+
+def get_counters():
+    ''' 给出当前全部计数的副本。'''
+    with lock:
+        return dict(counters)
+
+def get_hit_rates(counters):
+    ''' 对成对出现的 xxx_hit 和 xxx_miss 计数，给出 xxx 的命中率。'''
+    result = {}
+    for name, hit in counters.items():
+        if not name.endswith('_hit'):
+            continue
+        prefix = name[:-len('_hit')]
+        total = hit + counters.get(prefix + '_miss', 0)
+        result[prefix] = 0.0 if not total else float(hit) / total
+    return result
+
+def get_report():
+    ''' 给出用于接口输出的统计报告。'''
+    result = get_counters()
+    return {'pid': os.getpid(),
+            'uptime': time.time() - start_time,
+            'counters': result,
+            'hit_rates': get_hit_rates(result),
+           }
+
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import json
+import time
 
 import flock
+import numpy
+from sqlalchemy import and_, or_, bindparam, case, func, select
+from sqlalchemy.orm import aliased
 
-from YYMServer import db, app, util
+from YYMServer import db, app, cache, util, counters, popularity, cachesync
 from YYMServer.models import *
 
 
@@ -76,6 +81,281 @@ def transfer_actions():
             print 'Transferring actions tasks have been under processing!'
 
 
+def prune_tokens(days=None, batch=1000):
+    ''' 删除被取代的旧 token ：同一用户在同一设备上只保留最新的一个 token ，更早的 token 在创建 days 天后删除（默认为 TOKEN_RETENTION_DAYS 配置）。
+
+    旧 token 对应的缓存同时删除，客户端再使用这些 token 时按无效 token 处理。同时只允许一个实例运行。
+    '''
+    if days is None:
+        days = app.config['TOKEN_RETENTION_DAYS']
+    with open('/tmp/yym_task_prune_tokens.lock', 'w') as f:
+        blocking_lock = flock.Flock(f, flock.LOCK_EX|flock.LOCK_NB)
+
+        try:
+            with blocking_lock:
+                print 'Got lock and pruning superseded tokens:'
+                cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+                latest = db.session.query(Token.user_id.label('user_id'), Token.device.label('device'), func.max(Token.id).label('max_id')).group_by(Token.user_id, Token.device).subquery()
+                same_device = or_(Token.device == latest.c.device, and_(Token.device == None, latest.c.device == None))
+                query = db.session.query(Token.id, Token.token).join(latest, and_(Token.user_id == latest.c.user_id, same_device)).filter(Token.id < latest.c.max_id).filter(Token.create_time < cutoff).order_by(Token.id).limit(batch)
+                total = 0
+                while True:
+                    rows = query.all()
+                    if not rows:
+                        break
+                    db.session.query(Token).filter(Token.id.in_([id for id, token in rows])).delete(synchronize_session=False)
+                    db.session.commit()
+                    cache.delete_many(*[util.get_token_key(token) for id, token in rows if token])
+                    total += len(rows)
+                    print '* Deleted', len(rows), 'tokens, up to id', rows[-1][0]
+                print '* Pruned', total, 'tokens created before', cutoff
+        except IOError, e:
+            print 'Pruning tokens task has been under processing!'
+
+
+def _share_num_query():
+    ''' 用户分享过的有效 POI 、晒单评论、首页文章的数量（同一内容只计一次），与 util.count_shares 一致。'''
+    shared = []
+    for model, column in ((Site, ShareRecord.site_id), (Review, ShareRecord.review_id), (Article, ShareRecord.article_id)):
+        shared.append(db.session.query(ShareRecord.user_id.label('user_id'), func.count(func.distinct(column)).label('num')).join(model, model.id == column).filter(model.valid == True).group_by(ShareRecord.user_id))
+    shared = shared[0].union_all(*shared[1:]).subquery()
+    return db.session.query(shared.c.user_id, func.sum(shared.c.num)).group_by(shared.c.user_id)
+
+# 需要定期校对的计数字段：(model, 字段名, 格式化函数, 给出 (id, 实际计数) 的查询) ，实际计数的口径与 util.count_* 系列函数一致。
+fan_users = aliased(User)
+COUNTERS = [(User, 'fans_num', util.format_user, lambda: db.session.query(fans.c.user_id, func.count('*')).join(fan_users, fan_users.id == fans.c.fan_id).filter(fan_users.valid == True).group_by(fans.c.user_id)),
+            (User, 'follow_num', util.format_user, lambda: db.session.query(fans.c.fan_id, func.count('*')).join(fan_users, fan_users.id == fans.c.user_id).filter(fan_users.valid == True).group_by(fans.c.fan_id)),
+            (User, 'like_num', util.format_user, lambda: db.session.query(likes.c.user_id, func.count('*')).join(Review, Review.id == likes.c.review_id).filter(Review.valid == True).group_by(likes.c.user_id)),
+            (User, 'favorite_num', util.format_user, lambda: db.session.query(favorites.c.user_id, func.count('*')).join(Site, Site.id == favorites.c.site_id).filter(Site.valid == True).group_by(favorites.c.user_id)),
+            (User, 'review_num', util.format_user, lambda: db.session.query(Review.user_id, func.count('*')).filter(Review.valid == True).filter(Review.published == True).group_by(Review.user_id)),
+            (User, 'share_num', util.format_user, lambda: _share_num_query()),
+            (Review, 'like_num', util.format_review, lambda: db.session.query(likes.c.review_id, func.count('*')).join(User, User.id == likes.c.user_id).filter(User.valid == True).group_by(likes.c.review_id)),
+            (Review, 'comment_num', util.format_review, lambda: db.session.query(Comment.review_id, func.count('*')).filter(Comment.valid == True).group_by(Comment.review_id)),
+            (Site, 'review_num', util.format_site, lambda: db.session.query(Review.site_id, func.count('*')).filter(Review.valid == True).filter(Review.published == True).group_by(Review.site_id)),
+            (Site, 'stars_total', util.format_site, lambda: db.session.query(Review.site_id, func.sum(Review.stars)).filter(Review.valid == True).filter(Review.published == True).group_by(Review.site_id)),
+            (Article, 'comment_num', util.format_article, lambda: db.session.query(Comment.article_id, func.count('*')).filter(Comment.valid == True).group_by(Comment.article_id)),
+           ]
+
+FLOAT_TOLERANCE = 1e-6     # 小数计数（例如 Site.stars_total）因求和顺序不同产生的舍入误差，不超过此值的不算偏差
+
+FLUSH_LOCK = '/tmp/yym_task_flush_counters.lock'  # 写入计数增量缓冲（flush_counters）与校对计数（reconcile_counters）共用的锁
+
+def reconcile_counters(fix=True, batch=500):
+    ''' 用批量 SQL 重新计算各个计数字段（见 COUNTERS），输出与实际关系数据间的偏差；fix 为 True 时修正偏差并更新缓存。同时只允许一个实例运行。
+
+    接口在每次交互时只对计数做增量修改（util.incr_counters），重复请求、并发请求或后台直接修改数据都可能使计数产生偏差，由本任务定期修正。
+    校对期间持有 FLUSH_LOCK （等待正在运行的 run_counter_flusher 结束），不会与计数增量缓冲的写入交错进行。
+    '''
+    with open('/tmp/yym_task_reconcile_counters.lock', 'w') as f:
+        blocking_lock = flock.Flock(f, flock.LOCK_EX|flock.LOCK_NB)
+
+        try:
+            with blocking_lock:
+                print 'Got lock and reconciling counters:'
+                with open(FLUSH_LOCK, 'w') as flush_file:
+                    with flock.Flock(flush_file, flock.LOCK_EX):
+                        pending = {}
+                        if counters.enabled():  # 先写入缓冲中的增量，避免把尚未写入的增量当做偏差
+                            _flush_counters(batch)
+                            # 重新计算之前读取写入后又记入缓冲的增量，修正时只丢弃这部分，重新计算开始之后新增的增量予以保留：
+                            pending = counters.get_pending(counters.read_log()[2])
+                        for model, name, format_func, query_func in COUNTERS:
+                            deltas = dict((id, delta) for (tablename, field, id), delta in pending.items() if tablename == model.__tablename__ and field == name)
+                            _reconcile_counter(model, name, format_func, query_func, deltas, fix, batch)
+        except IOError, e:
+            print 'Reconciling counters task has been under processing!'
+
+def _reconcile_counter(model, name, format_func, query_func, deltas, fix, batch):
+    ''' 校对一个计数字段，deltas 是缓冲中尚未写入的增量 {id: 增量} ：接口输出的计数是字段值与增量之和，以两者之和与实际计数比较。'''
+    column = getattr(model, name)
+    actual = query_func().subquery()
+    id_column, num_column = list(actual.c)
+    if isinstance(column.type, db.Float):
+        drifted = or_(column == None, func.abs(column - func.coalesce(num_column, 0)) > FLOAT_TOLERANCE)
+    else:
+        drifted = func.coalesce(column, -1) != func.coalesce(num_column, 0)
+    if deltas:
+        drifted = or_(drifted, model.id.in_(deltas.keys()))
+    drifts = db.session.query(model.id, column, func.coalesce(num_column, 0)).outerjoin(actual, id_column == model.id).filter(drifted).all()
+    if deltas:
+        drifts = [(id, old if old is None else old + deltas.get(id, 0), new) for id, old, new in drifts]
+        drifts = [(id, old, new) for id, old, new in drifts if old != new]
+    print '* %s.%s: %d drifted, total drift %s' % (model.__name__, name, len(drifts), sum(abs((old or 0) - new) for id, old, new in drifts)), \
+          ', '.join('%d: %s -> %s' % (id, old, new) for id, old, new in drifts[:5])
+    if not fix or not drifts:
+        return
+    # 按修正后的值分组批量更新：
+    groups = {}
+    for id, old, new in drifts:
+        groups.setdefault(new, []).append(id)
+    for new, ids in groups.items():
+        for i in xrange(0, len(ids), batch):
+            db.session.query(model).filter(model.id.in_(ids[i:i + batch])).update({column: new}, synchronize_session=False)
+    ids = [id for id, old, new in drifts]
+    if model == Site:
+        _update_site_stars(ids)
+    db.session.commit()
+    if deltas:  # 修正后的值已经包含了重新计算之前记入缓冲的增量
+        counters.discard(model.__tablename__, name, dict((id, deltas[id]) for id in ids if id in deltas))
+    for i in xrange(0, len(ids), batch):
+        util.update_cache(db.session.query(model).filter(model.id.in_(ids[i:i + batch])).all(), format_func = format_func)
+
+
+def _update_site_stars(site_ids):
+    ''' 按 stars_total 和 review_num 重新计算 POI 的平均星级（没有评论的 POI 保留原有星级），不提交事务。'''
+    site = Site.__table__
+    db.session.execute(site.update().where(site.c.id.in_(site_ids)).values(stars = case([(site.c.review_num > 0, site.c.stars_total / site.c.review_num)], else_ = site.c.stars)))
+
+def rebuild_site_stars(batch=1000):
+    ''' 用批量 SQL 重新计算全部 POI 的 review_num 、 stars_total 和 stars ，用于初始化 stars_total 字段（见 initdb.py）。
+
+    平时这些字段由 models 模块中 Review 的 mapper 事件增量维护，偏差由 reconcile_counters 修正。
+    '''
+    review = Review.__table__
+    site = Site.__table__
+    counted = and_(review.c.site_id == site.c.id, review.c.valid == True, review.c.published == True)
+    review_num = select([func.count(review.c.id)]).where(counted).as_scalar()
+    stars_total = select([func.coalesce(func.sum(review.c.stars), 0.0)]).where(counted).as_scalar()
+    site_ids = [id for (id, ) in db.session.query(Site.id).order_by(Site.id)]
+    for i in xrange(0, len(site_ids), batch):
+        ids = site_ids[i:i + batch]
+        db.session.execute(site.update().where(site.c.id.in_(ids)).values(review_num = review_num, stars_total = stars_total))
+        _update_site_stars(ids)
+        db.session.commit()
+        util.update_cache(db.session.query(Site).filter(Site.id.in_(ids)).all(), format_func = util.format_site)
+        print '* Rebuilt stars of', len(ids), 'sites, up to id', ids[-1]
+
+# 计数增量缓冲（counters 模块）中各表对应的 model 及格式化函数：
+BUFFERED_MODELS = {'user': (User, util.format_user),
+                   'review': (Review, util.format_review),
+                  }
+
+def flush_counters(batch=500):
+    ''' 把 counters 模块缓冲的计数增量合并后批量写入数据库，并更新相关数据的缓存。给出写入的计数个数。
+
+    与 run_counter_flusher 、 reconcile_counters 共用 FLUSH_LOCK ，同一时间只有一个写入在进行；已有写入在进行时不做处理，给出 None 。
+    '''
+    with open(FLUSH_LOCK, 'w') as f:
+        blocking_lock = flock.Flock(f, flock.LOCK_EX|flock.LOCK_NB)
+
+        try:
+            with blocking_lock:
+                return _flush_counters(batch)
+        except IOError, e:
+            print 'Flushing counters task has been under processing!'
+
+def _flush_counters(batch):
+    ''' flush_counters 的实际处理，调用方需要持有 FLUSH_LOCK 。
+
+    先修改数据库，提交之后立即从缓冲中减去已写入的增量，再更新缓存（同时删除期间按不完整的计数生成的 JSON 片段）。
+    这样 get_info_ids 叠加的增量在 UPDATE 执行期间保持完整，接口输出的计数不会因写入而暂时偏少；
+    写入数据库失败时缓冲不受影响，增量留待下次写入。
+    '''
+    start, version, entries = counters.read_log()
+    pending = counters.get_pending(entries)
+    if not pending:
+        counters.mark_flushed(start, version, pending)
+        return 0
+    try:
+        # 同一字段、同一增量值的计数合并为一条 UPDATE ：
+        groups = {}
+        for (tablename, name, id), delta in pending.items():
+            groups.setdefault((tablename, name, delta), []).append(id)
+        for (tablename, name, delta), ids in groups.items():
+            model = BUFFERED_MODELS[tablename][0]
+            column = getattr(model, name)
+            for i in xrange(0, len(ids), batch):
+                db.session.query(model).filter(model.id.in_(ids[i:i + batch])).update({column: func.coalesce(column, 0) + delta}, synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    counters.mark_flushed(start, version, pending)
+    for tablename, (model, format_func) in BUFFERED_MODELS.items():
+        ids = list(set(id for (table, name, id) in pending if table == tablename))
+        for i in xrange(0, len(ids), batch):
+            util.update_cache(db.session.query(model).filter(model.id.in_(ids[i:i + batch])).all(), format_func = format_func)
+    return len(pending)
+
+def run_counter_flusher(duration=55, interval=5):
+    ''' 在 duration 秒内每隔 interval 秒执行一次 flush_counters ，供 cron 每分钟启动一次。同时只允许一个实例运行（持有 FLUSH_LOCK）。'''
+    with open(FLUSH_LOCK, 'w') as f:
+        blocking_lock = flock.Flock(f, flock.LOCK_EX|flock.LOCK_NB)
+
+        try:
+            with blocking_lock:
+                end_time = time.time() + duration
+                while True:
+                    start = time.time()
+                    flushed = _flush_counters(500)
+                    if flushed:
+                        print '* Flushed %d counters in %.3fs' % (flushed, time.time() - start)
+                    if time.time() + interval > end_time:
+                        break
+                    time.sleep(interval)
+        except IOError, e:
+            print 'Flushing counters task has been under processing!'
+
+
+# 人气指数（popularity 模块）：
+def _update_site_popular(batch):
+    ''' 按最新的人气指数批量修改 Site.popular （只修改有变化的 POI），给出被修改的 POI 数量。'''
+    scored_ids, scores = popularity.score_sites()
+    rows = db.session.query(Site.id, Site.popular).filter(Site.valid == True).order_by(Site.id).all()
+    if not rows:
+        return 0
+    ids, old = zip(*rows)
+    ids = numpy.array(ids, dtype=numpy.int64)
+    old = numpy.array([value or 0 for value in old], dtype=numpy.int64)
+    new = numpy.rint(popularity.lookup(ids, scored_ids, scores)).astype(numpy.int64)
+    changed = numpy.nonzero(new != old)[0]
+    site = Site.__table__
+    statement = site.update().where(site.c.id == bindparam('site_id')).values(popular = bindparam('popular'))
+    for i in xrange(0, len(changed), batch):
+        chunk = changed[i:i + batch]
+        db.session.execute(statement, [{'site_id': int(ids[j]), 'popular': int(new[j])} for j in chunk])
+        db.session.commit()
+        # POI 详情及片段缓存失效，各服务进程的 POI 数据表（sitetable）据 'site' 变更刷新“人气最高”排序：
+        cachesync.invalidate({'site': set(int(ids[j]) for j in chunk)})
+    if len(changed):
+        popularity.bump_version()   # 不使用 POI 数据表时，“人气最高”排序的候选集合缓存随之失效
+    return len(changed)
+
+def _select_reviews(batch):
+    ''' 把人气指数达到 REVIEW_SELECTED_SCORE 的已发布晒单评论设为精选，给出新设为精选的数量。
+
+    selected 也由运营人员手工设置，因此这里只设置、不取消精选。
+    '''
+    scored_ids, scores = popularity.score_reviews()
+    candidate_ids = [int(id) for id in scored_ids[scores >= app.config['REVIEW_SELECTED_SCORE']]]
+    review = Review.__table__
+    total = 0
+    for i in xrange(0, len(candidate_ids), batch):
+        ids = [id for (id, ) in db.session.query(Review.id).filter(Review.id.in_(candidate_ids[i:i + batch])).filter(Review.valid == True).filter(Review.published == True).filter(Review.selected != True)]
+        if not ids:
+            continue
+        db.session.execute(review.update().where(review.c.id.in_(ids)).values(selected = True))
+        db.session.commit()
+        cachesync.invalidate({'review': set(ids)}, cachesync.get_review_tags(db.session, ids))     # 晒单评论列表（例如 POI 详情中的精选）重新查询
+        total += len(ids)
+    return total
+
+def score_popularity(batch=1000):
+    ''' 每天计算一次 POI 和晒单评论的人气指数：批量修改 Site.popular ，并把人气高的晒单评论设为精选。同时只允许一个实例运行。'''
+    with open('/tmp/yym_task_score_popularity.lock', 'w') as f:
+        blocking_lock = flock.Flock(f, flock.LOCK_EX|flock.LOCK_NB)
+
+        try:
+            with blocking_lock:
+                print 'Got lock and scoring popularity:'
+                start = time.time()
+                print '* Updated popular of %d sites in %.1fs' % (_update_site_popular(batch), time.time() - start)
+                start = time.time()
+                print '* Selected %d reviews in %.1fs' % (_select_reviews(batch), time.time() - start)
+        except IOError, e:
+            print 'Scoring popularity task has been under processing!'
+
+
 if __name__ == '__main__':
     transfer_actions()
 
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import base64
 import json
 import math
 import random
@@ -10,6 +11,7 @@ import os.path
 import PIL
 import pytz
 from rfc3339 import rfc3339
+from sqlalchemy import func
 from sqlalchemy.orm import aliased
 
 import flask
@@ -19,7 +21,8 @@ from flask.ext.restful import fields
 import qiniu.rs
 import qiniu.io
 
-from YYMServer import db, cache, qiniu_bucket, qiniu_callback, tz_server
+from YYMServer import app, db, cache, qiniu_bucket, qiniu_callback, tz_server, stats, records, fragments, counters
+from YYMServer.caching import LocalCache
 from YYMServer.models import *
 
 
@@ -53,52 +56,144 @@ def get_distance(long1, lat1, long2, lat2):
     # in your favorite set of units to get length.
     return arc * 6378.1     # 后者是地球半径（单位是公里）
 
+# 进程内的一级缓存，放在共享缓存服务之前；其他进程修改数据后，通过 notify_changes 登记的变更使对应条目失效：
+local_cache = LocalCache(app.config['LOCAL_CACHE_SIZE'], app.config['LOCAL_CACHE_TIMEOUT'], app.config['LOCAL_CACHE_CHECK_INTERVAL'],
+                         get_changes = lambda channel, since: get_changes(channel, since))
+
 # @cache.memoize()    # 本应对常用的批量对象格式化结果进行缓存，避免对缓存服务进行频繁读取。但具体数据内容变化（例如评论数）时，无法自动更新这一级缓存，因而放弃。
 def get_info_ids(model_class, ids, format_func = None, valid_only = True):
-    ''' 根据输入的 id，从缓存中获取对应 model 实例的详情信息。'''
-    key_template = 'one_' + model_class.__tablename__ + '_%d'
-    has_valid_column = True if model_class.__tablename__ + '.valid' in model_class.__table__.columns else False
-    cached_result = []
+    ''' 根据输入的 id，从缓存中获取对应 model 实例的详情信息。
+
+    先读进程内的一级缓存 local_cache ，其中没有的再从共享缓存中批量读取（get_many），仍然没有的查库后批量写入（set_many）。
+    缓存中保存的是 records 模块定义的紧凑格式，返回的是解码得到的 records.Record 对象（没有定义格式的 model 仍是 model 实例）。
+
+    数据库中不存在的 id 缓存为 records.TOMBSTONE ，在 NEGATIVE_CACHE_TIMEOUT 秒内不再查库（新建数据时 cachesync 模块会删除对应的缓存）。
+    '''
+    tablename = model_class.__tablename__
+    key_template = 'one_' + tablename + '_%d'
+    # 注意：这一判断沿用原有写法，实际上从不成立（columns 以列名为 key），因而 valid_only 目前并不过滤无效数据。
+    # 分享页面模板、用户消息等调用方假定内嵌的用户、 POI 总能读到，修正之前需要先逐一检查这些调用方。
+    has_valid_column = True if tablename + '.valid' in model_class.__table__.columns else False
+    ids = [id or 0 for id in ids]
+    if not ids:
+        return []
+    keys = [key_template % id for id in ids]
+    local_cache.sync(tablename, key_template)
+    cached_dic = dict(zip(keys, local_cache.get_many(keys)))
+    missing_keys = list(set(key for key in keys if cached_dic[key] is None))
+    if missing_keys:
+        shared_dic = dict((key, data) for key, data in zip(missing_keys, cache.get_many(*missing_keys)) if data)
+        local_cache.set_many(shared_dic)
+        cached_dic.update(shared_dic)
+    loaded_dic = {}
     uncached_ids = []
-    for id in ids:
-        id = id or 0
-        key = key_template % id
-        obj = cache.get(key)
-        if obj:
-            if valid_only and has_valid_column and not obj.valid:
-                continue
-            cached_result.append(obj)
-        else:
-            cached_result.append(id)
+    missing_ids = set()
+    for id, key in zip(ids, keys):
+        data = cached_dic.get(key)
+        if data == records.TOMBSTONE:
+            missing_ids.add(id)
+            continue
+        obj = records.decode(tablename, data)
+        if obj is None:
             uncached_ids.append(id)
-    tmp_dic = {}
+        else:
+            loaded_dic[id] = obj
+    if missing_ids:     # 每个已知不存在的 id 都省去了一次按 id 的查库
+        stats.incr('negative_cache_saved_lookups', len(missing_ids))
     if uncached_ids:
         query = db.session.query(model_class).filter(model_class.id.in_(uncached_ids))
-        if valid_only and has_valid_column:
-            query = query.filter(model_class.valid == True)
+        mapping = {}
         for obj in query.all():
             if format_func != None:
                 obj = format_func(obj)
-            key = key_template % obj.id
-            cache.set(key, obj)
-            tmp_dic[obj.id] = obj
+            data = records.encode(tablename, obj)
+            mapping[key_template % obj.id] = data
+            loaded_dic[obj.id] = records.decode(tablename, data)
+        if mapping:
+            cache.set_many(mapping)
+            local_cache.set_many(mapping)
+        tombstones = dict((key_template % id, records.TOMBSTONE) for id in set(uncached_ids) if id not in loaded_dic)
+        if tombstones:
+            cache.set_many(tombstones, timeout=app.config['NEGATIVE_CACHE_TIMEOUT'])
+            local_cache.set_many(tombstones)
+    if counters.enabled():     # 叠加计数增量缓冲中尚未写入数据库的增量
+        counters.overlay(tablename, loaded_dic.values())
     result = []
-    for item in cached_result:
-        if isinstance(item, model_class):
-            result.append(item)
+    for id in ids:
+        obj = loaded_dic.get(id)
+        if obj is None:
+            continue
+        if valid_only and has_valid_column and not obj.valid:
             continue
-        if tmp_dic.has_key(item):
-            result.append(tmp_dic[item])
+        result.append(obj)
     return result
 
-def update_cache(model, format_func = None):
-    ''' 将单个 model 实例放入缓存。通常用于 post 和 put 操作数据的保存。'''
-    model_class = model.__class__
-    key_template = 'one_' + model_class.__tablename__ + '_%d'
-    key = key_template % model.id
-    if format_func != None:
-        model = format_func(model)
-    cache.set(key, model)
+def update_cache(models, format_func = None):
+    ''' 将 model 实例（或同一类 model 实例的列表）放入缓存。通常用于 post 和 put 操作数据的保存。'''
+    if isinstance(models, db.Model):
+        models = [models]
+    models = [model for model in models if model != None]
+    if not models:
+        return
+    tablename = models[0].__tablename__
+    key_template = 'one_' + tablename + '_%d'
+    mapping = {}
+    for model in models:
+        key = key_template % model.id
+        if format_func != None:
+            model = format_func(model)
+        mapping[key] = records.encode(tablename, model)
+    cache.set_many(mapping)
+    local_cache.set_many(mapping)
+    fragment_keys = fragments.get_keys(tablename, [model.id for model in models])     # 由旧数据生成的 JSON 片段不再可用
+    if fragment_keys:
+        cache.delete_many(*fragment_keys)
+    notify_changes(tablename, [model.id for model in models])
+
+def notify_changes(channel, ids):
+    ''' 在缓存服务中登记一批数据变更（例如 channel 为 'site' ，ids 为被修改的 POI id 列表），供各个服务进程中的常驻数据（如 sitetable.SiteTable）做增量刷新。
+
+    每次登记都使该 channel 的版本号加一，并把本次变更的 id 列表保存在该版本号名下。
+    '''
+    ids = [id for id in ids if id]
+    if not ids:
+        return
+    version = cache.cache.inc('changes_version_' + channel)
+    if version:
+        cache.set('changes_%s_%d' % (channel, version), ids)
+
+def get_changes(channel, since):
+    ''' 读取指定 channel 在版本号 since 之后登记的数据变更，返回 (最新版本号, 变更 id 列表) 。
+
+    如果中间某个版本的变更记录已经过期或丢失（或版本号被重置），无法做增量刷新，则变更 id 列表返回 None ，调用方应重新完整加载数据。
+    since 为 None 表示调用方还没有数据，只需要得到最新版本号（变更 id 列表同样返回 None）。
+    '''
+    version = cache.get('changes_version_' + channel) or 0
+    if since is None:
+        return (version, None)
+    if version == since:
+        return (version, [])
+    if version < since or version - since > 1000:
+        return (version, None)
+    keys = ['changes_%s_%d' % (channel, i) for i in xrange(since + 1, version + 1)]
+    ids = set()
+    for changed_ids in cache.get_many(*keys):
+        if changed_ids is None:
+            return (version, None)
+        ids.update(changed_ids)
+    return (version, sorted(ids))
+
+def encode_cursor(data):
+    ''' 把翻页位置信息（一个 dict）编码为不透明的 cursor 字符串，供客户端原样回传。'''
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')))
+
+def decode_cursor(cursor):
+    ''' 解码 encode_cursor 生成的 cursor 字符串，格式不正确时返回 None 。'''
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except Exception, e:
+        return None
+    return data if isinstance(data, dict) else None
 
 textlib_re = re.compile(r'(\{\{text:\d+(|#.*?)\}\})')
 
@@ -123,14 +218,17 @@ def replace_textlib(text):
     ''' 辅助函数：检查输入的 text 数据是否匹配 TextLib 替换代码，如果是则替换后返回。'''
     return textlib_re.sub(_replace_textlib, text)
 
-default_user_icon = db.session.query(Image).filter(Image.id == 9).first()
+@cache.memoize()
+def _get_default_user_icon():
+    ''' 私有辅助函数，读取用户默认头像。不在模块加载时查库，以免数据库尚未初始化时（例如初始化脚本、性能测试脚本）无法 import 。'''
+    return db.session.query(Image).filter(Image.id == 9).first()
 
 def format_user(user):
     ''' 辅助函数：用于格式化 User 实例，用于接口输出。'''
     user.formated_badges = () if not user.badges else user.badges.strip().split()
     user.icon_image = user.icon
     if not user.icon_id:
-        user.icon_image = default_user_icon
+        user.icon_image = _get_default_user_icon()
     return user
 
 def format_site(site):
@@ -177,16 +275,125 @@ def get_info_users(user_ids, valid_only = True, token = None):
     ''' 辅助函数：提取指定 id 的用户属性详情，并使用缓存。'''
     result = get_info_ids(User, user_ids, format_func = format_user, valid_only = valid_only)
     # 补充与当前用户间的关注关系：
-    if token:        # ToDo: 这里查询关注关系使用的是数据库查询，存在性能风险！
-        Main_User = aliased(User)
-        query = db.session.query(User.id).filter(User.valid == True).join(fans, User.id == fans.columns.user_id).join(Main_User, fans.columns.fan_id == Main_User.id).join(Token, Main_User.id == Token.user_id).filter(Token.token == token).filter(User.id.in_([user.id for user in result]))
-        follow_dic = {}
-        for user_id in query:
-            follow_dic[user_id[0]] = True
+    if token:
+        viewer = get_viewer(token).add('follows', [user.id for user in result])
         for user in result:
-            user.followed = follow_dic.get(user.id, False)
+            user.followed = viewer.followed(user.id)
     return result
 
+# 用户关系集合的种类，及读取某个用户该种关系全部 id 的查询：
+RELATIONS = {'favorites': lambda user_id: db.session.query(favorites.c.site_id).filter(favorites.c.user_id == user_id),    # 收藏的 POI
+             'likes': lambda user_id: db.session.query(likes.c.review_id).filter(likes.c.user_id == user_id),    # 喜欢的晒单评论
+             'follows': lambda user_id: db.session.query(fans.c.user_id).filter(fans.c.fan_id == user_id),    # 关注的用户
+            }
+
+def get_relation_key(relation, user_id):
+    return 'relations_%s_%d' % (relation, user_id)
+
+def get_relation_ids(user_id, relation):
+    ''' 辅助函数：给出用户 user_id 的 relation 关系（见 RELATIONS）涉及的全部 id 的集合，并使用缓存。
+
+    集合在首次使用时整体查库并缓存；用户收藏、喜欢、关注关系的修改提交到数据库后，由 cachesync 模块删除对应的缓存。
+    '''
+    if not user_id:
+        return frozenset()
+    key = get_relation_key(relation, user_id)
+    result = cache.get(key)
+    if result is None:
+        result = frozenset(id for (id, ) in RELATIONS[relation](user_id))
+        cache.set(key, result)
+    return result
+
+def get_token_key(token):
+    return 'token_user_%s' % token
+
+def get_token_user_id(token):
+    ''' 辅助函数：给出 token 对应的用户 id ，token 无效时给出 None 。
+
+    token 与用户的对应关系生成后不再改变（只会被 task.prune_tokens 整体删除），因而结果缓存在共享缓存中；
+    同一请求内的多次调用（例如 favorited 、 liked 、 followed 等字段的补充）只读取一次缓存，结果记录在 flask.g 中。
+    无效的 token 以 0 缓存较短时间（NEGATIVE_CACHE_TIMEOUT），避免反复查库。
+    '''
+    if not token:
+        return None
+    memo = None
+    if flask.has_app_context():
+        memo = getattr(flask.g, 'token_user_ids', None)
+        if memo is None:
+            memo = flask.g.token_user_ids = {}
+        if token in memo:
+            return memo[token]
+    key = get_token_key(token)
+    user_id = cache.get(key)
+    if user_id is None:
+        result = db.session.query(Token.user_id).filter(Token.token == token).first()
+        user_id = 0 if not result or not result[0] else result[0]
+        cache.set(key, user_id, timeout = None if user_id else app.config['NEGATIVE_CACHE_TIMEOUT'])
+    user_id = user_id or None
+    if memo is not None:
+        memo[token] = user_id
+    return user_id
+
+class ViewerContext(object):
+    ''' 一次请求中，当前用户（token 参数对应的用户）与接口输出的数据间的关系：是否收藏了 POI 、是否喜欢了晒单评论、是否关注了用户。
+
+    接口先用 add 登记本次响应将要输出的 id （关系种类见 RELATIONS），再逐条读取 favorited 、 liked 、 followed 标记。
+    首次读取某种关系的标记时，一次性解析该种关系已登记的全部 id ：每种关系在一次请求中最多读取一次用户的关系集合（get_relation_ids ，缓存未命中时只有一次查询）。
+    没有登记过的 id 也可以直接读取，这时只补充解析这一个 id ，不会再次读取关系集合。
+    '''
+    def __init__(self, token):
+        self.token = token
+        self.user_id = get_token_user_id(token)
+        self.pending = dict((relation, set()) for relation in RELATIONS)     # 已登记但尚未解析的 id
+        self.checked = dict((relation, set()) for relation in RELATIONS)     # 已解析的 id
+        self.found = dict((relation, set()) for relation in RELATIONS)       # 已解析且存在关系的 id
+        self.relation_ids = {}      # 关系种类 -> 用户该种关系的全部 id
+
+    def add(self, relation, ids):
+        self.pending[relation].update(id for id in ids if id and id not in self.checked[relation])
+        return self
+
+    def _resolve(self, relation):
+        pending = self.pending[relation]
+        if self.user_id and pending:
+            relation_ids = self.relation_ids.get(relation)
+            if relation_ids is None:
+                relation_ids = self.relation_ids[relation] = get_relation_ids(self.user_id, relation)
+            self.found[relation].update(relation_ids.intersection(pending))
+        self.checked[relation].update(pending)
+        pending.clear()
+
+    def has(self, relation, id):
+        ''' 当前用户与 id 间是否存在 relation 关系，没有有效 token 时为 False 。'''
+        if id not in self.checked[relation]:
+            self.pending[relation].add(id)
+            self._resolve(relation)
+        return id in self.found[relation]
+
+    def favorited(self, site_id):
+        ''' 是否收藏了 POI ，没有 token 参数时为 None 。'''
+        return None if not self.token else self.has('favorites', site_id)
+
+    def liked(self, review_id):
+        ''' 是否喜欢了晒单评论，没有 token 参数时为 False （与接口一直以来的输出一致）。'''
+        return False if not self.token else self.has('likes', review_id)
+
+    def followed(self, user_id):
+        ''' 是否关注了用户，没有 token 参数时为 None 。'''
+        return None if not self.token else self.has('follows', user_id)
+
+def get_viewer(token):
+    ''' 辅助函数：给出 token 对应的 ViewerContext ，同一请求内的各辅助函数共用同一个实例。'''
+    if not flask.has_app_context():
+        return ViewerContext(token)
+    viewers = getattr(flask.g, 'viewers', None)
+    if viewers is None:
+        viewers = flask.g.viewers = {}
+    viewer = viewers.get(token)
+    if viewer is None:
+        viewer = viewers[token] = ViewerContext(token)
+    return viewer
+
 def get_info_user(user_id, valid_only = True, token = None):
     ''' 与 get_info_users 的区别是只接收和返回单个的数据实例。'''
     result = get_info_users([user_id], valid_only, token = token)
@@ -208,7 +415,7 @@ def format_review(review):
     else:           # 如果 review 无图，则从对应的 site 的 gate_images 中随机取一个。
         if review.site_id:
             site = get_info_site(review.site_id)
-            if site.valid_gate_images:
+            if site and site.valid_gate_images:
                 review.valid_images = [random.choice(site.valid_gate_images)]
     review.images_num = len(review.valid_images)
     return review
@@ -323,14 +530,33 @@ def truncate_list(text, max_str_length, max_item_length):
             text = ' '.join(text.split()[:max_item_length])
     return text
 
-def get_self_and_children(model_class, self_id):
-    ''' 辅助函数：对指定 id 的数据，获取其自身及所有层级的子节点的 id 。'''
-    entries = [self_id]
-    for entry in db.session.query(model_class.id).filter(model_class.parent_id == self_id).all():
-        entry_id = entry[0]
-        sub_entries = get_self_and_children(model_class, entry_id)
-        entries.extend(sub_entries)
-    return entries
+def rebuild_closure(model_class, closure_class):
+    ''' 辅助函数：根据 model_class（Category 或 Area）当前的 parent_id 关系，重建其闭包表 closure_class ，并清除子节点 id 列表的缓存。
+
+    全部节点只需一次查询，在 Python 中逐个向上追溯祖先节点，层级关系中出现环时在环上停止追溯。
+    '''
+    parents = dict(db.session.query(model_class.id, model_class.parent_id).all())
+    rows = []
+    for id in parents:
+        ancestor_id = id
+        depth = 0
+        visited = set()
+        while ancestor_id != None and ancestor_id not in visited:
+            visited.add(ancestor_id)
+            rows.append({'ancestor_id': ancestor_id, 'descendant_id': id, 'depth': depth})
+            ancestor_id = parents.get(ancestor_id, None)
+            depth += 1
+    db.session.query(closure_class).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(closure_class.__table__.insert(), rows)
+    db.session.commit()
+    cache.delete_memoized(get_subtree_ids)
+
+@cache.memoize()
+def get_subtree_ids(closure_class, self_id):
+    ''' 辅助函数：从闭包表 closure_class 中，获取指定 id 的节点自身及其所有层级子节点的 id 。'''
+    query = db.session.query(closure_class.descendant_id).filter(closure_class.ancestor_id == self_id)
+    return [self_id] + [entry[0] for entry in query if entry[0] != self_id]
 
 def get_ids_from_str(ids_str):
     ''' 辅助函数：文本的用户 id 列表转为 long 类型的列表。'''
@@ -426,44 +652,69 @@ def diff_list_added(old, new):
     new_set = set(new)
     return list(new_set - old_set)
 
+def _pending_counters(models, name):
+    ''' 辅助函数：计数字段 name 重新计算之前，读取 counters 模块缓冲中这些数据尚未写入的增量，重新计算之后交给 _discard_counters 。'''
+    models = [model for model in models if model != None]
+    if not models or not counters.enabled():
+        return {}
+    return counters.snapshot(models[0].__tablename__, name, [model.id for model in models])
+
+def _discard_counters(models, name, deltas):
+    ''' 辅助函数：计数字段 name 重新计算之后，丢弃 counters 模块缓冲中重新计算之前读到的增量（实际计数已经包含了这些增量）。'''
+    models = [model for model in models if model != None]
+    if models and deltas:
+        counters.discard(models[0].__tablename__, name, deltas)
+
 def count_follow_fans(follows, fans):
     ''' 辅助函数，对交互行为涉及的用户账号，重新计算其 follow_num 和 fans_num 。'''
+    deltas = _pending_counters(follows, 'fans_num')
     for follow in follows:
         follow.fans_num = follow.fans.filter(User.valid == True).count()
         db.session.commit()
-        update_cache(follow, format_func = format_user)
+    _discard_counters(follows, 'fans_num', deltas)
+    update_cache(follows, format_func = format_user)
+    deltas = _pending_counters(fans, 'follow_num')
     for fan in fans:
         fan.follow_num = fan.follows.filter(User.valid == True).count()
         db.session.commit()
-        update_cache(fan, format_func = format_user)
+    _discard_counters(fans, 'follow_num', deltas)
+    update_cache(fans, format_func = format_user)
 
 def count_likes(users, reviews):
     ''' 辅助函数，对喜欢行为涉及的用户账号和晒单评论，重新计算其 like_num 。'''
+    deltas = _pending_counters(users, 'like_num')
     for user in users:
         user.like_num = user.likes.filter(Review.valid == True).count()
         db.session.commit()
-        update_cache(user, format_func = format_user)
+    _discard_counters(users, 'like_num', deltas)
+    update_cache(users, format_func = format_user)
+    deltas = _pending_counters(reviews, 'like_num')
     for review in reviews:
         review.like_num = review.fans.filter(User.valid == True).count()
         db.session.commit()
-        update_cache(review, format_func = format_review)
+    _discard_counters(reviews, 'like_num', deltas)
+    update_cache(reviews, format_func = format_review)
 
 def count_favorites(users, sites):
     ''' 辅助函数，对收藏行为涉及的用户账号和 POI ，重新计算其 favorite_num 。'''
+    deltas = _pending_counters(users, 'favorite_num')
     for user in users:
         user.favorite_num = user.favorites.filter(Site.valid == True).count()
     # Site 暂时没有与 favorite 相关的计数
         db.session.commit()
-        update_cache(user, format_func = format_user)
+    _discard_counters(users, 'favorite_num', deltas)
+    update_cache(users, format_func = format_user)
 
 def count_shares(users, sites, reviews, articles):
     ''' 辅助函数，对共享行为涉及的用户账号、 POI 、晒单评论、和首页文章，重新计算其 share_num 。'''
+    deltas = _pending_counters(users, 'share_num')
     for user in users:
         user.share_num = user.share_records.join(ShareRecord.site).filter(Site.valid == True).group_by('site_id').count() + \
                          user.share_records.join(ShareRecord.review).filter(Review.valid == True).group_by('review_id').count() + \
                          user.share_records.join(ShareRecord.article).filter(Article.valid == True).group_by('article_id').count()
         db.session.commit()
-        update_cache(user, format_func = format_user)
+    _discard_counters(users, 'share_num', deltas)
+    update_cache(users, format_func = format_user)
     # Site 暂时没有与 site, review, article 相关的计数
 
 def count_images(site):
@@ -477,25 +728,89 @@ def count_reviews(users, sites):
     for user in users:
         user.review_num = user.reviews.filter(Review.valid == True).filter(Review.published == True).count()
         db.session.commit()
-        update_cache(user, format_func = format_user)
+    update_cache(users, format_func = format_user)
     for site in sites:
-        reviews = site.reviews.filter(Review.valid == True).filter(Review.published == True).all()
-        if reviews:
-            review_num = len(reviews)
-            site.stars = sum([review.stars for review in reviews]) / review_num   # 假定用户发晒单评论时，星级必须填！
-            site.review_num = review_num
+        # 用 SQL 聚合计算，不把全部晒单评论读入内存：
+        review_num, stars_total = db.session.query(func.count(Review.id), func.sum(Review.stars)).filter(Review.site_id == site.id).filter(Review.valid == True).filter(Review.published == True).one()
+        site.review_num = review_num
+        site.stars_total = float(stars_total or 0)   # 假定用户发晒单评论时，星级必须填！
+        if review_num:
+            site.stars = site.stars_total / review_num
         db.session.commit()
-        update_cache(site, format_func = format_site)
+    update_cache(sites, format_func = format_site)
 
 def count_comments(users, articles, reviews):
     ''' 辅助函数，对子评论涉及的晒单评论、首页文章、用户账号（用户账号暂时不需要），重新计算其子评论数。'''
     for article in articles:
         article.comment_num = article.comments.filter(Comment.valid == True).count()
         db.session.commit()
-        update_cache(article, format_func = format_article)
+    update_cache(articles, format_func = format_article)
     for review in reviews:
         review.comment_num = review.comments.filter(Comment.valid == True).count()
         db.session.commit()
+    update_cache(reviews, format_func = format_review)
+
+def incr_counters(models, name, delta):
+    ''' 辅助函数：在当前事务中，把 models （同一类 model 实例的列表）的计数字段 name 原子地加上 delta （UPDATE ... SET name = name + delta），不提交事务。
+
+    与 count_* 系列函数重新 COUNT 全部关系不同，耗时不随用户、 POI 等的历史数据增长。计数与实际关系间的偏差由 task.reconcile_counters 定期修正。
+    '''
+    models = [model for model in models if model != None]
+    if not models or not delta:
+        return
+    model_class = type(models[0])
+    column = getattr(model_class, name)
+    db.session.query(model_class).filter(model_class.id.in_([model.id for model in models])).update({column: func.coalesce(column, 0) + delta}, synchronize_session = False)
+
+def _apply_counters(changes, delta):
+    ''' 辅助函数：按 changes （(model 实例列表, 计数字段名) 的列表）把计数增加 delta ，并提交事务。给出计数是否只记入了缓冲。
+
+    开启 COUNTER_BUFFER 配置时，先提交事务，再把增量记入 counters 模块的缓冲，由 task.flush_counters 批量写入数据库；
+    否则用 incr_counters 在同一事务中修改计数后提交。
+    '''
+    buffered = counters.enabled()
+    if not buffered:
+        for models, name in changes:
+            incr_counters(models, name, delta)
+    db.session.commit()
+    if buffered:
+        for models, name in changes:
+            models = [model for model in models if model != None]
+            if models:
+                counters.add(models[0].__tablename__, name, [model.id for model in models], delta)
+    return buffered
+
+def incr_follow_fans(follow, fan, delta):
+    ''' 辅助函数，用户 fan 关注（delta 为 1）或取消关注（delta 为 -1）用户 follow 时，与关注关系的修改一起增减 fans_num 和 follow_num ，提交并更新缓存。'''
+    if not _apply_counters([([follow], 'fans_num'), ([fan], 'follow_num')], delta):
+        update_cache([follow, fan], format_func = format_user)
+
+def incr_likes(user, review, delta):
+    ''' 辅助函数，用户喜欢或取消喜欢晒单评论时，与喜欢关系的修改一起增减双方的 like_num ，提交并更新缓存。'''
+    if not _apply_counters([([user], 'like_num'), ([review], 'like_num')], delta):
+        update_cache(user, format_func = format_user)
         update_cache(review, format_func = format_review)
 
+def incr_favorites(user, site, delta):
+    ''' 辅助函数，用户收藏或取消收藏 POI 时，与收藏关系的修改一起增减用户的 favorite_num ，提交并更新缓存。'''
+    # Site 暂时没有与 favorite 相关的计数
+    if not _apply_counters([([user], 'favorite_num')], delta):
+        update_cache(user, format_func = format_user)
+
+def incr_shares(user, delta):
+    ''' 辅助函数，用户分享之前没有分享过的 POI 、晒单评论或首页文章时（delta 为新分享的内容数），与分享记录一起增加用户的 share_num ，提交并更新缓存。'''
+    if not _apply_counters([([user], 'share_num')], delta) and delta:
+        update_cache(user, format_func = format_user)
+
+def incr_comments(comment, delta):
+    ''' 辅助函数，发表（delta 为 1）或删除（delta 为 -1）子评论时，在同一事务中增减所属首页文章、晒单评论的 comment_num ，提交并更新缓存。'''
+    db.session.flush()
+    article = comment.article
+    review = comment.review
+    incr_counters([article], 'comment_num', delta)
+    incr_counters([review], 'comment_num', delta)
+    db.session.commit()
+    update_cache([article], format_func = format_article)
+    update_cache([review], format_func = format_review)
+
 
@@ -6,6 +6,7 @@ from flask import jsonify, render_template, request
 
 from YYMServer import app, db, cache
 
+import YYMServer.cachesync
 import YYMServer.admin
 import YYMServer.rpc
 import YYMServer.share
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+''' 部署或清空缓存服务之后的缓存预热：预先计算访问量最大的几类接口数据并写入共享缓存，避免上线后最初几分钟的请求全部穿透到数据库。
+
+预热的内容包括：城市、国家、分类列表，各城市默认排序的 POI 列表前几页，各城市的首页文章列表，以及人气最高的 POI 详情。
+调用的都是 rpc 接口实际使用的缓存函数，参数也与接口的默认参数一致，因而生成的缓存 key 与线上请求完全相同。
+只有共享的缓存服务（例如 Redis）才能被其他进程预热；各服务进程内的一级缓存（LocalCache）及 POI 数据表仍然在首次访问时加载。
+
+用法见 cron/warm_cache.py 。
+'''
+
+import time
+from multiprocessing.pool import ThreadPool
+
+import flock
+
+from YYMServer import app, db, util
+from YYMServer.models import *
+from YYMServer import rpc
+
+
+def _run(task):
+    ''' 在独立的请求上下文中执行一个预热任务，给出 (任务名称, 耗时秒数, 错误信息) 。'''
+    name, func, args = task
+    start = time.time()
+    error = None
+    with app.test_request_context():
+        try:
+            func(*args)
+        except Exception, e:
+            error = repr(e)
+            db.session.rollback()
+    return (name, time.time() - start, error)
+
+def _warm_site_pages(city_id, pages, limit):
+    ''' 按 /rpc/sites 接口的默认参数（默认排序、概要信息）逐页读取城市的 POI 列表，同时读取列表中 POI 的详情。'''
+    site_list = rpc.SiteList()
+    cursor = None
+    for i in xrange(pages):
+        result, cursor = site_list._get_page(1, 0l, None, 0l, city_id, 0, 0l, 0, None, None, 0, limit, cursor)
+        util.get_info_sites(result)
+        if cursor is None:
+            break
+
+def _warm_articles(city_id, limit):
+    ''' 读取城市的首页文章列表，以及第一页文章的详情。'''
+    result = rpc.ArticleList()._get(0l, city_id)
+    rpc.get_info_articles(result[:limit])
+
+def _warm_sites(site_ids):
+    util.get_info_sites(site_ids)
+
+def get_tasks(top_sites=500, site_pages=1, page_size=10):
+    ''' 给出全部预热任务，每个任务是 (名称, 函数, 参数) 。'''
+    tasks = [('cities', rpc.CityList()._get, (0l, )),
+             ('countries', rpc.CountryList()._get, (0l, )),
+             ('categories', rpc.CategoryList()._get, (0l, )),
+            ]
+    with app.test_request_context():
+        city_ids = [id for (id, ) in db.session.query(City.id).filter(City.valid == True).order_by(City.order.desc()).all()]
+        site_ids = [id for (id, ) in db.session.query(Site.id).filter(Site.valid == True).order_by(Site.popular.desc()).limit(top_sites).all()]
+    for city_id in city_ids:
+        city_id = long(city_id)
+        tasks.append(('city %d' % city_id, rpc.CityList()._get, (city_id, )))
+        tasks.append(('sites of city %d' % city_id, _warm_site_pages, (city_id, site_pages, page_size)))
+        tasks.append(('articles of city %d' % city_id, _warm_articles, (city_id, page_size)))
+    for i in xrange(0, len(site_ids), 100):
+        chunk = site_ids[i:i + 100]
+        tasks.append(('popular sites %d-%d' % (i + 1, i + len(chunk)), _warm_sites, (chunk, )))
+    return tasks
+
+def warm(workers=4, top_sites=500, site_pages=1, page_size=10):
+    ''' 以最多 workers 个线程并发执行预热任务，输出每个任务的耗时及汇总信息。给出出错的任务数量。'''
+    start = time.time()
+    tasks = get_tasks(top_sites, site_pages, page_size)
+    print '* Warming cache with %d tasks, %d workers ...' % (len(tasks), workers)
+    pool = ThreadPool(max(1, workers))
+    try:
+        results = []
+        for name, seconds, error in pool.imap_unordered(_run, tasks):
+            results.append((name, seconds, error))
+            if error:
+                print '  %-32s FAILED after %.3fs: %s' % (name, seconds, error)
+            else:
+                print '  %-32s %.3fs' % (name, seconds)
+    finally:
+        pool.close()
+        pool.join()
+    errors = len([result for result in results if result[2]])
+    total = sum(result[1] for result in results)
+    slowest = sorted(results, key=lambda result: result[1], reverse=True)[:5]
+    print '* Finished in %.3fs (task time %.3fs), %d failed.' % (time.time() - start, total, errors)
+    print '* Slowest tasks: ' + ', '.join('%s (%.3fs)' % (name, seconds) for name, seconds, error in slowest)
+    return errors
+
+def warm_with_lock(*args, **kwargs):
+    ''' 与 warm 相同，但同一时间只允许一个预热进程运行。'''
+    with open('/tmp/yym_task_warm_cache.lock', 'w') as f:
+        blocking_lock = flock.Flock(f, flock.LOCK_EX|flock.LOCK_NB)
+
+        try:
+            with blocking_lock:
+                return warm(*args, **kwargs)
+        except IOError, e:
+            print 'Another cache warmer is running!'
+            return 1
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+''' 对比两种缓存格式的体积及序列化耗时：
+
+* 原格式：直接 pickle 经过 util.format_site / format_user / format_review 处理的 SQLAlchemy 实例；
+* 现格式：records 模块定义的紧凑元组。
+
+用法：python benchmark/cache_records.py [每种数据的重复次数]，默认 2000 次。数据是临时 sqlite 数据库中生成的模拟数据。
+'''
+
+import cPickle as pickle
+import datetime
+import os
+import os.path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.split(os.path.split(os.path.realpath(__file__))[0])[0], 'flask-hmacauth'))
+sys.path.insert(0, os.path.split(os.path.split(os.path.realpath(__file__))[0])[0])
+
+# 未指定配置文件时，使用临时的 sqlite 数据库，以便在没有 MySQL 的环境中运行：
+if not os.environ.get('YYMSERVER_SETTINGS'):
+    settings_file = tempfile.NamedTemporaryFile(suffix='.py', delete=False)
+    settings_file.write("SQLALCHEMY_DATABASE_URI = 'sqlite://'\nCACHE_TYPE = 'null'\n")
+    settings_file.close()
+    os.environ['YYMSERVER_SETTINGS'] = settings_file.name
+
+from YYMServer import app, db, util, records
+from YYMServer.models import *
+
+
+def seed():
+    ''' 生成一组典型的 POI 、用户和晒单评论，返回经过格式化的 (表名, 实例) 列表。'''
+    db.create_all()
+    images = [Image(path='site/%d.jpg' % i, note=u'图片 %d' % i, width=640, height=480) for i in xrange(6)]
+    db.session.add_all(images)
+    country = Country(name=u'日本', valid=True)
+    city = City(name=u'东京', valid=True, country=country)
+    area = Area(name=u'银座', valid=True, city=city)
+    category = Category(name=u'购物', valid=True)
+    user = User(name=u'买手', username='buyer', badges=u'达人 买手', icon=images[0])
+    db.session.add_all([country, city, area, category, user])
+    db.session.commit()
+    image_ids = ' '.join(str(image.id) for image in images)
+    site = Site(valid=True, name=u'银座三越', name_orig=u'銀座三越', area=area, logo=images[0], top_images=image_ids, gate_images=image_ids,
+                longitude=139.7654, latitude=35.6717, payment=u'V M UP', address=u'東京都中央区銀座4-6-16', keywords=u'{百货} 化妆品 退税',
+                business_hours=u'10:00-20:00', description=u'位于银座中心的老牌百货店。' * 5)
+    site.categories.append(category)
+    db.session.add(site)
+    db.session.commit()
+    review = Review(valid=True, published=True, user=user, site=site, stars=4.5, content=u'退税很方便，店员服务周到。' * 10,
+                    images=image_ids, keywords=u'退税 化妆品', total=12000, currency=u'日元', publish_time=datetime.datetime.now())
+    db.session.add(review)
+    db.session.commit()
+    return [('site', util.format_site(site)), ('user', util.format_user(user)), ('review', util.format_review(review))]
+
+def measure(func, count):
+    start = time.time()
+    for i in xrange(count):
+        result = func()
+    return (time.time() - start) * 1000000 / count, result
+
+
+if __name__ == '__main__':
+    count = 2000 if len(sys.argv) < 2 else int(sys.argv[1])
+    with app.test_request_context():
+        for tablename, model in seed():
+            old_dumps, old_data = measure(lambda: pickle.dumps(model, pickle.HIGHEST_PROTOCOL), count)
+            new_dumps, new_data = measure(lambda: pickle.dumps(records.encode(tablename, model), pickle.HIGHEST_PROTOCOL), count)
+            old_loads, result = measure(lambda: pickle.loads(old_data), count)
+            new_loads, result = measure(lambda: records.decode(tablename, pickle.loads(new_data)), count)
+            print '%-7s pickled instance: %6d bytes, dumps %7.1f us, loads %7.1f us' % (tablename, len(old_data), old_dumps, old_loads)
+            print '%-7s compact record:   %6d bytes, dumps %7.1f us, loads %7.1f us' % ('', len(new_data), new_dumps, new_loads)
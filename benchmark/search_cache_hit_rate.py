@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+''' 模拟“附近”搜索请求，对比两种缓存 key 方案的命中率：
+
+* 原方案：SiteList._get_sorted 按全部搜索条件及精确到 4 位小数的用户经纬度缓存排序结果；
+* 现方案：SiteList._get_site_items 按筛选条件及 geohash 覆盖方格缓存候选集合，距离计算和排序按请求单独完成。
+
+用法：python benchmark/search_cache_hit_rate.py [请求数量]，默认模拟 1 小时内的 2 万次请求，缓存时间取 CACHE_DEFAULT_TIMEOUT 。
+线上的实际命中率可以通过 /rpc/stats 接口中的 site_candidates 项查看。
+'''
+
+import os
+import os.path
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.split(os.path.split(os.path.realpath(__file__))[0])[0], 'flask-hmacauth'))
+sys.path.insert(0, os.path.split(os.path.split(os.path.realpath(__file__))[0])[0])
+
+# 未指定配置文件时，使用临时的 sqlite 数据库，以便在没有 MySQL 的环境中运行：
+if not os.environ.get('YYMSERVER_SETTINGS'):
+    settings_file = tempfile.NamedTemporaryFile(suffix='.py', delete=False)
+    settings_file.write("SQLALCHEMY_DATABASE_URI = 'sqlite://'\nCACHE_TYPE = 'null'\n")
+    settings_file.close()
+    os.environ['YYMSERVER_SETTINGS'] = settings_file.name
+
+from YYMServer import app
+from YYMServer.geohash import covering_cells
+
+HOTSPOTS = ((139.7005, 35.6595), (139.7671, 35.6812), (139.7966, 35.7148), (135.5023, 34.6937), (135.7681, 35.0116))     # 涩谷、东京站、浅草、大阪、京都
+CATEGORIES = (0, 0, 0, 1, 2, 3, 4, 5)       # 不限分类的请求最多
+ORDERS = (0, 0, 1, 2, 3)
+RANGES = (0, 0, 0, 1, 3, 5, 10)     # 0 表示默认的 5 公里
+DURATION = 3600
+
+
+def generate_requests(count):
+    ''' 生成 (时间, 经度, 纬度, 分类, 排序, 范围) 格式的随机请求，用户位置集中在几个热门地点附近。'''
+    requests = []
+    for i in xrange(count):
+        lon, lat = random.choice(HOTSPOTS)
+        requests.append((random.uniform(0, DURATION),
+                         round(lon + random.gauss(0, 0.02), 4), round(lat + random.gauss(0, 0.02), 4),
+                         random.choice(CATEGORIES), random.choice(ORDERS), random.choice(RANGES)))
+    requests.sort()
+    return requests
+
+def old_key(request):
+    now, longitude, latitude, category, order, range = request
+    return (category, order, range, longitude, latitude)
+
+def new_key(request):
+    now, longitude, latitude, category, order, range = request
+    range = range or 5
+    return (category, 0 if order == 1 else order, tuple(covering_cells(longitude, latitude, range)))
+
+def simulate(requests, key_func, timeout):
+    ''' 按请求时间顺序模拟缓存读写，给出 (命中次数, 缓存条目数) 。'''
+    expires = {}
+    hit = 0
+    for request in requests:
+        now = request[0]
+        key = key_func(request)
+        if expires.get(key, -1) > now:
+            hit += 1
+        else:
+            expires[key] = now + timeout
+    return (hit, len(expires))
+
+
+if __name__ == '__main__':
+    random.seed(408)
+    count = 20000 if len(sys.argv) < 2 else int(sys.argv[1])
+    timeout = app.config['CACHE_DEFAULT_TIMEOUT']
+    requests = generate_requests(count)
+    for name, key_func in (('lon/lat key (old)', old_key), ('filters + geohash cells (new)', new_key)):
+        hit, entries = simulate(requests, key_func, timeout)
+        print '%-30s hit rate: %5.1f%%  cache entries: %d' % (name, 100.0 * hit / count, entries)
+
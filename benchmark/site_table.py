@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+''' 性能对比：“附近”搜索中原有的逐个 POI 计算距离并排序的 Python 循环（SiteList._get_sorted），与 sitetable.SiteTable 的 NumPy 批量计算。
+
+用法：python benchmark/site_table.py [POI 数量 ...]，默认分别测试 1 万、10 万、100 万个 POI 。
+测试数据是随机生成的，集中分布在几个城市中心点附近，不读写数据库。
+'''
+
+import os
+import os.path
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.split(os.path.split(os.path.realpath(__file__))[0])[0], 'flask-hmacauth'))
+sys.path.insert(0, os.path.split(os.path.split(os.path.realpath(__file__))[0])[0])
+
+# 未指定配置文件时，使用临时的 sqlite 数据库，以便在没有 MySQL 的环境中运行：
+if not os.environ.get('YYMSERVER_SETTINGS'):
+    settings_file = tempfile.NamedTemporaryFile(suffix='.py', delete=False)
+    settings_file.write("SQLALCHEMY_DATABASE_URI = 'sqlite://'\nCACHE_TYPE = 'null'\n")
+    settings_file.close()
+    os.environ['YYMSERVER_SETTINGS'] = settings_file.name
+
+from YYMServer import util
+from YYMServer.sitetable import SiteTable
+
+CITIES = ((139.7670, 35.6814), (135.5023, 34.6937), (126.9780, 37.5665), (100.5018, 13.7563))    # 东京、大阪、首尔、曼谷
+REPEAT = 5
+
+
+def generate_rows(count):
+    ''' 生成 (id, valid, longitude, latitude, order, popular, stars, area_id) 格式的随机 POI 数据。'''
+    rows = []
+    for id in xrange(1, count + 1):
+        center_lon, center_lat = random.choice(CITIES)
+        rows.append((id, True,
+                     center_lon + random.gauss(0, 0.15), center_lat + random.gauss(0, 0.15),
+                     random.randint(0, 100), random.randint(0, 10000), random.randint(0, 10) / 2.0,
+                     random.randint(1, 50)))
+    return rows
+
+def legacy_rank(site_items, order, longitude, latitude, range):
+    ''' 与 SiteList._get_sorted 中原有的排序逻辑一致（_get 的数据库排序部分用 Python 排序代替）。'''
+    result = []
+    for site_item in site_items:
+        id, lon, lat, order_value, popular, stars = site_item
+        distance = 0.0 if not longitude or not latitude else util.get_distance(longitude, latitude, lon, lat)
+        if range and distance > range:
+            continue
+        result.append({'id': id,
+                       'dist': distance,
+                       'order': order_value,
+                       'popular': popular,
+                       'stars': stars,
+                      })
+    if order == 1:
+        result.sort(key = lambda x: x['dist'])
+    elif order == 2:
+        result.sort(key = lambda x: -x['popular'])
+    elif order == 3:
+        result.sort(key = lambda x: -x['stars'])
+    else:
+        result.sort(key = lambda x: -x['order'])
+    return map(lambda x: x['id'], result)
+
+def timeit(func, *args):
+    ''' 重复执行 REPEAT 次，返回最短耗时（毫秒）及最后一次的结果。'''
+    best = None
+    for i in xrange(REPEAT):
+        start = time.time()
+        result = func(*args)
+        cost = (time.time() - start) * 1000
+        best = cost if best is None else min(best, cost)
+    return (best, result)
+
+def run(count):
+    rows = generate_rows(count)
+    site_items = [(row[0], row[2], row[3], row[4], row[5], row[6]) for row in rows]
+    site_ids = [row[0] for row in rows]
+    table = SiteTable()
+    start = time.time()
+    table.load(rows, [])
+    load_cost = (time.time() - start) * 1000
+    longitude, latitude = CITIES[0]
+    print '%d sites (table load: %.1f ms)' % (count, load_cost)
+    for order, range in ((1, 5), (0, 5), (2, 20), (1, 0)):
+        legacy_cost, legacy_result = timeit(legacy_rank, site_items, order, longitude, latitude, range)
+        table_cost, table_result = timeit(table.rank, site_ids, order, longitude, latitude, range)
+        same = len(set(legacy_result) ^ set(table_result))
+        print '  order=%d range=%-2d results=%-7d legacy=%9.1f ms  table=%7.1f ms  speedup=%6.1fx  diff=%d' % \
+              (order, range, len(table_result), legacy_cost, table_cost, legacy_cost / max(table_cost, 0.001), same)
+
+
+if __name__ == '__main__':
+    random.seed(408)
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    for count in counts:
+        run(count)
+
@@ -0,0 +1,18 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+
+# 以下路径通常需要根据服务器实际路径修改：
+# 用于 virtualenv 的：
+sys.path.insert(0, '/var/www/youyoumm/lib/python2.7/site-packages')
+# 用于载入 Application 自身的：
+sys.path.insert(0, '/var/www/youyoumm/YYMServer/flask-hmacauth')
+sys.path.insert(0, '/var/www/youyoumm/YYMServer')
+
+from YYMServer import task
+
+# 建议设定的 cron 执行时间为每天凌晨执行一次（只输出偏差而不修正时，可以改为调用 task.reconcile_counters(fix=False)）：
+# 0 4 * * *
+if __name__ == '__main__':
+    task.reconcile_counters()
@@ -0,0 +1,26 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+
+# 以下路径通常需要根据服务器实际路径修改：
+# 用于 virtualenv 的：
+sys.path.insert(0, '/var/www/youyoumm/lib/python2.7/site-packages')
+# 用于载入 Application 自身的：
+sys.path.insert(0, '/var/www/youyoumm/YYMServer/flask-hmacauth')
+sys.path.insert(0, '/var/www/youyoumm/YYMServer')
+
+from YYMServer import warmer
+
+# 不需要定时执行，在部署新版本或清空缓存服务之后手动执行一次即可，例如：
+# python cron/warm_cache.py --workers 8 --top-sites 1000
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=u'预热共享缓存中访问量最大的接口数据。')
+    parser.add_argument('--workers', type=int, default=4, help=u'并发执行的线程数，默认为 4 。')
+    parser.add_argument('--top-sites', type=int, default=500, help=u'预热详情的人气最高 POI 数量，默认为 500 。')
+    parser.add_argument('--site-pages', type=int, default=1, help=u'每个城市预热的 POI 列表页数，默认为 1 。')
+    parser.add_argument('--page-size', type=int, default=10, help=u'每页的数据条数，与客户端的 limit 参数一致，默认为 10 。')
+    args = parser.parse_args()
+    errors = warmer.warm_with_lock(args.workers, args.top_sites, args.site_pages, args.page_size)
+    sys.exit(1 if errors else 0)
@@ -34,3 +34,22 @@ if db.session.query(User).count() == 0:
     db.session.add(operator)
     db.session.commit()
 
+# 为已有的 POI 补算 geohash 方格编码（旧数据库需先执行：ALTER TABLE site ADD COLUMN geohash VARCHAR(12) DEFAULT '', ADD INDEX ix_site_geohash (geohash);）：
+from YYMServer.models import Site
+from YYMServer import geohash
+for site in db.session.query(Site).filter(Site.longitude != None).filter(Site.latitude != None).filter((Site.geohash == None) | (Site.geohash == '')):
+    if site.longitude and site.latitude:
+        site.geohash = geohash.encode(site.latitude, site.longitude)
+db.session.commit()
+
+# POI 星级之和的缓存字段（旧数据库需先执行：ALTER TABLE site ADD COLUMN stars_total FLOAT DEFAULT 0;），用批量 SQL 初始化：
+from YYMServer import task
+task.rebuild_site_stars()
+
+# token 按 token 值查询，旧数据库需先建立索引：ALTER TABLE token ADD INDEX ix_token_token (token);
+
+# 重建 POI 分类和商区的层级关系闭包表：
+from YYMServer.models import Category, CategoryClosure, Area, AreaClosure
+from YYMServer import util
+util.rebuild_closure(Category, CategoryClosure)
+util.rebuild_closure(Area, AreaClosure)